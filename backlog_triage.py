@@ -0,0 +1,175 @@
+"""
+Startup triage of the updates that piled up while the bot was down.
+
+Without it, polling hands every queued update to the handlers in arrival
+order, so the bot spends its first minutes answering messages that are
+hours old while people writing right now wait. Before polling starts, the
+backlog is fetched (and confirmed to Telegram) and each update is sorted by
+age and kind:
+
+- fresh updates (younger than BACKLOG_FRESH_SECONDS) are handled first and
+  unchanged
+- stale private messages are collapsed per chat: the latest message is
+  answered once, with the text of the earlier unanswered ones prepended, so
+  one LLM call covers the whole chat; messages older than
+  BACKLOG_PRIVATE_MAX_AGE are dropped
+- stale group messages addressed to the bot (mention, reply, command) keep
+  only the latest one per chat and user, up to BACKLOG_GROUP_MAX_AGE;
+  other stale group chatter is dropped
+- stale commands are kept up to BACKLOG_COMMAND_MAX_AGE
+"""
+
+import logging
+import time
+from collections import Counter, OrderedDict
+
+from telebot import apihelper
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_FIELDS = ("message", "edited_message", "channel_post", "edited_channel_post")
+
+
+def fetch_backlog(token, max_updates=10000):
+    """Fetch and confirm every pending update; returns (updates, next_offset)"""
+    updates = []
+    offset = None
+    while len(updates) < max_updates:
+        # A short long-poll: the final, empty call also confirms everything fetched before it
+        batch = apihelper.get_updates(token, offset=offset, limit=100, long_polling_timeout=1)
+        if not batch:
+            break
+        updates.extend(batch)
+        offset = batch[-1]["update_id"] + 1
+    else:
+        # Stopped at max_updates: confirm the last batch, the rest is left to polling
+        apihelper.get_updates(token, offset=offset, limit=1, long_polling_timeout=0)
+    return updates, offset
+
+
+class BacklogTriage:
+    """Decides which backlog updates to handle, in which order and in what form"""
+
+    def __init__(self, bot_id=None, bot_username=None, fresh_seconds=60, private_max_age=6 * 3600,
+                 group_max_age=600, command_max_age=600, collapse_limit=5):
+        self.bot_id = bot_id
+        self.bot_username = (bot_username or "").lower()
+        self.fresh_seconds = fresh_seconds
+        self.private_max_age = private_max_age
+        self.group_max_age = group_max_age
+        self.command_max_age = command_max_age
+        self.collapse_limit = collapse_limit
+
+    def _addressed(self, message):
+        text = message.get("text") or message.get("caption") or ""
+        if text.startswith("/"):
+            # /cmd@other_bot in a group is meant for another bot
+            _, _, target = text.split()[0].partition("@")
+            return not target or bool(self.bot_username) and target.lower() == self.bot_username.lower()
+        if self.bot_username and f"@{self.bot_username.lower()}" in text.lower():
+            return True
+        reply = message.get("reply_to_message") or {}
+        return bool(self.bot_id) and (reply.get("from") or {}).get("id") == self.bot_id
+
+    def classify(self, update, now):
+        """Return (kind, age) for a raw update; kind is one of
+        fresh, private, private_command, group_addressed, group_chatter, edited, other"""
+        field = next((f for f in MESSAGE_FIELDS if update.get(f)), None)
+        if field is None:
+            # Callback queries, inline queries, ... carry no date
+            return "other", 0.0
+        message = update[field]
+        age = max(0.0, now - message.get("date", now))
+        if age <= self.fresh_seconds:
+            return "fresh", age
+        if field != "message":
+            return "edited", age
+        text = message.get("text") or ""
+        if message["chat"].get("type") == "private":
+            return ("private_command" if text.startswith("/") else "private"), age
+        return ("group_addressed" if self._addressed(message) else "group_chatter"), age
+
+    def _collapse(self, messages):
+        """One update answering the latest private message, with earlier texts folded in"""
+        update_id, latest = messages[-1]
+        parts = [m for _, m in messages[-self.collapse_limit:] if m.get("text")]
+        if latest.get("text") and len(parts) > 1:
+            # Entity offsets count UTF-16 code units from the start of the joined text
+            entities = []
+            start = 0
+            for part in parts:
+                entities += [dict(entity, offset=entity["offset"] + start) for entity in part.get("entities", ())]
+                start += len(part["text"].encode("utf-16-le")) // 2 + 1
+            latest = dict(latest, text="\n".join(part["text"] for part in parts))
+            latest.pop("entities", None)
+            if entities:
+                latest["entities"] = entities
+        return {"update_id": update_id, "message": latest}
+
+    def plan(self, updates, now=None):
+        """Return (updates to handle in order, Counter of what happened to the rest)"""
+        now = now or time.time()
+        fresh = []
+        other = []
+        private_chats = OrderedDict()
+        private_commands = []
+        group_latest = OrderedDict()
+        report = Counter()
+
+        for update in updates:
+            kind, age = self.classify(update, now)
+            report[f"seen_{kind}"] += 1
+            if kind == "fresh":
+                fresh.append(update)
+            elif kind == "other":
+                other.append(update)
+            elif kind == "private":
+                if age > self.private_max_age:
+                    report["dropped_too_old"] += 1
+                    continue
+                message = update["message"]
+                private_chats.setdefault(message["chat"]["id"], []).append((update["update_id"], message))
+            elif kind == "private_command":
+                if age > self.command_max_age:
+                    report["dropped_too_old"] += 1
+                    continue
+                private_commands.append(update)
+            elif kind == "group_addressed":
+                if age > self.group_max_age:
+                    report["dropped_too_old"] += 1
+                    continue
+                message = update["message"]
+                key = (message["chat"]["id"], (message.get("from") or {}).get("id"))
+                if key in group_latest:
+                    report["collapsed"] += 1
+                group_latest[key] = update
+            else:
+                report[f"dropped_{kind}"] += 1
+
+        collapsed_private = []
+        for messages in private_chats.values():
+            report["collapsed"] += len(messages) - 1
+            collapsed_private.append(self._collapse(messages))
+        # Chats that wrote most recently are answered first
+        collapsed_private.sort(key=lambda u: u["message"].get("date", 0), reverse=True)
+        stale_groups = sorted(group_latest.values(), key=lambda u: u["message"].get("date", 0), reverse=True)
+
+        ordered = fresh + other + collapsed_private + private_commands + stale_groups
+        report["handled"] = len(ordered)
+        return ordered, report
+
+
+def triage_startup_backlog(token, triage):
+    """Fetch the pending backlog and return (updates to handle in order, next offset, report)"""
+    started = time.time()
+    try:
+        updates, offset = fetch_backlog(token)
+    except Exception as e:
+        logger.error(f"Could not fetch the update backlog, leaving it to polling: {e}")
+        return [], None, Counter()
+    ordered, report = triage.plan(updates)
+    report["backlog"] = len(updates)
+    if updates:
+        logger.info(f"Backlog triage: {len(updates)} pending updates -> {len(ordered)} handled "
+                    f"in {time.time() - started:.2f}s; {dict(report)}")
+    return ordered, offset, report
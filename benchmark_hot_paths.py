@@ -0,0 +1,404 @@
+"""
+Micro-benchmarks for the per-message CPU work in simple_ruke_bot.py.
+
+Covers check_mentions, get_conversation_history / add_to_conversation with
+10k-1M tracked users, prompt assembly in generate_response, JPEG encoding
+in generate_image, user tracking and offline reply lookups. Network calls
+are replaced by in-process stand-ins so only the bot's own work is measured.
+
+Results are written as JSON (one file per commit by default) and can be
+compared against an earlier run:
+
+    python benchmark_hot_paths.py
+    python benchmark_hot_paths.py --compare benchmark_results/4d8ccc2.json
+"""
+
+import argparse
+import gc
+import importlib
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_USER_COUNTS = (10_000, 100_000, 1_000_000)
+
+
+def git_revision():
+    """Short hash of the current commit, or 'unknown'"""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return "unknown"
+
+
+def load_bot(store="memory"):
+    """Import the bot module with harmless settings (nothing is contacted at import time)"""
+    os.environ["CONVERSATION_STORE"] = store
+    os.environ.setdefault("TELEGRAM_TOKEN", "123456:BENCHMARK-TOKEN")
+    os.environ.setdefault("GOOGLE_API_KEY", "benchmark-key")
+    os.environ.setdefault("USERS_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="ruke-bench-"), "users.db"))
+    sys.path.insert(0, REPO_DIR)
+    return importlib.import_module("simple_ruke_bot")
+
+
+def measure(func, min_time=0.2, rounds=5):
+    """Time `func` (called with no arguments) and return per-call statistics in microseconds"""
+    # Calibrate how many calls fit into one round
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / rounds or number >= 1 << 24:
+            break
+        number *= 2
+
+    samples = []
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(rounds):
+            start = time.perf_counter()
+            for _ in range(number):
+                func()
+            samples.append((time.perf_counter() - start) / number * 1e6)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    return {
+        "calls_per_round": number,
+        "rounds": rounds,
+        "min_us": min(samples),
+        "median_us": statistics.median(samples),
+        "mean_us": statistics.mean(samples),
+        "stdev_us": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "ops_per_second": 1e6 / statistics.median(samples),
+    }
+
+
+class StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class StubChat:
+    """Stands in for ChatSession; keeps the history like the real one"""
+
+    def __init__(self, model, history):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, content, **kwargs):
+        response = self.model.generate_content(self.history + [{"role": "user", "parts": [content]}])
+        self.history.append({"role": "user", "parts": [content]})
+        self.history.append({"role": "model", "parts": [response.text]})
+        return response
+
+
+class StubModel:
+    """Stands in for GenerativeModel; returns a fixed reply without any I/O"""
+
+    def __init__(self, reply="Ку-ку-ку! Люди такие забавные."):
+        self.reply = StubResponse(reply)
+        self.last_prompt = None
+
+    def generate_content(self, prompt, *args, **kwargs):
+        self.last_prompt = prompt
+        return self.reply
+
+    def start_chat(self, history=None):
+        return StubChat(self, history)
+
+
+class StubImageClient:
+    """Stands in for InferenceClient.text_to_image; returns a pre-rendered PIL image"""
+
+    def __init__(self, size):
+        from PIL import Image
+
+        random_bytes = random.Random(0).randbytes(size[0] * size[1] * 3)
+        self.image = Image.frombytes("RGB", size, random_bytes)
+
+    def text_to_image(self, prompt, **kwargs):
+        return self.image
+
+
+def populate_conversations(bot_module, users, messages_per_user=2, users_per_chat=100):
+    """Fill the conversation store with `users` tracked users and return their (chat_id, user_id) keys"""
+    store = bot_module.conversation_store
+    store.clear()
+    keys = []
+    now = time.time()
+    for i in range(users):
+        chat_id = -1001000000000 - i // users_per_chat
+        user_id = 100000 + i
+        for m in range(messages_per_user, 0, -1):
+            message = f"Человек: сообщение {m}" if m % 2 == 0 else f"Рюк: ответ {m}"
+            store.append_message(chat_id, user_id, message, bot_module.CONVERSATION_TIMEOUT, now - m)
+        keys.append((chat_id, user_id))
+    return keys
+
+
+def reset_history(bot_module, chat_id, user_id, seed_history):
+    """Restore a user's history so repeated calls don't grow it without bound"""
+    store = bot_module.conversation_store
+    store.clear_conversation(chat_id, user_id)
+    now = time.time()
+    for age, message in enumerate(reversed(seed_history), 1):
+        store.append_message(chat_id, user_id, message, bot_module.CONVERSATION_TIMEOUT, now - age)
+
+
+def seed_history_of(bot_module, chat_id, user_id):
+    return bot_module.conversation_store.recent_messages(
+        chat_id, user_id, bot_module.CONVERSATION_TIMEOUT, limit=1000)
+
+
+def bench_check_mentions(bot_module, args):
+    bot_module.BOT_USERNAME = "my_Ruke_bot"
+    long_text = "Сегодня в школе была контрольная, и я вообще ничего не поняла. " * 8
+    cases = {
+        "check_mentions[mention]": "@my_Ruke_bot привет, как дела?",
+        "check_mentions[other_mention]": "@someone_else посмотри на это",
+        "check_mentions[no_mention]": "просто сообщение в группе без упоминаний",
+        "check_mentions[long_no_mention]": long_text,
+    }
+    results = {}
+    for name, text in cases.items():
+        results[name] = measure(lambda text=text: bot_module.check_mentions(text), args.min_time, args.rounds)
+    return results
+
+
+def bench_conversations(bot_module, args):
+    results = {}
+    rng = random.Random(42)
+    for users in args.users:
+        keys = populate_conversations(bot_module, users)
+        sample = [rng.choice(keys) for _ in range(1024)]
+        seed_history = seed_history_of(bot_module, *sample[0])
+        counter = [0]
+
+        def fetch():
+            chat_id, user_id = sample[counter[0] & 1023]
+            counter[0] += 1
+            bot_module.get_conversation_history(chat_id, user_id)
+
+        def append():
+            chat_id, user_id = sample[counter[0] & 1023]
+            counter[0] += 1
+            reset_history(bot_module, chat_id, user_id, seed_history)
+            bot_module.add_to_conversation(chat_id, user_id, "Человек: ещё одно сообщение")
+
+        results[f"get_conversation_history[{users}]"] = measure(fetch, args.min_time, args.rounds)
+        results[f"add_to_conversation[{users}]"] = measure(append, args.min_time, args.rounds)
+        bot_module.conversation_store.clear()
+        gc.collect()
+    return results
+
+
+def bench_generate_response(bot_module, args):
+    results = {}
+    stub = StubModel()
+    bot_module.model = stub
+    bot_module.chat_sessions.model_factory = lambda model_name, persona: stub
+    bot_module.chat_sessions.reset("benchmark-stub")
+    populate_conversations(bot_module, 1, messages_per_user=4)
+    chat_id, user_id = -1001000000000, 100000
+    seed_history = seed_history_of(bot_module, chat_id, user_id)
+    short_text = "Рюк, как дела?"
+    long_text = "Сегодня в школе была контрольная, и я вообще ничего не поняла. " * 8
+
+    def respond(text):
+        # Every call starts from the same four-message history and a rebuilt chat session
+        reset_history(bot_module, chat_id, user_id, seed_history)
+        bot_module.chat_sessions.discard(chat_id, user_id)
+        bot_module.generate_response(text, chat_id, user_id)
+
+    def respond_pooled(text):
+        # Conversation already has a live session in the pool
+        reset_history(bot_module, chat_id, user_id, seed_history)
+        bot_module.generate_response(text, chat_id, user_id)
+
+    results["generate_response[no_history]"] = measure(
+        lambda: bot_module.generate_response(short_text), args.min_time, args.rounds
+    )
+    results["generate_response[with_history]"] = measure(lambda: respond(short_text), args.min_time, args.rounds)
+    results["generate_response[long_message]"] = measure(lambda: respond(long_text), args.min_time, args.rounds)
+    results["generate_response[pooled_session]"] = measure(
+        lambda: respond_pooled(short_text), args.min_time, args.rounds
+    )
+    bot_module.conversation_store.clear()
+    return results
+
+
+def bench_track_users(bot_module, args):
+    from types import SimpleNamespace
+    from user_registry import UserRegistry
+
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="ruke-bench-")
+    users = [SimpleNamespace(id=i, username=f"user{i}", first_name="Имя", last_name=None) for i in range(1000)]
+    registries = {
+        "track_users[coalesced]": UserRegistry(os.path.join(workdir, "coalesced.db")),
+        "track_users[write_through]": UserRegistry(os.path.join(workdir, "write_through.db"), flush_interval=0),
+    }
+    for name, registry in registries.items():
+        counter = [0]
+
+        def record(registry=registry):
+            registry.record_interaction(users[counter[0] % len(users)])
+            counter[0] += 1
+
+        results[name] = measure(record, args.min_time, args.rounds)
+        registry.close()
+    return results
+
+
+def bench_offline_reply(bot_module, args):
+    from reply_index import ReplyIndex, build_index
+
+    rng = random.Random(42)
+    topics = ["яблоко", "школа", "айдол", "музыка", "друг", "тетрадь", "смерть", "игра", "скучно", "привет",
+              "дела", "любовь", "учитель", "контрольная", "немецкий", "погода", "аниме", "шинигами", "правда"]
+    letters = "абвгдежзиклмнопрстуфхцчшэюя"
+    rare = ["".join(rng.choice(letters) for _ in range(7)) for _ in range(20000)]
+    exchanges = [
+        (" ".join(rng.choice(topics) if rng.random() < 0.5 else rng.choice(rare) for _ in range(rng.randint(2, 12))),
+         f"Ку-ку-ку... ответ номер {i}")
+        for i in range(100_000)
+    ]
+    path = os.path.join(tempfile.mkdtemp(prefix="ruke-bench-"), "replies.idx")
+    build_index(exchanges, path)
+    index = ReplyIndex(path)
+    cases = {
+        "offline_reply[common_words]": "Рюк, мне скучно в школе, давай поиграем",
+        "offline_reply[rare_words]": f"{rare[5]} {rare[77]} айдол",
+        "offline_reply[no_match]": "абракадабра",
+    }
+    results = {}
+    for name, text in cases.items():
+        results[name] = measure(lambda text=text: index.search(text), args.min_time, args.rounds)
+    index.close()
+    return results
+
+
+def bench_generate_image(bot_module, args):
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="ruke-bench-")
+    previous_dir = os.getcwd()
+    previous_client = bot_module.hf_client
+    os.chdir(workdir)
+    try:
+        for size in args.image_sizes:
+            bot_module.hf_client = StubImageClient((size, size))
+            results[f"generate_image[{size}x{size}]"] = measure(
+                lambda: bot_module.generate_image("яблоко смерти"), args.min_time, max(3, args.rounds // 2)
+            )
+            for name in os.listdir(workdir):
+                os.remove(os.path.join(workdir, name))
+    finally:
+        bot_module.hf_client = previous_client
+        os.chdir(previous_dir)
+    return results
+
+
+BENCHMARKS = {
+    "check_mentions": bench_check_mentions,
+    "conversations": bench_conversations,
+    "generate_response": bench_generate_response,
+    "track_users": bench_track_users,
+    "offline_reply": bench_offline_reply,
+    "generate_image": bench_generate_image,
+}
+
+
+def compare(current, baseline_path, threshold):
+    """Print a comparison against an earlier results file and return the names that regressed"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = []
+    print(f"\nComparison against {baseline.get('revision', '?')} ({baseline_path}):")
+    for name, result in current["results"].items():
+        old = baseline.get("results", {}).get(name)
+        if not old:
+            print(f"  {name:<45} new")
+            continue
+        ratio = result["median_us"] / old["median_us"] if old["median_us"] else float("inf")
+        marker = ""
+        if ratio > 1 + threshold:
+            marker = "  <-- REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            marker = "  (faster)"
+        print(f"  {name:<45} {old['median_us']:>12.2f} -> {result['median_us']:>12.2f} us  x{ratio:.2f}{marker}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the bot's hot paths")
+    parser.add_argument("--only", nargs="*", choices=sorted(BENCHMARKS), help="Run only these groups")
+    parser.add_argument("--users", type=lambda s: [int(x) for x in s.split(",")], default=list(DEFAULT_USER_COUNTS),
+                        help="Comma-separated tracked-user counts for the conversation benchmarks")
+    parser.add_argument("--store", default="memory",
+                        help="CONVERSATION_STORE to benchmark, e.g. memory or sqlite:///bench_state.db")
+    parser.add_argument("--image-sizes", type=lambda s: [int(x) for x in s.split(",")], default=[512, 1024],
+                        help="Comma-separated square image sizes for the JPEG encoding benchmark")
+    parser.add_argument("--min-time", type=float, default=0.5, help="Approximate seconds spent per benchmark")
+    parser.add_argument("--rounds", type=int, default=5, help="Timed rounds per benchmark")
+    parser.add_argument("--output", help="Results file (default: benchmark_results/<revision>.json)")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Relative slowdown counted as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 on regressions")
+    parser.add_argument("--with-logging", action="store_true",
+                        help="Keep the bot's INFO logging enabled (it is silenced by default)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    bot_module = load_bot(args.store)
+    if not args.with_logging:
+        logging.disable(logging.INFO)
+
+    revision = git_revision()
+    report = {
+        "revision": revision,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "store": args.store,
+        "results": {},
+    }
+
+    for group in args.only or list(BENCHMARKS):
+        print(f"Running {group}...")
+        results = BENCHMARKS[group](bot_module, args)
+        for name, result in results.items():
+            print(f"  {name:<45} median {result['median_us']:>12.2f} us  ({result['ops_per_second']:,.0f} ops/s)")
+        report["results"].update(results)
+
+    output = args.output or os.path.join(REPO_DIR, "benchmark_results", f"{revision}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved to {output}")
+
+    if args.compare:
+        regressions = compare(report, args.compare, args.threshold)
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,400 @@
+"""
+Re-engagement broadcaster, ported from the Schedule Trigger branch of the n8n
+flow (Ryuk_test.json): every few hours, message users who have been idle for
+more than BROADCAST_IDLE_HOURS.
+
+Unlike the n8n loop (one user at a time: LLM call, send, next), a run
+- selects idle users with one indexed query on telegram_users.last_interaction
+- generates messages concurrently with a bounded thread pool; users without
+  recent history share a generic template, one LLM call per
+  BROADCAST_TEMPLATE_BATCH users
+- sends through rate-limited lanes (a global token bucket under Telegram's
+  ~30 msg/s limit, one lane per worker thread, 429 retry_after honoured)
+- keeps its queue in SQLite, so a crashed run is resumed instead of restarted
+- logs progress and returns a throughput report
+
+Run once from the command line with `python broadcaster.py --once`, or set
+BROADCAST_ENABLED=1 to run it on a schedule inside the bot. A dry run
+(`--dry-run`) keeps its queue in a throwaway database and leaves
+telegram_users.last_broadcast alone, so it changes nothing for real runs.
+"""
+
+import argparse
+import logging
+import math
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+logger = logging.getLogger(__name__)
+
+PROACTIVE_PROMPT = """
+Ты – Рюк, бог смерти из аниме Death Note.
+Твоя цель – продолжить разговор или начать новую тему, если собеседник долго молчит.
+- Если последний разговор был на интересной теме (например, обсуждение айдолов, школы, отношений, игр), попробуй продолжить его с вопросом или комментарием.
+- Если разговор затих на нейтральной или скучной теме, предложи игру или новый вопрос, чтобы развлечься.
+- Если пользователь просто не отвечал, но тема была личной (например, о чувствах), не дави – лучше предложи что-то отвлеченное.
+- Периодически вставляй немецкие слова или простые фразы, мягко предлагая ответить на немецком.
+- Не повторяй тему яблок слишком часто – ты же не магазин фруктов.
+Примеры сообщений после паузы:
+Если тема была про айдолов или музыку:
+“Ку-ку-ку… Интересно, а если бы у бога смерти был айдол-групп, как бы она называлась? Угадай или придумай свой вариант.”
+Если разговор был о школе:
+“Школа, учеба, оценки… Интересно, а если бы вместо уроков учили, как вести себя с богами смерти? Какой предмет был бы самым сложным?”
+Если обсуждали дружбу или отношения:
+“Хе-хе… люди такие забавные. Говорят одно, делают другое. А ты легко понимаешь, когда кто-то притворяется другом?”
+Если долго не отвечают:
+“Hallo? Уснул? Или твоя тетрадь уже где-то потерялась? Хе-хе…”
+Если нужна новая тема:
+“Давай сыграем в игру: ‘Правда или ложь’. Я говорю три факта о себе, а ты угадываешь, какой – ложь. Поехали!”
+Ты – не просто бот, ты Рюк. Разговаривай естественно, с любопытством и каплей цинизма. Твоя цель – не просто говорить, а развлечься.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS broadcast_runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL NOT NULL,
+    finished REAL,
+    status TEXT NOT NULL,
+    selected INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS broadcast_queue (
+    run_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    message TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated REAL,
+    PRIMARY KEY (run_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS broadcast_queue_by_status ON broadcast_queue (run_id, status);
+"""
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, up to `burst` at once"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Broadcaster:
+    """Generates and sends re-engagement messages to idle users"""
+
+    def __init__(self, registry, send_message, generate_message, get_history,
+                 idle_seconds=5 * 3600, llm_concurrency=4, send_lanes=4, send_rate=25.0,
+                 template_batch=20, max_attempts=3, progress_interval=5.0, dry_run=False):
+        self.registry = registry
+        self.send_message = send_message
+        self.generate_message = generate_message
+        self.get_history = get_history
+        self.idle_seconds = idle_seconds
+        self.llm_concurrency = llm_concurrency
+        self.send_lanes = send_lanes
+        self.bucket = TokenBucket(send_rate)
+        self.template_batch = template_batch
+        self.max_attempts = max_attempts
+        self.progress_interval = progress_interval
+        self.dry_run = dry_run
+        self._run_lock = threading.Lock()
+        self._local = threading.local()
+        self._dry_run_dir = tempfile.TemporaryDirectory(prefix="broadcast-dry-run-") if dry_run else None
+        connection = self.connection()
+        connection.executescript(SCHEMA)
+        connection.commit()
+
+    # --- run bookkeeping -------------------------------------------------
+
+    def connection(self):
+        """Connection to the run queue: the registry's database, or a throwaway one for dry runs"""
+        if not self.dry_run:
+            return self.registry.connection()
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(os.path.join(self._dry_run_dir.name, "broadcast.db"), timeout=30)
+            self._local.connection = connection
+        return connection
+
+    def has_unfinished_run(self):
+        return self.connection().execute(
+            "SELECT COUNT(*) FROM broadcast_runs WHERE status = 'running'"
+        ).fetchone()[0] > 0
+
+    def _open_run(self):
+        """Return (run_id, resumed) for an unfinished run, or a new run filled with idle users"""
+        connection = self.connection()
+        row = connection.execute(
+            "SELECT run_id FROM broadcast_runs WHERE status = 'running' ORDER BY run_id DESC LIMIT 1"
+        ).fetchone()
+        if row:
+            return row[0], True
+
+        now = time.time()
+        # Users messaged within the last interval are skipped, so a restart doesn't message them twice
+        user_ids = self.registry.idle_user_ids(self.idle_seconds, not_broadcast_since=now - self.idle_seconds)
+        with connection:
+            cursor = connection.execute(
+                "INSERT INTO broadcast_runs (started, status, selected) VALUES (?, 'running', ?)",
+                (now, len(user_ids)),
+            )
+            run_id = cursor.lastrowid
+            connection.executemany(
+                "INSERT INTO broadcast_queue (run_id, user_id, status, updated) VALUES (?, ?, 'pending', ?)",
+                [(run_id, user_id, now) for user_id in user_ids],
+            )
+        return run_id, False
+
+    def _rows(self, run_id, status):
+        return self.connection().execute(
+            "SELECT user_id, message, attempts FROM broadcast_queue WHERE run_id = ? AND status = ?",
+            (run_id, status),
+        ).fetchall()
+
+    def _set_status(self, run_id, updates):
+        """Apply [(user_id, status, message_or_None)] in one transaction"""
+        if not updates:
+            return
+        connection = self.connection()
+        now = time.time()
+        with connection:
+            connection.executemany(
+                "UPDATE broadcast_queue SET status = ?, message = COALESCE(?, message), "
+                "attempts = attempts + (? = 'failed'), updated = ? WHERE run_id = ? AND user_id = ?",
+                [(status, message, status, now, run_id, user_id) for user_id, status, message in updates],
+            )
+
+    # --- generation ------------------------------------------------------
+
+    def _generate_all(self, run_id, pending, on_generated):
+        """Generate messages for `pending` user ids; calls on_generated(user_id, message) as they finish"""
+        personal = []
+        generic = []
+        for user_id in pending:
+            history = self.get_history(user_id)
+            if history:
+                personal.append((user_id, history))
+            else:
+                generic.append(user_id)
+
+        template_count = math.ceil(len(generic) / self.template_batch) if generic else 0
+        logger.info(f"Broadcast {run_id}: {len(personal)} personal messages, "
+                    f"{len(generic)} users sharing {template_count} template messages")
+
+        with ThreadPoolExecutor(max_workers=self.llm_concurrency, thread_name_prefix="broadcast-llm") as pool:
+            futures = {}
+            for user_id, history in personal:
+                futures[pool.submit(self.generate_message, history)] = [user_id]
+            for i in range(template_count):
+                batch = generic[i * self.template_batch:(i + 1) * self.template_batch]
+                futures[pool.submit(self.generate_message, [])] = batch
+
+            for future in as_completed(futures):
+                users = futures[future]
+                try:
+                    message = future.result()
+                except Exception as e:
+                    logger.error(f"Broadcast {run_id}: message generation failed for {len(users)} users: {e}")
+                    self._set_status(run_id, [(user_id, "failed", None) for user_id in users])
+                    continue
+                if not message:
+                    self._set_status(run_id, [(user_id, "failed", None) for user_id in users])
+                    continue
+                self._set_status(run_id, [(user_id, "generated", message) for user_id in users])
+                for user_id in users:
+                    on_generated(user_id, message)
+
+    # --- sending ---------------------------------------------------------
+
+    def _send_one(self, user_id, message):
+        """Send with retries; returns 'sent', 'blocked' or 'failed'"""
+        for attempt in range(self.max_attempts):
+            self.bucket.acquire()
+            try:
+                self.send_message(user_id, message)
+                return "sent"
+            except Exception as e:
+                code = getattr(e, "error_code", None)
+                if code == 429:
+                    retry_after = 1
+                    result = getattr(e, "result_json", None) or {}
+                    retry_after = result.get("parameters", {}).get("retry_after", retry_after)
+                    logger.warning(f"Rate limited by Telegram, waiting {retry_after}s")
+                    time.sleep(retry_after)
+                    continue
+                if code in (400, 403):
+                    # Bot blocked, chat not found, user deactivated...
+                    return "blocked"
+                logger.warning(f"Send to {user_id} failed (attempt {attempt + 1}): {e}")
+                time.sleep(min(2 ** attempt, 10))
+        return "failed"
+
+    def _lane(self, run_id, lane_queue, counters, lock):
+        while True:
+            item = lane_queue.get()
+            if item is None:
+                return
+            user_id, message = item
+            status = self._send_one(user_id, message)
+            self._set_status(run_id, [(user_id, status, None)])
+            if status != "failed" and not self.dry_run:
+                # Blocked users are marked too, so they are not selected again every run
+                self.registry.mark_broadcast([user_id])
+            with lock:
+                counters[status] += 1
+
+    # --- public API ------------------------------------------------------
+
+    def run(self):
+        """Run (or resume) one broadcast and return a report dict"""
+        if not self._run_lock.acquire(blocking=False):
+            logger.warning("Broadcast already in progress, skipping")
+            return None
+        try:
+            return self._run()
+        finally:
+            self._run_lock.release()
+
+    def _run(self):
+        started = time.time()
+        run_id, resumed = self._open_run()
+        pending = [row[0] for row in self._rows(run_id, "pending")]
+        generated = [(row[0], row[1]) for row in self._rows(run_id, "generated")]
+        # Failed rows from an earlier attempt get another chance when resuming
+        retry = [row[0] for row in self._rows(run_id, "failed") if row[2] < self.max_attempts] if resumed else []
+        total = len(pending) + len(generated) + len(retry)
+        logger.info(f"Broadcast {run_id} {'resumed' if resumed else 'started'}: {total} users to message")
+
+        counters = {"sent": 0, "blocked": 0, "failed": 0}
+        lock = threading.Lock()
+        lanes = [queue.Queue() for _ in range(self.send_lanes)]
+        threads = [
+            threading.Thread(target=self._lane, args=(run_id, lane, counters, lock),
+                             name=f"broadcast-lane-{i}", daemon=True)
+            for i, lane in enumerate(lanes)
+        ]
+        for thread in threads:
+            thread.start()
+
+        def enqueue(user_id, message):
+            lanes[user_id % len(lanes)].put((user_id, message))
+
+        stop_progress = threading.Event()
+
+        def report_progress():
+            while not stop_progress.wait(self.progress_interval):
+                with lock:
+                    done = sum(counters.values())
+                    sent = counters["sent"]
+                elapsed = time.time() - started
+                logger.info(f"Broadcast {run_id}: {done}/{total} done, {sent} sent, "
+                            f"{done / elapsed if elapsed else 0:.1f} msg/s")
+
+        progress = threading.Thread(target=report_progress, name="broadcast-progress", daemon=True)
+        progress.start()
+
+        for user_id, message in generated:
+            enqueue(user_id, message)
+        self._generate_all(run_id, pending + retry, enqueue)
+
+        for lane in lanes:
+            lane.put(None)
+        for thread in threads:
+            thread.join()
+        stop_progress.set()
+
+        # Users whose generation failed were never queued for sending
+        with lock:
+            done = sum(counters.values())
+        generation_failed = len(self._rows(run_id, "failed")) - counters["failed"]
+
+        finished = time.time()
+        connection = self.connection()
+        with connection:
+            connection.execute(
+                "UPDATE broadcast_runs SET status = 'done', finished = ? WHERE run_id = ?", (finished, run_id)
+            )
+        elapsed = finished - started
+        report = {
+            "run_id": run_id,
+            "resumed": resumed,
+            "users": total,
+            "sent": counters["sent"],
+            "blocked": counters["blocked"],
+            "send_failed": counters["failed"],
+            "generation_failed": max(0, generation_failed),
+            "elapsed_seconds": elapsed,
+            "messages_per_second": done / elapsed if elapsed else 0.0,
+        }
+        logger.info(f"Broadcast {run_id} finished: {report}")
+        return report
+
+
+def start_scheduler(broadcaster, interval_seconds):
+    """Run the broadcaster every `interval_seconds` in a daemon thread; resumes an unfinished run at once"""
+    stop_event = threading.Event()
+
+    def run_logged():
+        try:
+            broadcaster.run()
+        except Exception as e:
+            logger.error(f"Broadcast failed: {e}", exc_info=True)
+
+    def loop():
+        try:
+            unfinished = broadcaster.has_unfinished_run()
+        except Exception as e:
+            logger.error(f"Could not check for an unfinished broadcast: {e}", exc_info=True)
+            unfinished = 0
+        if unfinished:
+            run_logged()
+        while not stop_event.wait(interval_seconds):
+            run_logged()
+
+    threading.Thread(target=loop, name="broadcast-scheduler", daemon=True).start()
+    return stop_event
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Send re-engagement messages to idle users")
+    parser.add_argument("--once", action="store_true", help="Run (or resume) one broadcast and exit")
+    parser.add_argument("--dry-run", action="store_true", help="Print messages instead of sending them")
+    args = parser.parse_args(argv)
+
+    import simple_ruke_bot as ruke
+
+    if not ruke.init_model():
+        print("Error: could not initialize the Gemini model")
+        return
+    broadcaster = ruke.create_broadcaster(dry_run=args.dry_run)
+    if args.dry_run:
+        broadcaster.send_message = lambda chat_id, text: print(f"[{chat_id}] {text}")
+    if args.once:
+        print(broadcaster.run())
+    else:
+        start_scheduler(broadcaster, ruke.BROADCAST_INTERVAL_HOURS * 3600)
+        while True:
+            time.sleep(3600)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+"Ryuk is typing…" while a reply is being worked on, like the sendChatAction
+node of the n8n flow.
+
+Telegram shows a chat action for five seconds or until the bot sends a
+message, so an action has to be sent again every few seconds while a slow
+Gemini call or an image render is running. Work registers with
+ChatActions.working(chat_id, action):
+
+- the first job for a chat sends the action right away; further jobs for the
+  same chat join its keepalive instead of starting another one, and the
+  shown action is the most telling one (upload_photo over typing)
+- every CHAT_ACTION_REFRESH seconds the action is sent again, driven by one
+  timer wheel thread for all chats, with sends on a small thread pool
+- when the last job for a chat ends (right after its reply is sent) the chat
+  leaves the wheel and is not refreshed again
+"""
+
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Higher wins when several jobs run for one chat
+ACTION_PRIORITY = {"typing": 1, "choose_sticker": 1, "upload_document": 2, "upload_photo": 3, "upload_video": 3}
+
+
+class ChatActions:
+    """Coalesced, self-refreshing chat actions on a shared timer wheel"""
+
+    def __init__(self, send_action, refresh=4.0, tick=0.25, slots=64, senders=4):
+        # send_action(chat_id, action) calls sendChatAction
+        self.send_action = send_action
+        self.refresh = refresh
+        self.tick = tick
+        self._refresh_ticks = max(1, math.ceil(refresh / tick))
+        # chat_id -> {"jobs": {token: action}, "action": shown action, "due": tick of the next refresh}
+        self._chats = {}
+        # Slot i holds the chats due at some tick t with t % len(slots) == i
+        self._wheel = [set() for _ in range(slots)]
+        self._origin = time.monotonic()
+        self._processed_tick = 0
+        self._next_token = 0
+        self._stats = {"jobs": 0, "coalesced": 0, "sent": 0, "refreshes": 0, "errors": 0}
+        self._condition = threading.Condition()
+        self._senders = ThreadPoolExecutor(max_workers=senders, thread_name_prefix="chat-action")
+        # Started with the first job, so importing the bot starts no threads
+        self._thread = None
+
+    def _current_tick(self):
+        return int((time.monotonic() - self._origin) / self.tick)
+
+    def _schedule(self, chat_id, state, now_tick):
+        state["due"] = now_tick + self._refresh_ticks
+        self._wheel[state["due"] % len(self._wheel)].add(chat_id)
+
+    @staticmethod
+    def _top_action(state):
+        return max(state["jobs"].values(), key=lambda action: ACTION_PRIORITY.get(action, 0))
+
+    # --- jobs --------------------------------------------------------------
+
+    def start(self, chat_id, action="typing"):
+        """Register work for a chat; returns a token for stop()"""
+        with self._condition:
+            self._next_token += 1
+            token = (chat_id, self._next_token)
+            self._stats["jobs"] += 1
+            state = self._chats.get(chat_id)
+            if state is None:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="chat-action-wheel", daemon=True)
+                    self._thread.start()
+                state = self._chats[chat_id] = {"jobs": {}, "action": None, "due": None}
+                self._schedule(chat_id, state, self._current_tick())
+                self._condition.notify()
+            else:
+                self._stats["coalesced"] += 1
+            state["jobs"][token] = action
+            shown = self._top_action(state)
+            changed = shown != state["action"]
+            state["action"] = shown
+        if changed:
+            self._senders.submit(self._send, chat_id, shown)
+        return token
+
+    def stop(self, token):
+        """End a job; the chat stops being refreshed once its last job ends"""
+        chat_id = token[0]
+        with self._condition:
+            state = self._chats.get(chat_id)
+            if state is None or token not in state["jobs"]:
+                return
+            del state["jobs"][token]
+            if state["jobs"]:
+                state["action"] = self._top_action(state)
+            else:
+                # Its wheel entry is skipped when the slot comes round
+                del self._chats[chat_id]
+
+    @contextmanager
+    def working(self, chat_id, action="typing"):
+        """Show `action` in the chat for the duration of the block"""
+        token = self.start(chat_id, action)
+        try:
+            yield
+        finally:
+            self.stop(token)
+
+    # --- timer -------------------------------------------------------------
+
+    def _send(self, chat_id, action):
+        with self._condition:
+            # The reply may have gone out while this send was queued
+            if chat_id not in self._chats:
+                return
+        try:
+            self.send_action(chat_id, action)
+        except Exception as e:
+            with self._condition:
+                self._stats["errors"] += 1
+            logger.debug(f"Could not send chat action to {chat_id}: {e}")
+            return
+        with self._condition:
+            self._stats["sent"] += 1
+
+    def _run(self):
+        while True:
+            due = []
+            with self._condition:
+                if not self._chats:
+                    while not self._chats:
+                        self._condition.wait()
+                    # Nothing was due while idle; don't walk the wheel over the idle time
+                    self._processed_tick = max(self._processed_tick, self._current_tick() - 1)
+                now_tick = self._current_tick()
+                for tick in range(self._processed_tick + 1, now_tick + 1):
+                    slot = self._wheel[tick % len(self._wheel)]
+                    for chat_id in list(slot):
+                        state = self._chats.get(chat_id)
+                        if state is None or state["due"] != tick:
+                            if state is None or state["due"] < tick:
+                                # Finished chat, or an entry left behind by a later reschedule
+                                slot.discard(chat_id)
+                            continue
+                        slot.discard(chat_id)
+                        self._schedule(chat_id, state, tick)
+                        due.append((chat_id, state["action"]))
+                        self._stats["refreshes"] += 1
+                self._processed_tick = max(self._processed_tick, now_tick)
+                wait = self._origin + (now_tick + 1) * self.tick - time.monotonic()
+            for chat_id, action in due:
+                self._senders.submit(self._send, chat_id, action)
+            time.sleep(max(0.0, wait))
+
+    def stats(self):
+        with self._condition:
+            stats = dict(self._stats)
+            stats["active_chats"] = len(self._chats)
+            stats["active_jobs"] = sum(len(state["jobs"]) for state in self._chats.values())
+        return stats
@@ -0,0 +1,260 @@
+"""
+Pluggable storage for conversation history and small shared caches.
+
+The bot talks to the store through a handful of methods, so the same code
+runs with the in-process store (single process, the default) or with the
+SQLite store, which several worker processes on one host can share
+(see sharded_runner.py).
+
+Select the backend with CONVERSATION_STORE:
+    memory                  - in-process dictionaries (default)
+    sqlite:///path/to.db    - SQLite file shared between processes
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryConversationStore:
+    """In-process store; conversation history lives in nested dicts"""
+
+    name = "memory"
+
+    def __init__(self):
+        # Format: {chat_id: {user_id: [(timestamp, "message"), ...]}}
+        self.conversations = defaultdict(lambda: defaultdict(list))
+        self.values = defaultdict(dict)
+        self._lock = threading.Lock()
+
+    def recent_messages(self, chat_id, user_id, timeout, limit=5):
+        """Messages not older than `timeout` seconds, oldest first, at most `limit` of them"""
+        current_time = time.time()
+        recent = [message for timestamp, message in self.conversations[chat_id][user_id]
+                  if current_time - timestamp <= timeout]
+        return recent[-limit:] if recent else []
+
+    def append_message(self, chat_id, user_id, message, timeout, timestamp=None):
+        """Store a message and drop the ones that have expired"""
+        current_time = timestamp or time.time()
+        history = self.conversations[chat_id][user_id]
+        history.append((current_time, message))
+        self.conversations[chat_id][user_id] = [
+            (ts, msg) for ts, msg in history
+            if current_time - ts <= timeout
+        ]
+
+    def histories(self):
+        """(chat_id, user_id, messages) for every stored conversation, messages oldest first"""
+        for chat_id, users in list(self.conversations.items()):
+            for user_id, history in list(users.items()):
+                yield chat_id, user_id, [message for _, message in history]
+
+    def get_value(self, namespace, key, default=None):
+        return self.values[namespace].get(str(key), default)
+
+    def set_value(self, namespace, key, value):
+        with self._lock:
+            self.values[namespace][str(key)] = value
+
+    def delete_value(self, namespace, key):
+        with self._lock:
+            self.values[namespace].pop(str(key), None)
+
+    def export_state(self):
+        """Plain-data copy of everything in the store (for snapshots)"""
+        return {
+            "conversations": {chat_id: dict(users) for chat_id, users in self.conversations.items()},
+            "values": {namespace: dict(values) for namespace, values in self.values.items()},
+        }
+
+    def import_state(self, state):
+        for chat_id, users in state.get("conversations", {}).items():
+            for user_id, history in users.items():
+                self.conversations[chat_id][user_id] = list(history)
+        for namespace, values in state.get("values", {}).items():
+            self.values[namespace].update(values)
+
+    def clear_conversation(self, chat_id, user_id):
+        """Forget the history of one user in one chat"""
+        users = self.conversations.get(chat_id)
+        if users is not None:
+            users.pop(user_id, None)
+
+    def clear(self):
+        self.conversations.clear()
+        self.values.clear()
+
+    def stats(self):
+        users = sum(len(users) for users in self.conversations.values())
+        messages = 0
+        approx_bytes = 0
+        for chat_users in self.conversations.values():
+            for history in chat_users.values():
+                messages += len(history)
+                approx_bytes += sys.getsizeof(history) + sum(
+                    sys.getsizeof(item) + sys.getsizeof(item[1]) for item in history
+                )
+        return {
+            "backend": self.name,
+            "chats": len(self.conversations),
+            "users": users,
+            "messages": messages,
+            "values": sum(len(v) for v in self.values.values()),
+            "approx_bytes": approx_bytes,
+        }
+
+
+class SQLiteConversationStore:
+    """SQLite-backed store that can be shared by several processes on the same host"""
+
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        # Created by the first query, so importing the bot touches no files
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        if not self._schema_ready:
+            with self._schema_lock:
+                if not self._schema_ready:
+                    connection.executescript("""
+                        CREATE TABLE IF NOT EXISTS messages (
+                            chat_id INTEGER NOT NULL,
+                            user_id INTEGER NOT NULL,
+                            ts REAL NOT NULL,
+                            message TEXT NOT NULL
+                        );
+                        CREATE INDEX IF NOT EXISTS messages_by_user ON messages (chat_id, user_id, ts);
+                        CREATE TABLE IF NOT EXISTS kv (
+                            namespace TEXT NOT NULL,
+                            key TEXT NOT NULL,
+                            value TEXT NOT NULL,
+                            PRIMARY KEY (namespace, key)
+                        );
+                    """)
+                    connection.commit()
+                    self._schema_ready = True
+        return connection
+
+    def recent_messages(self, chat_id, user_id, timeout, limit=5):
+        rows = self._connection().execute(
+            "SELECT message FROM messages WHERE chat_id = ? AND user_id = ? AND ts >= ? "
+            "ORDER BY ts DESC, rowid DESC LIMIT ?",
+            (chat_id, user_id, time.time() - timeout, limit),
+        ).fetchall()
+        return [row[0] for row in reversed(rows)]
+
+    def append_message(self, chat_id, user_id, message, timeout, timestamp=None):
+        current_time = timestamp or time.time()
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "INSERT INTO messages (chat_id, user_id, ts, message) VALUES (?, ?, ?, ?)",
+                (chat_id, user_id, current_time, message),
+            )
+            connection.execute(
+                "DELETE FROM messages WHERE chat_id = ? AND user_id = ? AND ts < ?",
+                (chat_id, user_id, current_time - timeout),
+            )
+
+    def histories(self):
+        """(chat_id, user_id, messages) for every stored conversation, messages oldest first"""
+        rows = self._connection().execute(
+            "SELECT chat_id, user_id, message FROM messages ORDER BY chat_id, user_id, ts, rowid"
+        )
+        current, messages = None, []
+        for chat_id, user_id, message in rows:
+            if (chat_id, user_id) != current:
+                if current is not None:
+                    yield current[0], current[1], messages
+                current, messages = (chat_id, user_id), []
+            messages.append(message)
+        if current is not None:
+            yield current[0], current[1], messages
+
+    def get_value(self, namespace, key, default=None):
+        row = self._connection().execute(
+            "SELECT value FROM kv WHERE namespace = ? AND key = ?", (namespace, str(key))
+        ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_value(self, namespace, key, value):
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO kv (namespace, key, value) VALUES (?, ?, ?)",
+                (namespace, str(key), json.dumps(value, ensure_ascii=False)),
+            )
+
+    def delete_value(self, namespace, key):
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, str(key)))
+
+    def export_state(self):
+        # The database file already is the durable copy
+        return {}
+
+    def import_state(self, state):
+        pass
+
+    def clear_conversation(self, chat_id, user_id):
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM messages WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
+
+    def clear(self):
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM messages")
+            connection.execute("DELETE FROM kv")
+
+    def stats(self):
+        connection = self._connection()
+        users, messages = connection.execute(
+            "SELECT COUNT(DISTINCT chat_id || ':' || user_id), COUNT(*) FROM messages"
+        ).fetchone()
+        values = connection.execute("SELECT COUNT(*) FROM kv").fetchone()[0]
+        approx_bytes = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        return {
+            "backend": self.name,
+            "path": self.path,
+            "users": users,
+            "messages": messages,
+            "values": values,
+            "approx_bytes": approx_bytes,
+        }
+
+
+def create_store(spec=None):
+    """Create a store from a CONVERSATION_STORE value ("memory" or "sqlite:///path")"""
+    spec = (spec or "memory").strip()
+    if spec == "memory":
+        return MemoryConversationStore()
+    if spec.startswith("sqlite:"):
+        path = spec[len("sqlite:"):]
+        if path.startswith("///"):
+            path = path[3:]
+        elif path.startswith("//"):
+            path = path[2:]
+        path = path or "ruke_state.db"
+        logger.info(f"Using SQLite conversation store at {path}")
+        return SQLiteConversationStore(path)
+    raise ValueError(f"Unknown CONVERSATION_STORE value: {spec}")
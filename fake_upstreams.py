@@ -0,0 +1,413 @@
+"""
+Local stand-ins for the services the bot talks to: the Telegram Bot API,
+Gemini generate_content (REST transport) and Hugging Face text_to_image.
+
+Each server runs in a background thread on 127.0.0.1, answers with the same
+JSON shapes as the real service, and can be told to be slow or to fail with
+a given probability. Used by load_test.py and replay_updates.py so that the
+bot can be exercised fully offline.
+"""
+
+import io
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from collections import Counter, deque
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class LatencyProfile:
+    """Latency and error distribution for a fake upstream.
+
+    Latency is drawn from a lognormal distribution around `median` seconds
+    (`sigma` = 0 gives a fixed delay). With probability `error_rate` the call
+    fails with one of `error_codes` instead of answering.
+    """
+
+    def __init__(self, median=0.0, sigma=0.0, error_rate=0.0, error_codes=(500,), seed=None):
+        self.median = median
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.error_codes = tuple(error_codes)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def parse(cls, spec, seed=None):
+        """Build a profile from "median[,sigma[,error_rate[,code|code...]]]", e.g. "0.8,0.4,0.02,500|429"."""
+        parts = [p.strip() for p in (spec or "").split(",")]
+        median = float(parts[0]) if parts and parts[0] else 0.0
+        sigma = float(parts[1]) if len(parts) > 1 and parts[1] else 0.0
+        error_rate = float(parts[2]) if len(parts) > 2 and parts[2] else 0.0
+        codes = tuple(int(c) for c in parts[3].split("|")) if len(parts) > 3 and parts[3] else (500,)
+        return cls(median, sigma, error_rate, codes, seed=seed)
+
+    def sample(self):
+        """Return (delay_seconds, error_code_or_None) for one call"""
+        with self._lock:
+            delay = self.median
+            if self.median > 0 and self.sigma > 0:
+                delay = self._random.lognormvariate(0.0, self.sigma) * self.median
+            error = None
+            if self.error_rate and self._random.random() < self.error_rate:
+                error = self._random.choice(self.error_codes)
+        return delay, error
+
+    def describe(self):
+        return f"median={self.median}s sigma={self.sigma} errors={self.error_rate:.1%} {list(self.error_codes)}"
+
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+    """Doesn't print tracebacks for clients that hang up, e.g. the bot exiting mid-poll"""
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+
+class _FakeServer:
+    """Threaded HTTP server with per-call latency injection and call accounting"""
+
+    name = "fake"
+
+    def __init__(self, profile=None, port=0):
+        self.profile = profile or LatencyProfile()
+        self.calls = Counter()
+        self.errors = Counter()
+        self._stats_lock = threading.Lock()
+        owner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                owner._dispatch(self, "GET")
+
+            def do_POST(self):
+                owner._dispatch(self, "POST")
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = _QuietHTTPServer(("127.0.0.1", port), Handler)
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name=f"{self.name}-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self.httpd.shutdown()
+            self._thread = None
+        self.httpd.server_close()
+
+    def stats(self):
+        with self._stats_lock:
+            return {"calls": dict(self.calls), "errors": dict(self.errors)}
+
+    def _count(self, method, error=None):
+        with self._stats_lock:
+            self.calls[method] += 1
+            if error:
+                self.errors[f"{method}:{error}"] += 1
+
+    def _dispatch(self, request, verb):
+        parsed = urllib.parse.urlsplit(request.path)
+        length = int(request.headers.get("Content-Length") or 0)
+        body = request.rfile.read(length) if length else b""
+        try:
+            status, content_type, payload = self.handle(verb, parsed.path, parsed.query, request.headers, body)
+        except Exception as e:
+            status, content_type, payload = 500, "application/json", json.dumps({"error": str(e)}).encode()
+        request.send_response(status)
+        request.send_header("Content-Type", content_type)
+        request.send_header("Content-Length", str(len(payload)))
+        request.end_headers()
+        request.wfile.write(payload)
+
+    def _upstream_delay(self, method):
+        """Apply the latency profile; returns an error status code or None"""
+        delay, error = self.profile.sample()
+        if delay > 0:
+            time.sleep(delay)
+        self._count(method, error)
+        return error
+
+    def handle(self, verb, path, query, headers, body):
+        raise NotImplementedError
+
+
+class FakeGeminiServer(_FakeServer):
+    """Answers generateContent and models.list like the Gemini REST API"""
+
+    name = "gemini"
+
+    def __init__(self, profile=None, port=0, reply_text=None, models=("gemini-pro", "gemini-1.5-flash")):
+        super().__init__(profile, port)
+        self.reply_text = reply_text or "Ку-ку-ку! Люди такие забавные. Расскажи мне ещё что-нибудь."
+        self.models = models
+        self.prompt_chars = 0
+
+    def handle(self, verb, path, query, headers, body):
+        if verb == "GET" and "/models" in path:
+            self._count("listModels")
+            models = [
+                {"name": f"models/{m}", "supportedGenerationMethods": ["generateContent"]}
+                for m in self.models
+            ]
+            return 200, "application/json", json.dumps({"models": models}).encode()
+
+        if verb == "POST" and path.endswith(":generateContent"):
+            error = self._upstream_delay("generateContent")
+            if error:
+                payload = {"error": {"code": error, "message": "fake upstream failure", "status": "INTERNAL"}}
+                return error, "application/json", json.dumps(payload).encode()
+            request = json.loads(body or b"{}")
+            prompt = json.dumps(request, ensure_ascii=False)
+            with self._stats_lock:
+                self.prompt_chars += len(prompt)
+            payload = {
+                "candidates": [{
+                    "content": {"parts": [{"text": self.reply_text}], "role": "model"},
+                    "finishReason": "STOP",
+                    "index": 0,
+                }],
+                "usageMetadata": {
+                    "promptTokenCount": len(prompt) // 4,
+                    "candidatesTokenCount": len(self.reply_text) // 4,
+                },
+            }
+            return 200, "application/json", json.dumps(payload, ensure_ascii=False).encode()
+
+        return 404, "application/json", b'{"error": {"code": 404, "message": "not found"}}'
+
+    def stats(self):
+        result = super().stats()
+        result["prompt_chars"] = self.prompt_chars
+        return result
+
+
+class FakeHuggingFaceServer(_FakeServer):
+    """Answers text_to_image calls made against an Inference Endpoint URL"""
+
+    name = "huggingface"
+
+    def __init__(self, profile=None, port=0, size=(64, 64)):
+        super().__init__(profile, port)
+        from PIL import Image
+
+        buffer = io.BytesIO()
+        Image.new("RGB", size, (20, 20, 30)).save(buffer, format="PNG")
+        self.image_bytes = buffer.getvalue()
+
+    @property
+    def model_url(self):
+        return f"{self.base_url}/models/stable-diffusion"
+
+    def handle(self, verb, path, query, headers, body):
+        error = self._upstream_delay("textToImage")
+        if error:
+            return error, "application/json", json.dumps({"error": "fake upstream failure"}).encode()
+        return 200, "image/png", self.image_bytes
+
+
+class FakeTelegramServer(_FakeServer):
+    """Minimal Telegram Bot API: getUpdates long polling plus the send methods the bot uses.
+
+    Updates are pushed with `push_update()`; every outgoing bot call is recorded
+    with its arrival time in `outbox` so callers can match replies to updates.
+    """
+
+    name = "telegram"
+
+    def __init__(self, profile=None, port=0, bot_id=7000000001, bot_username="my_Ruke_bot"):
+        super().__init__(profile, port)
+        self.bot_id = bot_id
+        self.bot_username = bot_username
+        self.outbox = []
+        self.listeners = []
+        self._pending = deque()
+        self._pending_cond = threading.Condition()
+        self._next_update_id = 1
+        self._next_message_id = 1_000_000
+        self._delivered = {}
+
+    @property
+    def api_url(self):
+        """Value for telebot.apihelper.API_URL"""
+        return self.base_url + "/bot{0}/{1}"
+
+    def push_update(self, update):
+        """Queue an update dict; assigns update_id if missing and returns it"""
+        with self._pending_cond:
+            if "update_id" not in update:
+                update["update_id"] = self._next_update_id
+            self._next_update_id = max(self._next_update_id, update["update_id"]) + 1
+            update.setdefault("_pushed_at", time.perf_counter())
+            self._pending.append(update)
+            self._pending_cond.notify_all()
+            return update["update_id"]
+
+    def pending_count(self):
+        with self._pending_cond:
+            return len(self._pending)
+
+    def delivered_at(self, update_id):
+        return self._delivered.get(update_id)
+
+    def _params(self, query, headers, body):
+        params = {k: v[-1] for k, v in urllib.parse.parse_qs(query).items()}
+        content_type = headers.get("Content-Type", "")
+        if body and content_type.startswith("multipart/form-data"):
+            message = BytesParser(policy=HTTP).parsebytes(
+                b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body
+            )
+            for part in message.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                if part.get_filename():
+                    params[name] = {"filename": part.get_filename(), "size": len(part.get_payload(decode=True) or b"")}
+                else:
+                    params[name] = part.get_content()
+        elif body and content_type.startswith("application/x-www-form-urlencoded"):
+            params.update({k: v[-1] for k, v in urllib.parse.parse_qs(body.decode()).items()})
+        elif body and content_type.startswith("application/json"):
+            params.update(json.loads(body))
+        return params
+
+    def _message(self, chat_id, **fields):
+        with self._stats_lock:
+            self._next_message_id += 1
+            message_id = self._next_message_id
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private" if int(chat_id) > 0 else "supergroup"},
+            "from": {"id": self.bot_id, "is_bot": True, "first_name": "Ryuk", "username": self.bot_username},
+        }
+        message.update(fields)
+        return message
+
+    def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        limit = int(params.get("limit") or 100)
+        deadline = time.monotonic() + timeout
+        with self._pending_cond:
+            while self._pending and self._pending[0]["update_id"] < offset:
+                self._pending.popleft()
+            while not self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self._pending_cond.wait(remaining)
+                while self._pending and self._pending[0]["update_id"] < offset:
+                    self._pending.popleft()
+            batch = list(self._pending)[:limit]
+        now = time.perf_counter()
+        result = []
+        for update in batch:
+            self._delivered.setdefault(update["update_id"], now)
+            result.append({k: v for k, v in update.items() if not k.startswith("_")})
+        return result
+
+    def handle(self, verb, path, query, headers, body):
+        method = path.rsplit("/", 1)[-1]
+        params = self._params(query, headers, body)
+
+        if method == "getUpdates":
+            self._count(method)
+            return self._ok(self._get_updates(params))
+        if method == "getMe":
+            self._count(method)
+            return self._ok({"id": self.bot_id, "is_bot": True, "first_name": "Ryuk", "username": self.bot_username})
+
+        error = self._upstream_delay(method)
+        if error:
+            payload = {"ok": False, "error_code": error, "description": "fake upstream failure"}
+            return error, "application/json", json.dumps(payload).encode()
+
+        chat_id = params.get("chat_id")
+        if method == "sendMessage":
+            result = self._message(chat_id, text=params.get("text", ""))
+        elif method == "sendPhoto":
+            file_id = f"photo-{self._next_message_id}"
+            result = self._message(chat_id, photo=[
+                {"file_id": file_id, "file_unique_id": file_id, "width": 64, "height": 64}
+            ], caption=params.get("caption"))
+        elif method == "sendDocument":
+            file_id = f"document-{self._next_message_id}"
+            result = self._message(chat_id, document={"file_id": file_id, "file_unique_id": file_id})
+        elif method == "sendMediaGroup":
+            media = json.loads(params.get("media") or "[]")
+            result = []
+            for item in media:
+                file_id = f"photo-{self._next_message_id}"
+                result.append(self._message(chat_id, photo=[
+                    {"file_id": file_id, "file_unique_id": file_id, "width": 64, "height": 64}
+                ], caption=item.get("caption")))
+        elif method == "editMessageText":
+            result = self._message(chat_id, text=params.get("text", ""))
+        else:
+            # deleteMessage, setMyCommands, sendChatAction, answerInlineQuery, ...
+            result = True
+
+        record = {
+            "method": method,
+            "at": time.perf_counter(),
+            "chat_id": int(chat_id) if chat_id not in (None, "") else None,
+            "reply_to_message_id": int(params["reply_to_message_id"]) if params.get("reply_to_message_id") else None,
+            "params": params,
+        }
+        with self._stats_lock:
+            self.outbox.append(record)
+        for listener in self.listeners:
+            listener(record)
+        return self._ok(result)
+
+    @staticmethod
+    def _ok(result):
+        return 200, "application/json", json.dumps({"ok": True, "result": result}, ensure_ascii=False).encode()
+
+
+def start_fake_upstreams(telegram_profile=None, gemini_profile=None, hf_profile=None):
+    """Start all three stand-ins and return them as (telegram, gemini, huggingface)"""
+    telegram = FakeTelegramServer(telegram_profile).start()
+    gemini = FakeGeminiServer(gemini_profile).start()
+    huggingface = FakeHuggingFaceServer(hf_profile).start()
+    return telegram, gemini, huggingface
+
+
+def stop_fake_upstreams(*servers):
+    """Stop stand-ins started by start_fake_upstreams"""
+    for server in servers:
+        server.stop()
+
+
+def point_bot_environment(telegram, gemini, huggingface, environ):
+    """Fill `environ` so that simple_ruke_bot talks to the given stand-ins when imported"""
+    environ["TELEGRAM_TOKEN"] = "123456:OFFLINE-TEST-TOKEN"
+    environ["TELEGRAM_API_URL"] = telegram.api_url
+    environ["GOOGLE_API_KEY"] = "offline-test-key"
+    environ["GEMINI_API_ENDPOINT"] = gemini.base_url
+    environ["DEFAULT_LLM_MODEL"] = "gemini-pro"
+    environ["HUGGINGFACE_API_KEY"] = "hf_offline_test_token"
+    environ["SD_MODEL"] = huggingface.model_url
+    return environ
@@ -0,0 +1,283 @@
+"""
+Chat-session layer for Gemini.
+
+Instead of pasting RUKE_SYSTEM_PROMPT and the history into one flat prompt on
+every turn, the bot keeps a bounded LRU pool of per-conversation
+ChatSession objects:
+
+- the persona is passed as the model's system instruction when the installed
+  google-generativeai supports it (0.5+); older versions get it once as the
+  opening exchange of each session's history instead of in every prompt
+- sessions keep only the last MAX_SESSION_TURNS exchanges, which bounds the
+  input tokens per turn; an evicted or expired session is rebuilt from the
+  conversation store, so retries and other worker processes keep the context
+- a persona of at least MIN_CACHED_TOKENS tokens (counted with
+  count_tokens) is cached on the provider side once per model, reused across
+  resets and deleted when the model changes. RUKE_SYSTEM_PROMPT is a few
+  thousand characters, far below that minimum, so today it is always sent as
+  a plain system instruction and caching saves nothing
+"""
+
+import inspect
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import google.generativeai as genai
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+try:
+    from google.generativeai import caching
+    CONTEXT_CACHING_AVAILABLE = True
+except ImportError:
+    caching = None
+    CONTEXT_CACHING_AVAILABLE = False
+
+SYSTEM_INSTRUCTION_SUPPORTED = "system_instruction" in inspect.signature(genai.GenerativeModel.__init__).parameters
+
+HUMAN_PREFIX = "Человек: "
+RYUK_PREFIX = "Рюк: "
+PERSONA_ACK = "Понял. Ку-ку-ку!"
+# The API refuses to cache less than this many tokens
+MIN_CACHED_TOKENS = 32768
+
+
+def history_to_contents(history):
+    """Convert stored "Человек: ..." / "Рюк: ..." lines into chat contents"""
+    contents = []
+    for line in history:
+        if line.startswith(RYUK_PREFIX):
+            role, text = "model", line[len(RYUK_PREFIX):]
+        elif line.startswith(HUMAN_PREFIX):
+            role, text = "user", line[len(HUMAN_PREFIX):]
+        else:
+            role, text = "user", line
+        if contents and contents[-1]["role"] == role:
+            # Gemini expects user/model turns to alternate
+            contents[-1]["parts"][0] += "\n" + text
+        else:
+            contents.append({"role": role, "parts": [text]})
+    # A chat history has to end with a model turn before the next user message
+    if contents and contents[-1]["role"] == "user":
+        contents.append({"role": "model", "parts": ["..."]})
+    return contents
+
+
+class _PooledSession:
+    __slots__ = ("chat", "last_used", "lock")
+
+    def __init__(self, chat):
+        self.chat = chat
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+
+
+class ChatSessionPool:
+    """Bounded LRU pool of Gemini chat sessions keyed by (chat_id, user_id)"""
+
+    def __init__(self, persona, max_sessions=1000, max_turns=5, idle_timeout=600,
+                 use_context_cache=True, cache_ttl=3600):
+        self.persona = persona
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self.idle_timeout = idle_timeout
+        self.use_context_cache = use_context_cache
+        self.cache_ttl = cache_ttl
+        self.model_name = None
+        # Replaceable for benchmarks: (model_name, persona) -> object with start_chat()
+        self.model_factory = self._create_model
+        self._model = None
+        self._persona_in_history = False
+        # (model_name, CachedContent, renew_at) of the persona cache in use, and models the API refused
+        self._cached_persona = None
+        self._cache_refused = set()
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            "turns": 0,
+            "sessions_created": 0,
+            "sessions_reused": 0,
+            "evictions": 0,
+            "errors": 0,
+            "prompt_tokens": 0,
+            "prompt_chars": 0,
+            "latency_seconds": 0.0,
+        }
+
+    def _create_model(self, model_name, persona):
+        if not SYSTEM_INSTRUCTION_SUPPORTED:
+            logger.info("google-generativeai has no system_instruction support; persona goes into session history")
+            self._persona_in_history = True
+            return genai.GenerativeModel(model_name)
+
+        if self.use_context_cache and CONTEXT_CACHING_AVAILABLE:
+            cached = self._cached_persona_for(model_name, persona)
+            if cached is not None:
+                return genai.GenerativeModel.from_cached_content(cached)
+
+        return genai.GenerativeModel(model_name, system_instruction=persona)
+
+    def _cached_persona_for(self, model_name, persona):
+        """CachedContent holding the persona for `model_name`, created once and reused; None when not cacheable"""
+        current = self._cached_persona
+        if current is not None and current[0] == model_name and time.time() < current[2]:
+            return current[1]
+        self._delete_cached_persona()
+        if model_name in self._cache_refused:
+            return None
+        tokens = self._count_tokens(model_name, persona)
+        if tokens is None or tokens < MIN_CACHED_TOKENS:
+            logger.info(f"Persona is below the {MIN_CACHED_TOKENS} tokens needed for context caching "
+                        f"(or could not be counted); using the plain system instruction")
+            self._cache_refused.add(model_name)
+            return None
+        try:
+            import datetime
+            cached = caching.CachedContent.create(
+                model=model_name,
+                system_instruction=persona,
+                ttl=datetime.timedelta(seconds=self.cache_ttl),
+            )
+        except Exception as e:
+            logger.info(f"Context caching not used for the persona with {model_name}: {e}")
+            self._cache_refused.add(model_name)
+            return None
+        logger.info(f"Persona cached on the provider side as {cached.name}")
+        # Renewed a minute before it expires, on the next reset
+        self._cached_persona = (model_name, cached, time.time() + self.cache_ttl - 60)
+        return cached
+
+    @staticmethod
+    def _count_tokens(model_name, persona):
+        """Token count of the persona for `model_name` (an upper bound for short ones), or None"""
+        # Every token covers at least one character, so a shorter text needs no API call
+        if len(persona) < MIN_CACHED_TOKENS:
+            return len(persona)
+        try:
+            return genai.GenerativeModel(model_name).count_tokens(persona).total_tokens
+        except Exception as e:
+            logger.info(f"Could not count the persona's tokens with {model_name}: {e}")
+            return None
+
+    def _delete_cached_persona(self):
+        if self._cached_persona is None:
+            return
+        cached = self._cached_persona[1]
+        self._cached_persona = None
+        try:
+            cached.delete()
+        except Exception as e:
+            logger.warning(f"Could not delete the persona cache {cached.name}: {e}")
+
+    def close(self):
+        """Delete the provider-side persona cache, so it is not billed until its TTL runs out"""
+        with self._lock:
+            self._delete_cached_persona()
+
+    def reset(self, model_name):
+        """Switch to `model_name` and drop all sessions (called after init_model)"""
+        with self._lock:
+            self._persona_in_history = False
+            self.model_name = model_name
+            self._model = self.model_factory(model_name, self.persona)
+            self._sessions.clear()
+
+    def _seed_contents(self, history):
+        contents = history_to_contents(history[-self.max_turns * 2:])
+        if self._persona_in_history:
+            contents = [
+                {"role": "user", "parts": [self.persona]},
+                {"role": "model", "parts": [PERSONA_ACK]},
+            ] + contents
+        return contents
+
+    def _acquire(self, key, history):
+        """Return (session, reused) for `key`, creating it from `history` when needed"""
+        now = time.time()
+        with self._lock:
+            if self._model is None:
+                raise RuntimeError("Chat session pool used before a model was initialized")
+            session = self._sessions.get(key) if key is not None else None
+            if session is not None and now - session.last_used <= self.idle_timeout:
+                self._sessions.move_to_end(key)
+                self._stats["sessions_reused"] += 1
+                session.last_used = now
+                return session, True
+
+            session = _PooledSession(self._model.start_chat(history=self._seed_contents(history)))
+            self._stats["sessions_created"] += 1
+            if key is not None:
+                self._sessions[key] = session
+                self._sessions.move_to_end(key)
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+                    self._stats["evictions"] += 1
+            return session, False
+
+    def _trim(self, chat):
+        """Keep the persona exchange (if any) plus the last max_turns exchanges"""
+        history = chat.history
+        keep_head = 2 if self._persona_in_history else 0
+        limit = keep_head + self.max_turns * 2
+        if len(history) > limit:
+            chat.history = history[:keep_head] + history[-self.max_turns * 2:]
+
+    def send(self, chat_id, user_id, user_input, history=()):
+        """Send one user message in the conversation's session and return the reply text.
+
+        `history` is the stored conversation (used only when a session has to be created).
+        Without chat_id/user_id a one-off session is used.
+        """
+        key = (chat_id, user_id) if chat_id and user_id else None
+        with tracing.span("prompt.build") as build:
+            session, reused = self._acquire(key, list(history))
+            build.set("session.reused", reused)
+        with session.lock, tracing.span("gemini.send_message", tracing.KIND_CLIENT, model=self.model_name) as call:
+            sent_chars = len(user_input) + sum(
+                len(getattr(part, "text", "")) for content in session.chat.history
+                for part in getattr(content, "parts", [])
+            )
+            start = time.time()
+            try:
+                response = session.chat.send_message(user_input)
+                text = response.text.strip()
+            except Exception:
+                self.discard(chat_id, user_id)
+                with self._lock:
+                    self._stats["errors"] += 1
+                raise
+            elapsed = time.time() - start
+            self._trim(session.chat)
+
+            usage = getattr(response, "usage_metadata", None)
+            prompt_tokens = getattr(usage, "prompt_token_count", 0) if usage else 0
+            call.set("prompt_tokens", prompt_tokens or 0)
+        with self._lock:
+            self._stats["turns"] += 1
+            self._stats["latency_seconds"] += elapsed
+            self._stats["prompt_tokens"] += prompt_tokens or 0
+            self._stats["prompt_chars"] += sent_chars
+        return text
+
+    def discard(self, chat_id, user_id):
+        """Forget a conversation's session (e.g. after an error); it is rebuilt from history next time"""
+        with self._lock:
+            self._sessions.pop((chat_id, user_id), None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["sessions"] = len(self._sessions)
+        lookups = stats["sessions_created"] + stats["sessions_reused"]
+        stats["hit_ratio"] = stats["sessions_reused"] / lookups if lookups else 0.0
+        stats["avg_latency_seconds"] = stats["latency_seconds"] / stats["turns"] if stats["turns"] else 0.0
+        stats["avg_prompt_tokens"] = stats["prompt_tokens"] / stats["turns"] if stats["turns"] else 0.0
+        stats["avg_prompt_chars"] = stats["prompt_chars"] / stats["turns"] if stats["turns"] else 0.0
+        stats["model"] = self.model_name
+        stats["system_instruction"] = SYSTEM_INSTRUCTION_SUPPORTED
+        stats["context_caching"] = CONTEXT_CACHING_AVAILABLE and self.use_context_cache
+        return stats
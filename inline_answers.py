@@ -0,0 +1,295 @@
+"""
+Inline mode: answers to "@my_Ruke_bot ..." typed in any chat.
+
+Telegram sends a new inline query for nearly every keystroke, so answers
+are served from cheap sources wherever possible:
+
+- a bounded LRU cache of finished answer sets, keyed by the normalized
+  query (shared by all users, kept across restarts in the lifecycle
+  snapshot), answered with Telegram's cache_time so repeated queries do not
+  even reach the bot
+- precomputed results: Ryuk quotes and matching past replies from the
+  reply index
+- images the querying user generated earlier with /draw (by their Telegram
+  file_id); they are added per user, never cached or shown to anyone else,
+  and answers carrying them are marked personal for Telegram's cache
+
+Only a cache miss for a query of a useful length asks Gemini. That call is
+debounced per user: it starts once the user has stopped typing for
+INLINE_DEBOUNCE seconds, and queries superseded by a newer one are never
+generated. Generations run on a small thread pool, and identical queries
+from several users share one generation. Only real model output is
+cached: when Gemini is down or busy the query gets the precomputed results,
+uncached, and is generated again next time.
+"""
+
+import hashlib
+import heapq
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot import types
+
+logger = logging.getLogger(__name__)
+
+RYUK_QUOTES = [
+    "Люди такие интересные! Ку-ку-ку...",
+    "Яблоки в мире людей такие сочные!",
+    "Я не на твоей стороне и не на стороне L. Мне просто скучно.",
+    "Все люди рано или поздно умирают. Хе-хе-хе.",
+    "Тетрадь смерти упала в мир людей не случайно. Мне было скучно.",
+    "Не жди от шинигами помощи. Я здесь только чтобы развлечься.",
+    "Hallo! Скучаешь? Я тоже. Давай сыграем во что-нибудь.",
+    "Человек, который использовал тетрадь, не попадёт ни в рай, ни в ад. Ку-ку-ку.",
+]
+QUOTE_TITLE = "Цитата Рюка"
+
+
+def normalize_query(text):
+    """Lowercased query with collapsed whitespace and no trailing punctuation"""
+    return re.sub(r"\s+", " ", text.lower()).strip(" .,!?…")
+
+
+def result_id(*parts):
+    return hashlib.blake2b("\x1f".join(parts).encode(), digest_size=16).hexdigest()
+
+
+def to_inline_results(results):
+    """Convert plain result dicts (snapshot-friendly) to telebot inline result objects"""
+    converted = []
+    for result in results:
+        if result["type"] == "photo":
+            converted.append(types.InlineQueryResultCachedPhoto(
+                id=result_id("photo", result["file_id"]),
+                photo_file_id=result["file_id"],
+                title=result.get("title"),
+                caption=result.get("title"),
+            ))
+        else:
+            converted.append(types.InlineQueryResultArticle(
+                id=result_id("article", result["text"]),
+                title=result.get("title") or "Рюк",
+                description=result["text"][:100],
+                input_message_content=types.InputTextMessageContent(result["text"]),
+            ))
+    return converted
+
+
+class Debouncer:
+    """Runs the latest callback scheduled for a key once no newer one arrived for `delay` seconds.
+
+    One timer thread serves all keys, so a burst of keystrokes costs no threads;
+    the callbacks themselves run on `executor`.
+    """
+
+    def __init__(self, delay, executor):
+        self.delay = delay
+        self.executor = executor
+        self._latest = {}
+        self._heap = []
+        self._sequence = 0
+        self._condition = threading.Condition()
+        # Started with the first query
+        self._thread = None
+
+    def schedule(self, key, callback):
+        """Schedule `callback`, replacing a pending one for the same key; returns True if one was replaced"""
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="inline-debounce", daemon=True)
+                self._thread.start()
+            self._sequence += 1
+            replaced = key in self._latest
+            self._latest[key] = (self._sequence, callback)
+            heapq.heappush(self._heap, (time.monotonic() + self.delay, self._sequence, key))
+            self._condition.notify()
+            return replaced
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._condition.wait(timeout)
+                _, sequence, key = heapq.heappop(self._heap)
+                latest = self._latest.get(key)
+                if latest is None or latest[0] != sequence:
+                    # Superseded by a newer query from the same user
+                    continue
+                del self._latest[key]
+                callback = latest[1]
+            self.executor.submit(self._call, callback)
+
+    @staticmethod
+    def _call(callback):
+        try:
+            callback()
+        except Exception as e:
+            logger.error(f"Debounced inline callback failed: {e}", exc_info=True)
+
+
+class InlineAnswers:
+    """Builds, caches and debounces answers to inline queries"""
+
+    def __init__(self, generate, answer, search_replies=None, recent_images=None, max_entries=5000,
+                 ttl=3600, debounce=0.7, min_query_length=3, max_results=10, cache_time=300, workers=4):
+        # generate(text) -> model reply, or None when the model could not answer;
+        # answer(query_id, results, cache_time, is_personal) sends the answer;
+        # recent_images(user_id) -> images that user generated, newest first
+        self.generate = generate
+        self.answer = answer
+        self.search_replies = search_replies
+        self.recent_images = recent_images
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.min_query_length = min_query_length
+        self.max_results = max_results
+        self.cache_time = cache_time
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="inline")
+        self.debouncer = Debouncer(debounce, self.executor)
+        self._cache = OrderedDict()
+        self._waiting = {}
+        self._lock = threading.Lock()
+        self._stats = {"queries": 0, "cache_hits": 0, "instant": 0, "generated": 0, "joined": 0,
+                       "superseded": 0}
+
+    # --- cache -------------------------------------------------------------
+
+    def _cached(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            stored_at, results = entry
+            if time.time() - stored_at > self.ttl:
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return results
+
+    def _store(self, key, results):
+        with self._lock:
+            self._cache[key] = (time.time(), results)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def export_state(self):
+        with self._lock:
+            return list(self._cache.items())
+
+    def import_state(self, state):
+        now = time.time()
+        for key, (stored_at, results) in state:
+            if now - stored_at <= self.ttl:
+                # Older snapshots cached users' images in the shared answers
+                self._store(key, [result for result in results if result["type"] != "photo"])
+
+    # --- answering ---------------------------------------------------------
+
+    def instant_results(self, key):
+        """Shared results that cost no LLM call: matching past replies and quotes"""
+        results = []
+        if key and self.search_replies:
+            match = self.search_replies(key)
+            if match:
+                results.append({"type": "article", "title": "Рюк отвечает", "text": match})
+        quotes = [quote for quote in RYUK_QUOTES if key and key in quote.lower()] or RYUK_QUOTES
+        for quote in quotes:
+            results.append({"type": "article", "title": QUOTE_TITLE, "text": quote})
+        return results[:self.max_results]
+
+    def personal_images(self, key, user_id):
+        """Up to three images `user_id` drew, those whose prompt shares a word with the query first"""
+        if not self.recent_images:
+            return []
+        words = set(key.split())
+        images = sorted(self.recent_images(user_id),
+                        key=lambda image: not words & set(image["prompt"].lower().split()))
+        return [{"type": "photo", "file_id": image["file_id"], "title": image["prompt"]} for image in images[:3]]
+
+    def _send(self, query_id, user_id, key, results, cache_time):
+        """Answer with the shared `results` plus the user's own images, placed before the quotes"""
+        images = self.personal_images(key, user_id)
+        if images:
+            answers = [result for result in results if result.get("title") != QUOTE_TITLE]
+            quotes = [result for result in results if result.get("title") == QUOTE_TITLE]
+            results = (answers + images + quotes)[:self.max_results]
+        try:
+            self.answer(query_id, results, cache_time, bool(images))
+        except Exception as e:
+            # Usually "query is too old": the user kept typing or left
+            logger.info(f"Could not answer inline query {query_id}: {e}")
+
+    def handle(self, query_id, user_id, text):
+        """Answer an inline query now from cache, or schedule a debounced generation"""
+        key = normalize_query(text)
+        with self._lock:
+            self._stats["queries"] += 1
+
+        results = self._cached(key)
+        if results is not None:
+            with self._lock:
+                self._stats["cache_hits"] += 1
+            self._send(query_id, user_id, key, results, self.cache_time)
+            return
+
+        if len(key) < self.min_query_length:
+            results = self.instant_results(key)
+            with self._lock:
+                self._stats["instant"] += 1
+            self._send(query_id, user_id, key, results, self.cache_time)
+            return
+
+        if self.debouncer.schedule(user_id, lambda: self._generate(key, query_id, user_id)):
+            with self._lock:
+                self._stats["superseded"] += 1
+
+    def _generate(self, key, query_id, user_id):
+        """Generate the answer set for `key` once, answering every query waiting for it"""
+        results = self._cached(key)
+        if results is not None:
+            self._send(query_id, user_id, key, results, self.cache_time)
+            return
+        with self._lock:
+            if key in self._waiting:
+                # Someone else is already generating this query
+                self._waiting[key].append((query_id, user_id))
+                self._stats["joined"] += 1
+                return
+            self._waiting[key] = [(query_id, user_id)]
+
+        results = None
+        cache_time = self.cache_time
+        try:
+            reply = self.generate(key)
+            if reply:
+                results = [{"type": "article", "title": "Рюк отвечает", "text": reply}]
+                results = (results + self.instant_results(key))[:self.max_results]
+                self._store(key, results)
+                with self._lock:
+                    self._stats["generated"] += 1
+            else:
+                # Gemini is down or busy: answer from precomputed results, keep nothing
+                results = self.instant_results(key)
+                cache_time = 0
+        except Exception as e:
+            logger.error(f"Inline generation failed for {key!r}: {e}")
+            results = self.instant_results(key)
+            cache_time = 0
+        finally:
+            with self._lock:
+                waiting = self._waiting.pop(key, [])
+        for waiting_query_id, waiting_user_id in waiting:
+            self._send(waiting_query_id, waiting_user_id, key, results, cache_time)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cached_queries"] = len(self._cache)
+        stats["hit_ratio"] = stats["cache_hits"] / stats["queries"] if stats["queries"] else 0.0
+        return stats
@@ -0,0 +1,143 @@
+"""
+Live introspection of the running bot for /debug.
+
+Admins (ADMIN_USER_IDS) get runtime internals with /debug and can capture
+a time-boxed report from the running process, sent back as a document:
+
+    /debug profile [seconds]   sampling profile of every thread
+    /debug memory [seconds]    tracemalloc snapshot and what grew meanwhile
+
+The profiler reads the stacks of all threads from sys._current_frames()
+every few milliseconds. It needs no instrumentation and costs nothing while
+it is not running, and since it samples wall-clock time it shows where
+handlers wait (Gemini, Hugging Face, Telegram) as well as where they burn
+CPU. The report lists the top functions by own and cumulative samples and
+the hottest stacks in the collapsed format flamegraph.pl reads.
+
+tracemalloc is only switched on for the memory window (unless the bot was
+started with PYTHONTRACEMALLOC), so the report shows the allocations made
+during the window that are still alive, next to the object counts by type.
+"""
+
+import gc
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+DEFAULT_INTERVAL = 0.005
+
+
+class InFlight:
+    """Counts jobs running inside `with counter:` blocks (or between add() and done())"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {"running": 0, "peak": 0, "total": 0}
+
+    def add(self):
+        with self._lock:
+            self._stats["running"] += 1
+            self._stats["total"] += 1
+            self._stats["peak"] = max(self._stats["peak"], self._stats["running"])
+
+    def done(self):
+        with self._lock:
+            self._stats["running"] -= 1
+
+    def __enter__(self):
+        self.add()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.done()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+def _frame_key(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def profile(seconds, interval=DEFAULT_INTERVAL, top=30):
+    """Sample the stacks of all other threads for `seconds`; returns a text report"""
+    own = threading.get_ident()
+    own_samples = Counter()
+    cumulative = Counter()
+    stacks = Counter()
+    per_thread = Counter()
+    samples = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while time.perf_counter() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_key(frame))
+                frame = frame.f_back
+            own_samples[stack[0]] += 1
+            # A recursive function counts once per sample
+            cumulative.update(set(stack))
+            stacks[";".join(reversed(stack))] += 1
+            per_thread[names.get(ident, str(ident))] += 1
+        samples += 1
+        time.sleep(interval)
+    elapsed = time.perf_counter() - started
+    total = sum(per_thread.values()) or 1
+
+    lines = [
+        f"Sampling profile: {elapsed:.1f}s, {samples} samples every {interval * 1000:.0f} ms, "
+        f"{len(per_thread)} threads",
+        "Wall clock: threads waiting on I/O or locks are counted too",
+        "",
+        "Samples per thread:",
+    ]
+    lines += [f"  {count:8d}  {name}" for name, count in per_thread.most_common(top)]
+    for title, counter in (("Top functions by own samples", own_samples),
+                           ("Top functions by cumulative samples", cumulative)):
+        lines += ["", f"{title}:", f"  {'samples':>8} {'share':>6}  function"]
+        lines += [f"  {count:8d} {count / total:6.1%}  {key}" for key, count in counter.most_common(top)]
+    lines += ["", "Hottest stacks (collapsed, for flamegraph.pl):"]
+    lines += [f"{stack} {count}" for stack, count in stacks.most_common(top)]
+    return "\n".join(lines) + "\n"
+
+
+def memory_snapshot(seconds, top=30):
+    """Trace allocations for `seconds` with tracemalloc; returns a text report"""
+    started_here = not tracemalloc.is_tracing()
+    if started_here:
+        tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        time.sleep(seconds)
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started_here:
+            tracemalloc.stop()
+    ignore = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__))
+    before = before.filter_traces(ignore)
+    after = after.filter_traces(ignore)
+
+    lines = [
+        f"tracemalloc snapshot after {seconds:.1f}s "
+        f"({'started for this window' if started_here else 'tracing since startup'})",
+        f"Traced memory: {current / 1024:,.0f} KB now, {peak / 1024:,.0f} KB peak",
+        "",
+        "Top allocation sites by size:",
+    ]
+    lines += [f"  {stat}" for stat in after.statistics("lineno")[:top]]
+    lines += ["", "Growth during the window:"]
+    lines += [f"  {stat}" for stat in after.compare_to(before, "lineno")[:top] if stat.size_diff]
+    objects = Counter(type(item).__name__ for item in gc.get_objects())
+    lines += ["", f"Objects tracked by the garbage collector: {sum(objects.values()):,}"]
+    lines += [f"  {count:10,d}  {name}" for name, count in objects.most_common(top)]
+    return "\n".join(lines) + "\n"
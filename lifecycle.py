@@ -0,0 +1,256 @@
+"""
+Graceful shutdown and warm restart.
+
+On SIGTERM or Ctrl+C the bot
+- stops taking new updates; the long poll in progress is abandoned, and
+  since Telegram only confirms updates on the next poll, whatever it
+  returns is delivered again after the restart
+- waits up to SHUTDOWN_DEADLINE seconds for running handlers, e.g. /draw
+  jobs and LLM calls, to finish
+- writes a snapshot (SNAPSHOT_PATH) with the conversation store, registered
+  caches and every update that was not handled in time
+
+On the next start the snapshot is loaded before polling begins, so users
+keep their context, and the unhandled updates are dispatched again.
+Snapshots are pickled plain data, compressed with zlib and written
+atomically.
+"""
+
+import logging
+import os
+import pickle
+import signal
+import threading
+import time
+import zlib
+
+from telebot.types import Update
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b"RUKESNAP"
+SNAPSHOT_VERSION = 1
+
+
+def write_snapshot(path, state):
+    """Write `state` to `path` atomically; returns the number of bytes written"""
+    payload = zlib.compress(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL), 6)
+    data = SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]) + payload
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(data)
+
+
+def read_snapshot(path):
+    """Load a snapshot written by write_snapshot, or None if there is none"""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    header = len(SNAPSHOT_MAGIC) + 1
+    if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC or data[len(SNAPSHOT_MAGIC)] != SNAPSHOT_VERSION:
+        raise ValueError(f"{path} is not a version {SNAPSHOT_VERSION} snapshot")
+    return pickle.loads(zlib.decompress(data[header:]))
+
+
+class Lifecycle:
+    """Tracks in-flight handler tasks of a TeleBot and handles drain, snapshot and restore"""
+
+    def __init__(self, bot, snapshot_path, deadline=25.0, pending_max_age=600):
+        self.bot = bot
+        self.snapshot_path = snapshot_path
+        self.deadline = deadline
+        self.pending_max_age = pending_max_age
+        # name -> (export_fn, import_fn) for state that should survive restarts
+        self.providers = {}
+        # Callables run after the snapshot, e.g. flushing buffered writes
+        self.shutdown_hooks = []
+        self.stopping = threading.Event()
+        self._stopped = False
+        self._stop_requested_at = None
+        self._in_flight = {}
+        self._dropped = 0
+        self._next_token = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._original_exec_task = None
+
+    def register_state(self, name, export_fn, import_fn):
+        """Include export_fn() in snapshots and pass it to import_fn() on restore"""
+        self.providers[name] = (export_fn, import_fn)
+
+    def on_shutdown(self, hook):
+        self.shutdown_hooks.append(hook)
+
+    # --- tracking ----------------------------------------------------------
+
+    def install(self, handle_signals=True):
+        """Start tracking handler tasks; optionally take over SIGTERM/SIGINT"""
+        self._original_exec_task = self.bot._exec_task
+        self.bot._exec_task = self._exec_task
+        if handle_signals and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self._on_signal)
+            signal.signal(signal.SIGINT, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        if self.stopping.is_set():
+            logger.warning("Second stop signal, exiting without waiting")
+            raise SystemExit(1)
+        logger.info(f"Received signal {signum}, stopping intake and draining")
+        self.request_stop()
+
+    def request_stop(self):
+        self._stop_requested_at = time.monotonic()
+        self.stopping.set()
+        self.bot.stop_polling()
+
+    def _exec_task(self, task, *args, **kwargs):
+        update_type = kwargs.get("update_type")
+        item = args[0] if args else None
+        raw = getattr(item, "json", None) if update_type else None
+
+        if raw is not None and self.stopping.is_set():
+            # Intake is closed; this update was never confirmed, so Telegram sends it again after the restart
+            with self._lock:
+                self._dropped += 1
+            return
+
+        with self._lock:
+            self._next_token += 1
+            token = self._next_token
+            self._in_flight[token] = (update_type, raw)
+
+        def tracked(*task_args, **task_kwargs):
+            try:
+                return task(*task_args, **task_kwargs)
+            finally:
+                with self._lock:
+                    self._in_flight.pop(token, None)
+                    if not self._in_flight:
+                        self._idle.notify_all()
+
+        self._original_exec_task(tracked, *args, **kwargs)
+
+    def run_polling(self, polling):
+        """Run the blocking `polling` callable in a thread until it ends or a stop is requested.
+
+        Returning right away on a stop request means shutdown does not wait for
+        the long poll in progress. Errors raised by `polling` are re-raised here.
+        """
+        errors = []
+
+        def target():
+            try:
+                polling()
+            except BaseException as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=target, name="polling", daemon=True)
+        thread.start()
+        while thread.is_alive() and not self.stopping.wait(0.5):
+            pass
+        if errors:
+            raise errors[0]
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._in_flight)
+
+    # --- shutdown ----------------------------------------------------------
+
+    def drain(self):
+        """Wait for in-flight tasks until the deadline; returns how many are still running"""
+        started = self._stop_requested_at or time.monotonic()
+        end = started + self.deadline
+        with self._lock:
+            while self._in_flight:
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._idle.wait(remaining)
+            return len(self._in_flight)
+
+    def snapshot(self):
+        """Write the current state and unhandled updates to snapshot_path"""
+        with self._lock:
+            pending = [entry for entry in self._in_flight.values() if entry[1] is not None]
+            dropped = self._dropped
+        state = {"created": time.time(), "pending": pending, "state": {}}
+        for name, (export_fn, _) in self.providers.items():
+            try:
+                state["state"][name] = export_fn()
+            except Exception as e:
+                logger.error(f"Could not export {name} for the snapshot: {e}")
+        size = write_snapshot(self.snapshot_path, state)
+        logger.info(f"Snapshot written to {self.snapshot_path}: {size} bytes, {len(pending)} unhandled updates "
+                    f"({dropped} left for Telegram to resend)")
+        return state
+
+    def shutdown(self):
+        """Stop intake, drain, snapshot and run the shutdown hooks (safe to call more than once)"""
+        if self._stopped:
+            return
+        self._stopped = True
+        if not self.stopping.is_set():
+            self.request_stop()
+        still_running = self.drain()
+        if still_running:
+            logger.warning(f"{still_running} handlers still running after {self.deadline}s; "
+                           f"their updates are kept for the next start")
+        try:
+            self.snapshot()
+        except Exception as e:
+            logger.error(f"Could not write snapshot: {e}", exc_info=True)
+        self.run_shutdown_hooks()
+
+    def run_shutdown_hooks(self):
+        """Run the on_shutdown hooks, logging failures"""
+        for hook in self.shutdown_hooks:
+            try:
+                hook()
+            except Exception as e:
+                logger.error(f"Shutdown hook failed: {e}")
+
+    # --- startup -----------------------------------------------------------
+
+    def restore(self):
+        """Load the snapshot (if any) into the registered providers; returns the pending updates.
+
+        The snapshot file is removed once loaded, so it is never applied twice.
+        """
+        try:
+            state = read_snapshot(self.snapshot_path)
+        except Exception as e:
+            logger.error(f"Ignoring unreadable snapshot {self.snapshot_path}: {e}")
+            return []
+        if state is None:
+            return []
+        for name, (_, import_fn) in self.providers.items():
+            if name in state["state"]:
+                try:
+                    import_fn(state["state"][name])
+                except Exception as e:
+                    logger.error(f"Could not restore {name} from the snapshot: {e}")
+        os.remove(self.snapshot_path)
+
+        now = time.time()
+        pending = [
+            (update_type, raw) for update_type, raw in state["pending"]
+            # Answering a message from long ago would be confusing; drop those
+            if now - raw.get("date", now) <= self.pending_max_age
+        ]
+        age = now - state["created"]
+        logger.info(f"Restored snapshot from {age:.0f}s ago with {len(pending)} unhandled updates "
+                    f"({len(state['pending']) - len(pending)} too old)")
+        return pending
+
+    def redeliver(self, pending):
+        """Dispatch updates returned by restore() through the bot's normal handlers"""
+        updates = [Update.de_json({"update_id": 0, update_type: raw}) for update_type, raw in pending]
+        if updates:
+            self.bot.process_new_updates(updates)
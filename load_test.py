@@ -0,0 +1,366 @@
+"""
+Offline end-to-end load test for simple_ruke_bot.
+
+Starts the local Telegram / Gemini / Hugging Face stand-ins from
+fake_upstreams.py, points the bot at them through its environment overrides,
+runs the real main() (model probing, getMe, setMyCommands, polling) and drives
+it with synthetic private and group traffic.
+
+Reports updates/s, p50/p95/p99 reply latency (from the moment an update is
+queued in the fake Telegram server until the bot's first reply to it arrives)
+and upstream call counts.
+
+Usage:
+    python load_test.py --updates 300 --rate 50 --gemini 0.8,0.4,0.01,500 --hf 3,0.3
+"""
+
+import argparse
+import importlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+
+from fake_upstreams import LatencyProfile, point_bot_environment, start_fake_upstreams, stop_fake_upstreams
+
+SAMPLE_TEXTS = [
+    "привет",
+    "Рюк, как дела?",
+    "что ты думаешь о BTS?",
+    "мне скучно, давай поиграем",
+    "расскажи что-нибудь про тетрадь смерти",
+    "Сегодня в школе была контрольная по математике, и я вообще ничего не поняла, "
+    "учительница опять задала кучу домашки, а потом ещё подруга обиделась непонятно на что. "
+    "Как думаешь, что мне делать?",
+    "Wie geht's?",
+    "ты любишь яблоки?",
+    "а что будет, если написать в тетради своё имя?",
+    "хахаха",
+]
+
+DRAW_PROMPTS = ["яблоко смерти", "шинигами наблюдает за городом", "тетрадь смерти в лунном свете"]
+# Seconds to wait for the bot to shut down before the stand-ins are stopped
+SHUTDOWN_WAIT = 90
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers (0 for an empty list)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def latency_summary(values):
+    """Count, mean and p50/p95/p99/max of latencies in seconds"""
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else 0.0,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else 0.0,
+    }
+
+
+class TrafficGenerator:
+    """Builds synthetic Telegram updates for private chats and group chats"""
+
+    KINDS = ("private", "group_mention", "group_reply", "group_command", "group_chatter", "draw")
+
+    def __init__(self, bot_id, bot_username, users=200, groups=10, private_ratio=0.5,
+                 draw_ratio=0.02, chatter_ratio=0.3, seed=1):
+        self.bot_id = bot_id
+        self.bot_username = bot_username
+        self.users = users
+        self.groups = groups
+        self.private_ratio = private_ratio
+        self.draw_ratio = draw_ratio
+        self.chatter_ratio = chatter_ratio
+        self.random = random.Random(seed)
+        self._next_message_id = 1
+
+    def _user(self):
+        user_id = 100000 + self.random.randrange(self.users)
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "language_code": "ru"}
+
+    def next_update(self):
+        """Return (kind, update dict)"""
+        self._next_message_id += 1
+        user = self._user()
+        text = self.random.choice(SAMPLE_TEXTS)
+
+        if self.random.random() < self.draw_ratio:
+            kind = "draw"
+            text = f"/draw {self.random.choice(DRAW_PROMPTS)}"
+            private = self.random.random() < self.private_ratio
+        elif self.random.random() < self.private_ratio:
+            kind = "private"
+            private = True
+        else:
+            private = False
+            roll = self.random.random()
+            if roll < self.chatter_ratio:
+                kind = "group_chatter"
+            elif roll < self.chatter_ratio + (1 - self.chatter_ratio) / 3:
+                kind = "group_mention"
+                text = f"@{self.bot_username} {text}"
+            elif roll < self.chatter_ratio + 2 * (1 - self.chatter_ratio) / 3:
+                kind = "group_reply"
+            else:
+                kind = "group_command"
+                text = f"/ryuk {text}"
+
+        if private:
+            chat = {"id": user["id"], "type": "private", "first_name": user["first_name"]}
+        else:
+            group_id = -1001000000000 - self.random.randrange(self.groups)
+            chat = {"id": group_id, "type": "supergroup", "title": f"Group {group_id}"}
+
+        message = {
+            "message_id": self._next_message_id,
+            "date": int(time.time()),
+            "chat": chat,
+            "from": user,
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        if kind == "group_reply":
+            message["reply_to_message"] = {
+                "message_id": self._next_message_id - 1,
+                "date": int(time.time()) - 30,
+                "chat": chat,
+                "from": {"id": self.bot_id, "is_bot": True, "first_name": "Ryuk", "username": self.bot_username},
+                "text": "Ку-ку-ку!",
+            }
+        return kind, {"message": message}
+
+
+class ReplyTracker:
+    """Matches outgoing bot calls to the updates they answer"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.outstanding = {}
+        self.required_outstanding = 0
+        self.latencies = defaultdict(list)
+        self.sent = Counter()
+        self.first_push = None
+        self.last_reply = None
+        self.all_answered = threading.Event()
+
+    def expect(self, kind, chat_id, message_id, pushed_at, required=True):
+        """Register an update; `required` ones must be answered before the run ends"""
+        with self.lock:
+            self.outstanding[(chat_id, message_id)] = (kind, pushed_at, required)
+            self.sent[kind] += 1
+            if required:
+                self.required_outstanding += 1
+                self.all_answered.clear()
+            if self.first_push is None:
+                self.first_push = pushed_at
+
+    def on_outgoing(self, record):
+        if record["reply_to_message_id"] is None:
+            return
+        key = (record["chat_id"], record["reply_to_message_id"])
+        with self.lock:
+            entry = self.outstanding.pop(key, None)
+            if entry is None:
+                return
+            kind, pushed_at, required = entry
+            self.latencies[kind].append(record["at"] - pushed_at)
+            self.last_reply = record["at"]
+            if required:
+                self.required_outstanding -= 1
+                if self.required_outstanding == 0:
+                    self.all_answered.set()
+
+
+def build_profiles(args):
+    return (
+        LatencyProfile.parse(args.telegram, seed=args.seed),
+        LatencyProfile.parse(args.gemini, seed=args.seed + 1),
+        LatencyProfile.parse(args.hf, seed=args.seed + 2),
+    )
+
+
+def run_load_test(args):
+    """Run one load test and return the report dict"""
+    telegram_profile, gemini_profile, hf_profile = build_profiles(args)
+    telegram, gemini, huggingface = start_fake_upstreams(telegram_profile, gemini_profile, hf_profile)
+    point_bot_environment(telegram, gemini, huggingface, os.environ)
+
+    # The bot writes temp/debug images into the working directory
+    workdir = tempfile.mkdtemp(prefix="ruke-loadtest-")
+    os.chdir(workdir)
+
+    tracker = ReplyTracker()
+    telegram.listeners.append(tracker.on_outgoing)
+
+    stop_event = threading.Event()
+    if args.workers:
+        # Chat-sharded multi-process mode; workers inherit the fake endpoints from os.environ
+        sharded_runner = importlib.import_module("sharded_runner")
+        os.environ["CONVERSATION_STORE"] = "sqlite:///loadtest_state.db"
+        bot_thread = threading.Thread(target=sharded_runner.run, args=(args.workers, stop_event),
+                                      kwargs={"poll_timeout": 1}, name="bot-front", daemon=True)
+        stop_bot = stop_event.set
+    else:
+        bot_module = importlib.import_module("simple_ruke_bot")
+        bot_thread = threading.Thread(target=bot_module.main, name="bot-main", daemon=True)
+        stop_bot = bot_module.lifecycle.request_stop
+    if args.quiet:
+        import logging
+        logging.getLogger().setLevel(logging.WARNING)
+    bot_thread.start()
+
+    # Wait until the bot is actually polling
+    deadline = time.monotonic() + 120
+    while telegram.stats()["calls"].get("getUpdates", 0) == 0:
+        if time.monotonic() > deadline or not bot_thread.is_alive():
+            raise RuntimeError("Bot did not start polling against the fake Telegram server")
+        time.sleep(0.05)
+    startup_calls = {"telegram": telegram.stats(), "gemini": gemini.stats(), "huggingface": huggingface.stats()}
+
+    generator = TrafficGenerator(
+        telegram.bot_id, telegram.bot_username, users=args.users, groups=args.groups,
+        private_ratio=args.private_ratio, draw_ratio=args.draw_ratio,
+        chatter_ratio=args.chatter_ratio, seed=args.seed,
+    )
+
+    started = time.perf_counter()
+    for i in range(args.updates):
+        if args.rate > 0:
+            target = started + i / args.rate
+            delay = target - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        kind, update = generator.next_update()
+        message = update["message"]
+        pushed_at = time.perf_counter()
+        update["_pushed_at"] = pushed_at
+        # Group chatter is not addressed to the bot, so a reply is optional
+        tracker.expect(kind, message["chat"]["id"], message["message_id"], pushed_at,
+                       required=kind != "group_chatter")
+        telegram.push_update(update)
+    offered_seconds = time.perf_counter() - started
+
+    tracker.all_answered.wait(args.timeout)
+    finished = time.perf_counter()
+    stop_bot()
+    # Let the bot (or the front and its workers) finish shutting down while the stand-ins still answer
+    bot_thread.join(timeout=SHUTDOWN_WAIT)
+
+    with tracker.lock:
+        unanswered = Counter(kind for kind, _, _ in tracker.outstanding.values())
+        latencies = {kind: list(values) for kind, values in tracker.latencies.items()}
+        sent = dict(tracker.sent)
+        last_reply = tracker.last_reply or finished
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    answered = len(all_latencies)
+    elapsed = max(last_reply - started, 1e-9)
+
+    report = {
+        "config": {
+            "updates": args.updates,
+            "rate": args.rate,
+            "workers": args.workers,
+            "users": args.users,
+            "groups": args.groups,
+            "private_ratio": args.private_ratio,
+            "draw_ratio": args.draw_ratio,
+            "chatter_ratio": args.chatter_ratio,
+            "telegram": telegram_profile.describe(),
+            "gemini": gemini_profile.describe(),
+            "huggingface": hf_profile.describe(),
+        },
+        "sent": sent,
+        "answered": answered,
+        "unanswered": dict(unanswered),
+        "offered_rate": args.updates / offered_seconds if offered_seconds > 0 else None,
+        "elapsed_seconds": elapsed,
+        "updates_per_second": answered / elapsed,
+        "latency": latency_summary(all_latencies),
+        "latency_by_kind": {kind: latency_summary(values) for kind, values in sorted(latencies.items())},
+        "startup_calls": startup_calls,
+        "upstream_calls": {
+            "telegram": telegram.stats(),
+            "gemini": gemini.stats(),
+            "huggingface": huggingface.stats(),
+        },
+    }
+    stop_fake_upstreams(telegram, gemini, huggingface)
+    return report
+
+
+def print_report(report):
+    latency = report["latency"]
+    print("====================================================")
+    print("Load test report")
+    print("====================================================")
+    for key, value in report["config"].items():
+        print(f"{key:>14}: {value}")
+    print("----------------------------------------------------")
+    print(f"Updates sent:     {sum(report['sent'].values())} {report['sent']}")
+    print(f"Answered:         {report['answered']}")
+    print(f"Unanswered:       {report['unanswered']}")
+    print(f"Elapsed:          {report['elapsed_seconds']:.2f} s")
+    print(f"Throughput:       {report['updates_per_second']:.2f} updates/s")
+    print(f"Reply latency:    p50={latency['p50']*1000:.0f}ms p95={latency['p95']*1000:.0f}ms "
+          f"p99={latency['p99']*1000:.0f}ms max={latency['max']*1000:.0f}ms")
+    for kind, summary in report["latency_by_kind"].items():
+        print(f"  {kind:>14}: n={summary['count']} p50={summary['p50']*1000:.0f}ms "
+              f"p95={summary['p95']*1000:.0f}ms p99={summary['p99']*1000:.0f}ms")
+    print("Upstream calls:")
+    for name, stats in report["upstream_calls"].items():
+        print(f"  {name:>14}: {stats['calls']} errors={stats['errors']}")
+    gemini = report["upstream_calls"]["gemini"]
+    if gemini["calls"].get("generateContent"):
+        print(f"Gemini request size: {gemini['prompt_chars'] / gemini['calls']['generateContent']:.0f} chars/call")
+    print("====================================================")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test for the Ryuk bot")
+    parser.add_argument("--updates", type=int, default=200, help="Number of synthetic updates to send")
+    parser.add_argument("--rate", type=float, default=0, help="Updates per second to offer (0 = all at once)")
+    parser.add_argument("--users", type=int, default=200, help="Size of the synthetic user pool")
+    parser.add_argument("--groups", type=int, default=10, help="Number of synthetic group chats")
+    parser.add_argument("--private-ratio", type=float, default=0.5, help="Share of private-chat traffic")
+    parser.add_argument("--draw-ratio", type=float, default=0.02, help="Share of /draw commands")
+    parser.add_argument("--chatter-ratio", type=float, default=0.3, help="Share of group traffic not addressed to the bot")
+    parser.add_argument("--telegram", default="0.02,0.3", help="Telegram latency: median[,sigma[,error_rate[,codes]]]")
+    parser.add_argument("--gemini", default="0.8,0.4", help="Gemini latency: median[,sigma[,error_rate[,codes]]]")
+    parser.add_argument("--hf", default="3,0.3", help="Hugging Face latency: median[,sigma[,error_rate[,codes]]]")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Run sharded_runner with this many worker processes (0 = single-process main())")
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds to wait for outstanding replies")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for traffic and latency")
+    parser.add_argument("--json", help="Also write the report to this JSON file")
+    parser.add_argument("--quiet", action="store_true", help="Only log warnings and errors from the bot")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    json_path = os.path.abspath(args.json) if args.json else None
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    report = run_load_test(args)
+    print_report(report)
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Report saved to {json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+Builds the deployable mini-app (docs/ for GitHub Pages) from public/ and src/.
+
+The source images are large JPEGs: the background alone is about 1 MB, which
+makes the first paint inside Telegram slow on mobile. For every image the
+build writes resized AVIF, WebP and JPEG variants with content-hashed names
+(so they can be cached forever) and rewrites the references:
+
+- <img> tags in index.html become <picture> elements with AVIF and WebP
+  sources and a JPEG fallback, each with a srcset of the resized widths
+- CSS backgrounds use image-set() with a plain JPEG declaration in front for
+  browsers without it, and a smaller variant on narrow screens
+
+Everything else is copied as is. The output directory is rebuilt from
+scratch, so it is never edited by hand:
+
+    pip install Pillow
+    python build_assets.py                 # writes docs/
+    python build_assets.py --output dist
+
+The payload size before and after is printed at the end.
+"""
+
+import argparse
+import hashlib
+import io
+import os
+import re
+import shutil
+import sys
+
+try:
+    from PIL import Image
+except ImportError:
+    sys.exit("build_assets.py needs Pillow: pip install Pillow")
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+IMAGES_DIR = os.path.join("src", "assets", "images")
+
+# Widths to produce per image; `sizes` is the srcset sizes of <img> tags,
+# `narrow_width` the variant used as a background on narrow screens
+IMAGES = {
+    "death_note_cover.jpg": {"widths": [200, 400, 600], "sizes": "200px"},
+    "death_note_bg.jpg": {"widths": [960, 1920], "narrow_width": 960},
+}
+NARROW_SCREEN = "(max-width: 600px)"
+
+# Format -> (extension, MIME type, Pillow save options)
+FORMATS = {
+    "avif": ("avif", "image/avif", {"quality": 50, "speed": 6}),
+    "webp": ("webp", "image/webp", {"quality": 75, "method": 6}),
+    "jpeg": ("jpg", "image/jpeg", {"quality": 78, "optimize": True, "progressive": True}),
+}
+
+
+def encode(image, format_name):
+    _, _, options = FORMATS[format_name]
+    buffer = io.BytesIO()
+    image.save(buffer, format=format_name.upper(), **options)
+    return buffer.getvalue()
+
+
+def build_variants(source, output_dir, widths):
+    """Write resized variants of `source`; returns {format: [(width, filename, size)]}"""
+    with Image.open(source) as original:
+        image = original.convert("RGB")
+    stem = os.path.splitext(os.path.basename(source))[0]
+    variants = {format_name: [] for format_name in FORMATS}
+    for width in widths:
+        width = min(width, image.width)
+        resized = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+        for format_name, (extension, _, _) in FORMATS.items():
+            data = encode(resized, format_name)
+            digest = hashlib.sha256(data).hexdigest()[:10]
+            filename = f"{stem}-{width}.{digest}.{extension}"
+            with open(os.path.join(output_dir, filename), "wb") as f:
+                f.write(data)
+            variants[format_name].append((width, filename, len(data)))
+    return variants, image.size
+
+
+def pick(variants, width):
+    """(width, filename, size) of the smallest variant at least `width` wide, else the largest"""
+    return next((variant for variant in variants if variant[0] >= width), variants[-1])
+
+
+def srcset(variants, prefix):
+    return ", ".join(f"{prefix}{filename} {width}w" for width, filename, _ in variants)
+
+
+def picture_tag(match, name, variants, size, sizes, prefix):
+    """<picture> replacing an <img> tag that points at `name`"""
+    attributes = match.group(1).rstrip()
+    fallback = variants["jpeg"][-1][1]
+    sources = "".join(
+        f'<source type="{FORMATS[format_name][1]}" srcset="{srcset(variants[format_name], prefix)}" sizes="{sizes}">'
+        for format_name in ("avif", "webp")
+    )
+    return (f'<picture>{sources}<img src="{prefix}{fallback}" srcset="{srcset(variants["jpeg"], prefix)}" '
+            f'sizes="{sizes}" width="{size[0]}" height="{size[1]}"{attributes} decoding="async"></picture>')
+
+
+def image_set(variants, width, prefix):
+    entries = []
+    for format_name in FORMATS:
+        filename = pick(variants[format_name], width)[1]
+        entries.append(f"url('{prefix}{filename}') type(\"{FORMATS[format_name][1]}\")")
+    return "image-set(" + ", ".join(entries) + ")"
+
+
+def rewrite_html(html, built, prefix):
+    for name, (variants, size) in built.items():
+        if "sizes" not in IMAGES[name]:
+            continue
+        pattern = re.compile(r'<img\s+src="' + re.escape(prefix + name) + r'"([^>]*?)/?>')
+        html = pattern.sub(lambda match: picture_tag(match, name, variants, size, IMAGES[name]["sizes"], prefix), html)
+    return html
+
+
+def rewrite_css(css, built, prefix):
+    for name, (variants, _) in built.items():
+        declaration = re.compile(r"^(\s*)background-image:\s*url\(['\"]?" + re.escape(prefix + name) + r"['\"]?\);$",
+                                 re.MULTILINE)
+        match = declaration.search(css)
+        if not match:
+            continue
+        indent = match.group(1)
+        widest = variants["jpeg"][-1][0]
+        replacement = (f"{indent}background-image: url('{prefix}{variants['jpeg'][-1][1]}');\n"
+                       f"{indent}background-image: {image_set(variants, widest, prefix)};")
+        # Selector of the rule holding the declaration, for the narrow-screen override
+        rule_start = css.rfind("}", 0, match.start()) + 1
+        selector = css[rule_start:css.index("{", rule_start)].strip()
+        rule_end = css.index("}", match.end()) + 1
+        narrow = IMAGES[name].get("narrow_width")
+        override = ""
+        if narrow:
+            override = (f"\n\n@media {NARROW_SCREEN} {{\n    {selector} {{\n"
+                        f"        background-image: {image_set(variants, narrow, prefix)};\n    }}\n}}")
+        css = css[:match.start()] + replacement + css[match.end():rule_end] + override + css[rule_end:]
+    return css
+
+
+def tree_size(path):
+    return sum(os.path.getsize(os.path.join(directory, name))
+               for directory, _, names in os.walk(path) for name in names)
+
+
+def kb(size):
+    return f"{size / 1024:,.0f} KB"
+
+
+def build(output):
+    output = os.path.abspath(output)
+    if output in (ROOT, os.path.join(ROOT, "src"), os.path.join(ROOT, "public")):
+        sys.exit(f"Refusing to overwrite {output}")
+    if os.path.isdir(output):
+        shutil.rmtree(output)
+    shutil.copytree(os.path.join(ROOT, "public"), output)
+    shutil.copytree(os.path.join(ROOT, "src"), os.path.join(output, "src"),
+                    ignore=lambda directory, names: names if directory.endswith(IMAGES_DIR) else [])
+    open(os.path.join(output, ".nojekyll"), "w").close()
+
+    built = {}
+    report = []
+    for name, options in IMAGES.items():
+        source = os.path.join(ROOT, IMAGES_DIR, name)
+        variants, size = build_variants(source, os.path.join(output, IMAGES_DIR), options["widths"])
+        built[name] = (variants, size)
+        report.append((name, os.path.getsize(source), variants))
+
+    html_path = os.path.join(output, "index.html")
+    with open(html_path, encoding="utf-8") as f:
+        html = f.read()
+    with open(html_path, "w", encoding="utf-8") as f:
+        f.write(rewrite_html(html, built, "./src/assets/images/"))
+    css_path = os.path.join(output, "src", "styles", "main.css")
+    with open(css_path, encoding="utf-8") as f:
+        css = f.read()
+    with open(css_path, "w", encoding="utf-8") as f:
+        f.write(rewrite_css(css, built, "../assets/images/"))
+
+    # Payload: what a phone downloads for the images (largest cover variant for 3x screens,
+    # narrow background) compared to the original JPEGs
+    print(f"{'image':<24}{'original':>12}  variants")
+    before = after_avif = after_webp = after_jpeg = 0
+    for name, original_size, variants in report:
+        options = IMAGES[name]
+        width = options.get("narrow_width") or options["widths"][-1]
+        before += original_size
+        after_avif += pick(variants["avif"], width)[2]
+        after_webp += pick(variants["webp"], width)[2]
+        after_jpeg += pick(variants["jpeg"], width)[2]
+        listed = ", ".join(f"{w}w {format_name} {kb(s)}" for format_name in FORMATS for w, _, s in variants[format_name])
+        print(f"{name:<24}{kb(original_size):>12}  {listed}")
+    source_tree = tree_size(os.path.join(ROOT, "public")) + tree_size(os.path.join(ROOT, "src"))
+    print(f"\nImages on a phone: {kb(before)} before, {kb(after_avif)} AVIF / {kb(after_webp)} WebP / "
+          f"{kb(after_jpeg)} JPEG after")
+    print(f"Deployed tree: {kb(source_tree)} before, {kb(tree_size(output))} after ({output})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the mini-app with optimized images")
+    parser.add_argument("--output", default=os.path.join(ROOT, "docs"), help="Output directory (default: docs)")
+    args = parser.parse_args(argv)
+    build(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,12 @@
 #!/bin/bash
 # This script prepares the Death Note mini-app for GitHub Pages deployment
 
-# Create a docs folder for GitHub Pages (or use any other folder you've configured)
-mkdir -p docs
+cd "$(dirname "$0")"
 
-# Copy public files to docs
-cp -r public/* docs/
-
-# Create .nojekyll file to bypass Jekyll processing
-touch docs/.nojekyll
-
-# Copy source files to docs
-cp -r src docs/
-
-# Fix paths in index.html (already done in the file)
-cp public/index.html docs/
+# Build the docs folder from public/ and src/, with optimized, content-hashed images
+# (docs/ is generated; edit public/ and src/ instead)
+python3 build_assets.py --output docs || exit 1
 
 echo "Files prepared for GitHub Pages in 'docs' folder."
 echo "You can now commit and push to your GitHub repository."
-echo "Make sure to set GitHub Pages to use the 'docs' folder in your repository settings." 
\ No newline at end of file
+echo "Make sure to set GitHub Pages to use the 'docs' folder in your repository settings."
@@ -13,6 +13,8 @@ document.addEventListener('DOMContentLoaded', () => {
     
     // Initialize the game
     initGame();
+    loadCases();
+    loadSavedProgress();
     
     // Show the game interface after a short loading delay
     setTimeout(() => {
@@ -95,7 +97,8 @@ function backToChat() {
 function startGame() {
     hideAllScreens();
     document.getElementById('gameScreen').classList.remove('hide');
-    loadCase(1); // Load the first case
+    // Load the first case, resuming it if the player left it unfinished
+    Promise.all([loadCases(), loadSavedProgress()]).then(() => loadCase(1));
 }
 
 // Hide all screens
@@ -161,6 +164,15 @@ function updateDeathNoteUses() {
 function showResults(solved) {
     hideAllScreens();
     
+    // Keep the outcome for sharing
+    const caseData = gameState.currentCase;
+    gameState.lastResults = {
+        solved: solved,
+        score: solved ? Math.max(gameState.daysLeft, 0) * 100 + (caseData.deathNoteUses - gameState.killedSuspects.length) * 50 : 0,
+        daysUsed: caseData.days - Math.max(gameState.daysLeft, 0),
+        deathNoteUses: gameState.killedSuspects.length
+    };
+    
     const resultsSummary = document.getElementById('resultsSummary');
     resultsSummary.innerHTML = '';
     
@@ -195,13 +207,8 @@ function nextCase() {
 
 // Share results with the Telegram chat
 function shareResults() {
-    const telegramApp = window.Telegram?.WebApp;
-    if (telegramApp) {
-        telegramApp.sendData(JSON.stringify({
-            action: 'share_results',
-            case_solved: true, // Replace with actual result
-            case_id: 1 // Replace with actual case ID
-        }));
+    if (gameState.lastResults) {
+        shareTelegramResults(gameState.lastResults);
     }
 }
 
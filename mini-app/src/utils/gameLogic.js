@@ -14,105 +14,41 @@ let gameState = {
     killedSuspects: []
 };
 
-// Case database
-const cases = [
-    {
-        id: 1,
-        title: "Case #1: The Serial Killer",
-        description: "A series of murders has occurred in Tokyo. All victims died of heart attacks, but they were all criminals who had escaped justice. The police are baffled.",
-        days: 5,
-        deathNoteUses: 3,
-        culprit: "Higuchi Kyosuke",
-        evidence: [
-            {
-                id: "e1",
-                title: "Crime Scene Photos",
-                description: "Photos showing victims died clutching their chests. No signs of struggle or forced entry."
-            },
-            {
-                id: "e2",
-                title: "Victim List",
-                description: "All victims were criminals who had escaped prosecution or received light sentences."
-            },
-            {
-                id: "e3",
-                title: "Surveillance Footage",
-                description: "One victim was caught on camera dying suddenly at a cafe. A businessman in a suit was watching from across the street."
-            }
-        ],
-        suspects: [
-            {
-                id: "s1",
-                name: "Higuchi Kyosuke",
-                description: "A businessman who works at Yotsuba Group. Has expressed extreme views about justice on social media.",
-                isGuilty: true,
-                clues: ["Was seen near the location of the third murder.", "Has access to criminal records through company database.", "Recent promotion coincided with start of killings."]
-            },
-            {
-                id: "s2",
-                name: "Misa Amane",
-                description: "A popular model whose parents were murdered. The killer was never brought to justice.",
-                isGuilty: false,
-                clues: ["Publicly supports the mysterious killings.", "Has an alibi for two of the murder times.", "Shows no signs of the calculated planning evident in the crimes."]
-            },
-            {
-                id: "s3",
-                name: "Teru Mikami",
-                description: "A prosecutor who has lost several high-profile cases against obvious criminals.",
-                isGuilty: false,
-                clues: ["Was out of the country during two of the killings.", "Has expressed frustration with the justice system.", "Works within legal channels despite his frustration."]
-            }
-        ]
-    },
-    {
-        id: 2,
-        title: "Case #2: The Corporate Conspiracy",
-        description: "CEOs of competing companies are dying in mysterious accidents. All companies are now being acquired by Yotsuba Group.",
-        days: 6,
-        deathNoteUses: 2,
-        culprit: "Reiji Namikawa",
-        evidence: [
-            {
-                id: "e1",
-                title: "Financial Records",
-                description: "Yotsuba Group's stock rises after each CEO's death."
-            },
-            {
-                id: "e2",
-                title: "Meeting Minutes",
-                description: "Secret meetings held by Yotsuba executives discussing 'removing obstacles'."
-            },
-            {
-                id: "e3",
-                title: "Accident Reports",
-                description: "All deaths appeared to be accidents but occurred in statistically improbable ways."
-            }
-        ],
-        suspects: [
-            {
-                id: "s1",
-                name: "Reiji Namikawa",
-                description: "Yotsuba's Director of Sales. Known for his ruthless business tactics.",
-                isGuilty: true,
-                clues: ["Was present at all meetings where 'obstacles' were discussed.", "Received largest bonus after acquisitions.", "Has personal grudges against two of the deceased CEOs."]
-            },
-            {
-                id: "s2",
-                name: "Shingo Mido",
-                description: "Yotsuba's Marketing Director. Stands to gain from company expansion.",
-                isGuilty: false,
-                clues: ["Opposed aggressive acquisition strategies in private emails.", "Was on vacation during two deaths.", "Has family connections to one of the victim's companies."]
-            },
-            {
-                id: "s3",
-                name: "Suguru Shimura",
-                description: "Yotsuba's Personnel Director. Has access to all company information.",
-                isGuilty: false,
-                clues: ["No direct benefit from the acquisitions.", "Expressed ethical concerns in private communications.", "Had alibis for three of the deaths."]
-            }
-        ]
+// Case database, loaded from the bot's API (or the bundled JSON file) by loadCases()
+let cases = [];
+
+// Progress saved by the bot, {case_id: state}, loaded by loadSavedProgress()
+let savedProgress = {};
+
+// Load the player's saved progress once; resolves to {case_id: state}
+function loadSavedProgress() {
+    if (!loadSavedProgress.promise) {
+        loadSavedProgress.promise = fetchProgress().then(progress => {
+            savedProgress = progress;
+            const solved = Object.values(progress).map(state => state.cases_solved || 0);
+            gameState.casesSolved = Math.max(gameState.casesSolved, ...solved);
+            return savedProgress;
+        });
     }
-];
+    return loadSavedProgress.promise;
+}
+
+// Load the case database once; resolves to the list of cases
+function loadCases() {
+    if (!loadCases.promise) {
+        loadCases.promise = fetchCases()
+            .then(data => {
+                cases = data;
+                return cases;
+            })
+            .catch(error => {
+                console.error('Could not load cases:', error);
+                loadCases.promise = null;
+                return cases;
+            });
+    }
+    return loadCases.promise;
+}
 
 // Initialize the game
 function initGame() {
@@ -148,9 +84,17 @@ function loadCase(caseId) {
     gameState.evidence = caseData.evidence;
     gameState.killedSuspects = [];
     
+    // Pick up an unfinished game of this case where the player left it (once per launch)
+    const saved = savedProgress[caseId];
+    delete savedProgress[caseId];
+    if (saved && saved.days_left > 0) {
+        gameState.daysLeft = saved.days_left;
+        gameState.killedSuspects = saved.killed_suspects.filter(name => caseData.suspects.some(s => s.name === name));
+    }
+    
     // Update UI
     document.getElementById('caseTitle').textContent = caseData.title;
-    document.getElementById('daysLeft').textContent = `Days left: ${caseData.days}`;
+    document.getElementById('daysLeft').textContent = `Days left: ${gameState.daysLeft}`;
     document.getElementById('noteUses').textContent = `Death Note uses: ${caseData.deathNoteUses}`;
     
     // Load the case board
@@ -339,6 +283,7 @@ function attemptSolve() {
         if (isSolved) {
             gameState.casesSolved++;
         }
+        saveProgress(true);
     });
 }
 
@@ -370,6 +315,8 @@ function checkDeathNoteTarget(name) {
         if (!suspect.isGuilty) {
             consumeDay(2); // Penalty: lose 2 days
         }
+        
+        saveProgress();
     }
 }
 
@@ -380,6 +327,7 @@ function consumeDay(days = 1) {
     // Update days left
     gameState.daysLeft -= days;
     document.getElementById('daysLeft').textContent = `Days left: ${gameState.daysLeft}`;
+    saveProgress();
     
     // Check for game over
     if (gameState.daysLeft <= 0) {
@@ -6,6 +6,78 @@
 // Get Telegram Web App instance
 const telegramApp = window.Telegram?.WebApp;
 
+// Base URL of the bot's API and version of its case database, passed by the bot
+// as ?api=...&cases=... when it opens the Mini App
+const launchParams = new URLSearchParams(window.location.search);
+const apiBase = launchParams.get('api');
+const casesVersion = launchParams.get('cases');
+
+// Delay before game progress is sent, so a burst of moves becomes one request
+const PROGRESS_SAVE_DELAY = 1500;
+let progressTimer = null;
+
+// Call the bot's API, authenticated with the signed Telegram init data
+function apiRequest(path, options = {}) {
+    const headers = Object.assign({}, options.headers);
+    if (telegramApp?.initData) {
+        headers['Authorization'] = `tma ${telegramApp.initData}`;
+    }
+    return fetch(`${apiBase}${path}`, Object.assign({}, options, { headers }))
+        .then(response => {
+            if (!response.ok) throw new Error(`${path}: HTTP ${response.status}`);
+            return response;
+        });
+}
+
+// Fetch the case database from the bot's API, falling back to the bundled copy
+function fetchCases() {
+    const bundled = () => fetch('./src/data/cases.json').then(response => response.json());
+    if (!apiBase) return bundled();
+    // A versioned URL is cached by the WebView for good; a new version gets a new URL
+    const query = casesVersion ? `?v=${encodeURIComponent(casesVersion)}` : '';
+    return fetch(`${apiBase}/api/cases${query}`)
+        .then(response => {
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            return response.json();
+        })
+        .catch(error => {
+            console.warn('Case API unavailable, using bundled cases:', error);
+            return bundled();
+        });
+}
+
+// Progress saved on the bot's side, {case_id: state}; empty when there is no API
+function fetchProgress() {
+    if (!apiBase || !telegramApp?.initData) return Promise.resolve({});
+    return apiRequest('/api/progress')
+        .then(response => response.json())
+        .then(data => data.progress || {})
+        .catch(error => {
+            console.warn('Could not load saved progress:', error);
+            return {};
+        });
+}
+
+// Save the current case progress on the bot's side (debounced);
+// a finished case is saved with no days left, so it is not resumed
+function saveProgress(finished = false) {
+    if (!apiBase || !telegramApp?.initData || !gameState.currentCase) return;
+    
+    clearTimeout(progressTimer);
+    progressTimer = setTimeout(() => {
+        apiRequest('/api/progress', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                case_id: gameState.currentCase.id,
+                days_left: finished ? 0 : gameState.daysLeft,
+                killed_suspects: gameState.killedSuspects,
+                cases_solved: gameState.casesSolved
+            })
+        }).catch(error => console.warn('Could not save progress:', error));
+    }, PROGRESS_SAVE_DELAY);
+}
+
 // Initialize Telegram Mini App
 function initTelegramApp() {
     if (!telegramApp) {
@@ -150,6 +222,20 @@ function shareTelegramResults(results) {
         death_note_uses: results.deathNoteUses
     };
     
+    if (telegramApp.initDataUnsafe?.query_id) {
+        // Opened from an inline button: sendData is only available to keyboard buttons,
+        // so the results go through the bot's API instead
+        if (!apiBase) return;
+        apiRequest('/api/results', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(formattedResults)
+        })
+            .then(() => telegramApp.close())
+            .catch(error => console.error('Error sending results:', error));
+        return;
+    }
+    
     // Send to the bot via Telegram Mini App
     telegramApp.sendData(JSON.stringify(formattedResults));
 }
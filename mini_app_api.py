@@ -0,0 +1,538 @@
+"""
+Backend of the Death Note mini-app, served from the bot process.
+
+A small HTTP/1.1 server on asyncio (no web framework needed) runs in its own
+thread next to polling:
+
+    GET  /api/cases            case database (JSON)
+    GET  /api/cases/<id>       one case
+    GET  /api/progress         the player's saved progress
+    POST /api/progress         save progress for one case
+    POST /api/results          record a finished game
+
+Case data is served with an ETag, so a WebView revalidating it gets a
+bodyless 304; when the URL carries the current catalog version
+(/api/cases?v=<version>, the bot adds it to the mini-app link) the response
+is marked immutable and never requested again. Bodies are gzipped once at
+load time.
+
+Player endpoints are authenticated with the Telegram init data the mini-app
+sends as "Authorization: tma <initData>". Its HMAC is checked once per
+distinct init data string and the result kept in an LRU cache, since a
+WebView sends the same string with every request of a session.
+
+Progress is written like the user registry: saves only replace an entry in
+memory, and a background thread writes dirty entries to SQLite in one
+transaction every few seconds, so a player clicking through a case costs one
+row write. Game results (also arriving as web_app_data messages) are written
+right away. SQLite is only touched from a small thread pool, never on the
+event loop, so a slow write does not hold up other connections.
+"""
+
+import asyncio
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qsl, urlsplit
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS game_progress (
+    user_id INTEGER NOT NULL,
+    case_id INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (user_id, case_id)
+);
+CREATE TABLE IF NOT EXISTS game_results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    case_id INTEGER NOT NULL,
+    solved INTEGER NOT NULL,
+    score INTEGER NOT NULL,
+    days_used INTEGER NOT NULL,
+    death_note_uses INTEGER NOT NULL,
+    source TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS game_results_by_user ON game_results (user_id);
+"""
+
+UPSERT_PROGRESS = """
+INSERT INTO game_progress (user_id, case_id, state, updated) VALUES (?, ?, ?, ?)
+ON CONFLICT (user_id, case_id) DO UPDATE
+SET state = excluded.state, updated = excluded.updated
+WHERE excluded.updated >= game_progress.updated
+"""
+
+MAX_BODY = 16 * 1024
+KEEPALIVE_TIMEOUT = 30
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+class InvalidInitData(ValueError):
+    """Init data that is malformed, wrongly signed or too old"""
+
+
+def _clamp(value, low, high):
+    try:
+        return min(high, max(low, int(value)))
+    except (TypeError, ValueError):
+        return low
+
+
+def normalize_result(data):
+    """Game result dict from a mini-app payload, or None if it is not one.
+
+    Accepts the share_game_results payload of telegramApp.js and the older
+    share_results one.
+    """
+    if not isinstance(data, dict):
+        return None
+    if data.get("action") == "share_game_results":
+        solved = data.get("solved")
+    elif data.get("action") == "share_results":
+        solved = data.get("case_solved")
+    else:
+        return None
+    return {
+        "case_id": _clamp(data.get("case_id", 1), 1, 10 ** 6),
+        "solved": bool(solved),
+        "score": _clamp(data.get("score", 0), 0, 10 ** 6),
+        "days_used": _clamp(data.get("days_used", 0), 0, 1000),
+        "death_note_uses": _clamp(data.get("death_note_uses", 0), 0, 1000),
+    }
+
+
+def normalize_progress(data):
+    """Progress entry (case_id, state dict) from a POST /api/progress body"""
+    if not isinstance(data, dict) or "case_id" not in data:
+        raise ValueError("case_id is required")
+    killed = data.get("killed_suspects") or []
+    if not isinstance(killed, list):
+        raise ValueError("killed_suspects must be a list")
+    state = {
+        "days_left": _clamp(data.get("days_left", 0), -1000, 1000),
+        "killed_suspects": [str(name)[:100] for name in killed[:20]],
+        "cases_solved": _clamp(data.get("cases_solved", 0), 0, 10 ** 6),
+    }
+    return _clamp(data["case_id"], 1, 10 ** 6), state
+
+
+class InitDataValidator:
+    """Checks Telegram Web App init data, caching verified strings.
+
+    See https://core.telegram.org/bots/webapps#validating-data-received-via-the-mini-app
+    """
+
+    def __init__(self, bot_token, max_age=24 * 3600, cache_size=10000):
+        self.max_age = max_age
+        self.cache_size = cache_size
+        self._secret = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+        # init data string -> (user dict, auth_date)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"verified": 0, "cache_hits": 0, "rejected": 0}
+
+    def validate(self, init_data, now=None):
+        """The Telegram user dict from `init_data`; raises InvalidInitData"""
+        now = now or time.time()
+        with self._lock:
+            entry = self._cache.get(init_data)
+            if entry is not None:
+                self._cache.move_to_end(init_data)
+                self._stats["cache_hits"] += 1
+        if entry is None:
+            entry = self._verify(init_data)
+            with self._lock:
+                self._cache[init_data] = entry
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        user, auth_date = entry
+        if now - auth_date > self.max_age:
+            with self._lock:
+                self._stats["rejected"] += 1
+            raise InvalidInitData("init data expired")
+        return user
+
+    def _verify(self, init_data):
+        try:
+            fields = dict(parse_qsl(init_data, keep_blank_values=True, strict_parsing=True))
+        except ValueError:
+            fields = {}
+        received = fields.pop("hash", "")
+        data_check_string = "\n".join(f"{key}={fields[key]}" for key in sorted(fields))
+        expected = hmac.new(self._secret, data_check_string.encode(), hashlib.sha256).hexdigest()
+        if not received or not hmac.compare_digest(expected, received):
+            with self._lock:
+                self._stats["rejected"] += 1
+            raise InvalidInitData("bad signature")
+        try:
+            user = json.loads(fields["user"])
+            auth_date = int(fields["auth_date"])
+            user["id"] = int(user["id"])
+        except (KeyError, TypeError, ValueError):
+            raise InvalidInitData("no user in init data")
+        with self._lock:
+            self._stats["verified"] += 1
+        return user, auth_date
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cached"] = len(self._cache)
+        return stats
+
+
+class CaseCatalog:
+    """Case database with precomputed bodies, gzipped bodies and ETags"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, encoding="utf-8") as f:
+            cases = json.load(f)
+        self.all = self._entry(cases)
+        self.by_id = {str(case["id"]): self._entry(case) for case in cases}
+        # Short content hash of the whole catalog, used in immutable URLs
+        self.version = self.all["etag"].strip('"')[:12]
+
+    @staticmethod
+    def _entry(data):
+        body = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        return {"body": body, "gzip": gzip.compress(body, 9, mtime=0), "etag": etag}
+
+
+class GameStore:
+    """Mini-app progress (write-coalesced) and game results in SQLite"""
+
+    def __init__(self, path, flush_interval=5.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        # (user_id, case_id) -> (user_id, case_id, state json, updated)
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stats = {"progress_saves": 0, "rows_written": 0, "flushes": 0, "results": 0}
+        self._stop = threading.Event()
+        # The database is created by the first query and the flush thread by the first write,
+        # so importing the bot touches no files and starts no threads
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+        self._thread = None
+
+    def connection(self):
+        """Per-thread SQLite connection"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        if not self._schema_ready:
+            with self._schema_lock:
+                if not self._schema_ready:
+                    connection.executescript(SCHEMA)
+                    connection.commit()
+                    self._schema_ready = True
+        return connection
+
+    def save_progress(self, user_id, case_id, state, when=None):
+        """Remember progress on a case; written on the next flush"""
+        row = (user_id, case_id, json.dumps(state, ensure_ascii=False), when or time.time())
+        with self._lock:
+            self._dirty[(user_id, case_id)] = row
+            self._stats["progress_saves"] += 1
+            start_thread = self.flush_interval and self._thread is None and not self._stop.is_set()
+            if start_thread:
+                self._thread = threading.Thread(target=self._flush_loop, name="game-store-flush", daemon=True)
+        if start_thread:
+            self._thread.start()
+        elif not self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Write all dirty progress in one transaction; returns the number of rows written"""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._dirty = list(self._dirty.values()), {}
+            if not rows:
+                return 0
+            connection = self.connection()
+            try:
+                with connection:
+                    connection.executemany(UPSERT_PROGRESS, rows)
+            except sqlite3.Error as e:
+                logger.error(f"Error flushing {len(rows)} progress rows: {e}")
+                with self._lock:
+                    for row in rows:
+                        self._dirty.setdefault(row[:2], row)
+                return 0
+            with self._lock:
+                self._stats["rows_written"] += len(rows)
+                self._stats["flushes"] += 1
+            return len(rows)
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """Stop the flush thread and write what is left"""
+        self._stop.set()
+        self.flush()
+
+    def progress(self, user_id):
+        """{case_id: state} for a user, including saves not flushed yet"""
+        rows = self.connection().execute(
+            "SELECT case_id, state, updated FROM game_progress WHERE user_id = ?", (user_id,)
+        ).fetchall()
+        with self._lock:
+            rows += [(row[1], row[2], row[3]) for key, row in self._dirty.items() if key[0] == user_id]
+        progress = {}
+        # Unflushed rows come last and win unless older
+        for case_id, state, updated in sorted(rows, key=lambda row: row[2]):
+            progress[case_id] = dict(json.loads(state), updated=updated)
+        return progress
+
+    def record_result(self, user_id, result, source):
+        """Store a normalize_result() dict; returns the player's totals"""
+        connection = self.connection()
+        with connection:
+            connection.execute(
+                "INSERT INTO game_results (user_id, case_id, solved, score, days_used, death_note_uses, source, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (user_id, result["case_id"], int(result["solved"]), result["score"], result["days_used"],
+                 result["death_note_uses"], source, time.time()),
+            )
+        with self._lock:
+            self._stats["results"] += 1
+        return self.totals(user_id)
+
+    def totals(self, user_id):
+        games, solved, best = self.connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(solved), 0), COALESCE(MAX(score), 0) FROM game_results WHERE user_id = ?",
+            (user_id,),
+        ).fetchone()
+        return {"games": games, "solved": solved, "best_score": best}
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["dirty"] = len(self._dirty)
+        return stats
+
+
+class MiniAppAPI:
+    """HTTP API of the mini-app on an asyncio server in a background thread"""
+
+    def __init__(self, validator, catalog, store, on_result=None, allowed_origin="*"):
+        # on_result(user dict, result, totals) runs off the event loop, e.g. to message the player
+        self.validator = validator
+        self.catalog = catalog
+        self.store = store
+        self.on_result = on_result
+        self.allowed_origin = allowed_origin
+        self.port = None
+        self._loop = None
+        self._server = None
+        self._closed = None
+        self._writers = set()
+        self._thread = None
+        self._notify = ThreadPoolExecutor(max_workers=2, thread_name_prefix="mini-app-notify")
+        # Store calls run here, off the event loop
+        self._db = ThreadPoolExecutor(max_workers=4, thread_name_prefix="mini-app-db")
+        self._stats = {"requests": 0, "not_modified": 0}
+
+    # --- server ------------------------------------------------------------
+
+    def start(self, host="0.0.0.0", port=8080):
+        """Start serving in a background thread; returns the bound port"""
+        started = threading.Event()
+        errors = []
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            try:
+                self._server = self._loop.run_until_complete(
+                    asyncio.start_server(self._handle_connection, host, port))
+            except OSError as e:
+                errors.append(e)
+                started.set()
+                return
+            self.port = self._server.sockets[0].getsockname()[1]
+            self._closed = self._loop.create_future()
+            started.set()
+            self._loop.run_until_complete(self._closed)
+            self._server.close()
+            # Close idle keep-alive connections; their handlers then see EOF and return
+            for writer in list(self._writers):
+                writer.close()
+            pending = asyncio.all_tasks(self._loop)
+            self._loop.run_until_complete(asyncio.wait(pending, timeout=1) if pending else asyncio.sleep(0))
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="mini-app-api", daemon=True)
+        self._thread.start()
+        started.wait()
+        if errors:
+            raise errors[0]
+        logger.info(f"Mini-app API listening on {host}:{self.port}")
+        return self.port
+
+    def stop(self):
+        """Stop accepting requests and write buffered progress"""
+        if self._loop is not None and self._server is not None:
+            self._loop.call_soon_threadsafe(self._closed.set_result, None)
+            self._thread.join(timeout=5)
+        self._db.shutdown(wait=True)
+        self._notify.shutdown(wait=True)
+        self.store.close()
+
+    async def _handle_connection(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), KEEPALIVE_TIMEOUT)
+                if not request_line:
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                if length > MAX_BODY:
+                    writer.write(self._response(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"error": "body too large"},
+                                                keep_alive=False))
+                    await writer.drain()
+                    break
+                body = await reader.readexactly(length) if length else b""
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                writer.write(await self.dispatch(method, target, headers, body, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    # --- routing -----------------------------------------------------------
+
+    async def _in_db_thread(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._db, fn, *args)
+
+    async def dispatch(self, method, target, headers, body=b"", keep_alive=True):
+        """Handle one request; returns the raw HTTP response"""
+        self._stats["requests"] += 1
+        url = urlsplit(target)
+        path = url.path.rstrip("/")
+        if method == "OPTIONS":
+            # CORS preflight: the mini-app is served from another origin
+            return self._response(HTTPStatus.NO_CONTENT, None, keep_alive, extra={
+                "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+                "Access-Control-Allow-Headers": "Authorization, Content-Type",
+                "Access-Control-Max-Age": "86400",
+            })
+        try:
+            if method == "GET" and path == "/api/cases":
+                return self._static(self.catalog.all, headers, dict(parse_qsl(url.query)).get("v"), keep_alive)
+            if method == "GET" and path.startswith("/api/cases/"):
+                entry = self.catalog.by_id.get(path.rsplit("/", 1)[1])
+                if entry is None:
+                    return self._response(HTTPStatus.NOT_FOUND, {"error": "no such case"}, keep_alive)
+                return self._static(entry, headers, dict(parse_qsl(url.query)).get("v"), keep_alive)
+            if path in ("/api/progress", "/api/results"):
+                user = self._authenticate(headers)
+                if method == "GET" and path == "/api/progress":
+                    progress = await self._in_db_thread(self.store.progress, user["id"])
+                    return self._response(HTTPStatus.OK, {"progress": progress}, keep_alive)
+                if method == "POST" and path == "/api/progress":
+                    case_id, state = normalize_progress(json.loads(body or b"{}"))
+                    await self._in_db_thread(self.store.save_progress, user["id"], case_id, state)
+                    return self._response(HTTPStatus.ACCEPTED, {"ok": True}, keep_alive)
+                if method == "POST" and path == "/api/results":
+                    result = normalize_result(json.loads(body or b"{}"))
+                    if result is None:
+                        raise ValueError("not a game result")
+                    totals = await self._in_db_thread(self.record_result, user, result, "api")
+                    return self._response(HTTPStatus.OK, {"ok": True, "totals": totals}, keep_alive)
+                return self._response(HTTPStatus.METHOD_NOT_ALLOWED, {"error": "method not allowed"}, keep_alive)
+            return self._response(HTTPStatus.NOT_FOUND, {"error": "not found"}, keep_alive)
+        except InvalidInitData as e:
+            return self._response(HTTPStatus.UNAUTHORIZED, {"error": str(e)}, keep_alive)
+        except ValueError as e:
+            return self._response(HTTPStatus.BAD_REQUEST, {"error": str(e)}, keep_alive)
+        except Exception as e:
+            logger.error(f"Mini-app API error on {method} {target}: {e}", exc_info=True)
+            return self._response(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "internal error"}, keep_alive)
+
+    def _authenticate(self, headers):
+        scheme, _, init_data = headers.get("authorization", "").partition(" ")
+        if scheme.lower() != "tma" or not init_data:
+            raise InvalidInitData("missing init data")
+        return self.validator.validate(init_data)
+
+    def record_result(self, user, result, source):
+        """Store a game result and notify on_result in the background; returns the player's totals"""
+        totals = self.store.record_result(user["id"], result, source)
+        if self.on_result is not None:
+            self._notify.submit(self._run_on_result, user, result, totals)
+        return totals
+
+    def _run_on_result(self, user, result, totals):
+        try:
+            self.on_result(user, result, totals)
+        except Exception as e:
+            logger.error(f"Game result notification failed: {e}")
+
+    def _static(self, entry, headers, version, keep_alive):
+        cache_control = IMMUTABLE if version == self.catalog.version else "no-cache"
+        extra = {"ETag": entry["etag"], "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+        if entry["etag"] in headers.get("if-none-match", ""):
+            self._stats["not_modified"] += 1
+            return self._response(HTTPStatus.NOT_MODIFIED, None, keep_alive, extra=extra)
+        if "gzip" in headers.get("accept-encoding", ""):
+            extra["Content-Encoding"] = "gzip"
+            return self._response(HTTPStatus.OK, entry["gzip"], keep_alive, extra=extra)
+        return self._response(HTTPStatus.OK, entry["body"], keep_alive, extra=extra)
+
+    def _response(self, status, payload, keep_alive, extra=None):
+        if payload is None:
+            body = b""
+        elif isinstance(payload, bytes):
+            body = payload
+        else:
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        lines = [
+            f"HTTP/1.1 {status.value} {status.phrase}",
+            f"Content-Length: {len(body)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+            f"Access-Control-Allow-Origin: {self.allowed_origin}",
+        ]
+        if body:
+            lines.append("Content-Type: application/json; charset=utf-8")
+        for name, value in (extra or {}).items():
+            lines.append(f"{name}: {value}")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats.update({f"init_data_{key}": value for key, value in self.validator.stats().items()})
+        stats.update({f"store_{key}": value for key, value in self.store.stats().items()})
+        return stats
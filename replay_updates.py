@@ -0,0 +1,225 @@
+"""
+Replays a recording made with update_recorder.py against the bot's real
+handlers, with Telegram, Gemini and Hugging Face replaced by the local
+stand-ins from fake_upstreams.py.
+
+Updates are fed in at their recorded pace (--speed 1), accelerated
+(--speed 10) or as fast as possible (--speed 0). Every handler is timed and
+the report shows, per handler, the execution time and the end-to-end time
+from dispatch (including waiting for a free worker thread).
+
+Usage:
+    python replay_updates.py updates.jsonl.gz --speed 20 --gemini 0.8,0.4 --json replay.json
+"""
+
+import argparse
+import importlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from fake_upstreams import LatencyProfile, point_bot_environment, start_fake_upstreams, stop_fake_upstreams
+from load_test import latency_summary
+from update_recorder import read_recording
+
+HANDLER_LISTS = ("message_handlers", "edited_message_handlers", "inline_handlers", "callback_query_handlers")
+
+
+class HandlerTimer:
+    """Wraps the bot's registered handlers and records how long each one takes"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.execution = defaultdict(list)
+        self.end_to_end = defaultdict(list)
+        self.failures = defaultdict(int)
+        self.in_flight = 0
+
+    def mark_dispatched(self, update):
+        now = time.perf_counter()
+        for key in ("message", "edited_message", "inline_query"):
+            obj = getattr(update, key, None)
+            if obj is not None:
+                obj._replay_dispatched_at = now
+
+    def wrap(self, name, func):
+        def timed(obj, *args, **kwargs):
+            start = time.perf_counter()
+            with self.lock:
+                self.in_flight += 1
+            try:
+                return func(obj, *args, **kwargs)
+            except Exception:
+                with self.lock:
+                    self.failures[name] += 1
+                raise
+            finally:
+                end = time.perf_counter()
+                dispatched = getattr(obj, "_replay_dispatched_at", start)
+                with self.lock:
+                    self.in_flight -= 1
+                    self.execution[name].append(end - start)
+                    self.end_to_end[name].append(end - dispatched)
+
+        timed.__name__ = getattr(func, "__name__", name)
+        return timed
+
+    def install(self, bot):
+        for list_name in HANDLER_LISTS:
+            for handler in getattr(bot, list_name, []):
+                name = handler["function"].__name__
+                handler["function"] = self.wrap(name, handler["function"])
+
+    def idle(self):
+        with self.lock:
+            return self.in_flight == 0
+
+
+def wait_until_drained(bot, timer, timeout):
+    """Wait for the worker pool queue to empty and all handlers to finish"""
+    deadline = time.monotonic() + timeout
+    quiet_since = None
+    while time.monotonic() < deadline:
+        pool = getattr(bot, "worker_pool", None)
+        queue_empty = pool is None or pool.tasks.empty()
+        if queue_empty and timer.idle():
+            quiet_since = quiet_since or time.monotonic()
+            if time.monotonic() - quiet_since > 0.3:
+                return True
+        else:
+            quiet_since = None
+        time.sleep(0.02)
+    return False
+
+
+def run_replay(args):
+    telegram, gemini, huggingface = start_fake_upstreams(
+        LatencyProfile.parse(args.telegram, seed=args.seed),
+        LatencyProfile.parse(args.gemini, seed=args.seed + 1),
+        LatencyProfile.parse(args.hf, seed=args.seed + 2),
+    )
+
+    entries = list(read_recording(args.recording))
+    if not entries:
+        raise SystemExit(f"No updates found in {args.recording}")
+    header = entries[0][0]
+    if header.get("bot_id"):
+        telegram.bot_id = header["bot_id"]
+    if header.get("bot_username"):
+        telegram.bot_username = header["bot_username"]
+
+    point_bot_environment(telegram, gemini, huggingface, os.environ)
+    os.chdir(tempfile.mkdtemp(prefix="ruke-replay-"))
+    bot_module = importlib.import_module("simple_ruke_bot")
+    if args.quiet:
+        import logging
+        logging.getLogger().setLevel(logging.WARNING)
+
+    from telebot.types import Update
+
+    bot_module.BOT_USERNAME = telegram.bot_username
+    bot_module.BOT_ID = telegram.bot_id
+    bot_module.init_model()
+
+    timer = HandlerTimer()
+    timer.install(bot_module.bot)
+
+    first_ts = entries[0][1]["ts"]
+    started = time.perf_counter()
+    for _, entry in entries[:args.limit or None]:
+        if args.speed > 0:
+            target = started + (entry["ts"] - first_ts) / args.speed
+            delay = target - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        update = Update.de_json(entry["update"])
+        timer.mark_dispatched(update)
+        bot_module.bot.process_new_updates([update])
+
+    drained = wait_until_drained(bot_module.bot, timer, args.timeout)
+    elapsed = time.perf_counter() - started
+
+    with timer.lock:
+        handlers = {
+            name: {
+                "execution": latency_summary(timer.execution[name]),
+                "end_to_end": latency_summary(timer.end_to_end[name]),
+                "failures": timer.failures.get(name, 0),
+            }
+            for name in sorted(timer.execution)
+        }
+
+    report = {
+        "recording": args.recording,
+        "updates": min(len(entries), args.limit or len(entries)),
+        "recorded_span_seconds": entries[-1][1]["ts"] - first_ts,
+        "speed": args.speed,
+        "elapsed_seconds": elapsed,
+        "drained": drained,
+        "handlers": handlers,
+        "upstream_calls": {
+            "telegram": telegram.stats(),
+            "gemini": gemini.stats(),
+            "huggingface": huggingface.stats(),
+        },
+    }
+    stop_fake_upstreams(telegram, gemini, huggingface)
+    return report
+
+
+def print_report(report):
+    print("====================================================")
+    print(f"Replay of {report['recording']}")
+    print("====================================================")
+    print(f"Updates:   {report['updates']} (recorded over {report['recorded_span_seconds']:.0f} s)")
+    speed = "max" if not report["speed"] else f"{report['speed']}x"
+    print(f"Speed:     {speed}, took {report['elapsed_seconds']:.2f} s"
+          f"{'' if report['drained'] else ' (timed out before all handlers finished)'}")
+    print("Handler latency (execution / end-to-end):")
+    for name, stats in report["handlers"].items():
+        execution, end_to_end = stats["execution"], stats["end_to_end"]
+        print(f"  {name:<24} n={execution['count']:<5} "
+              f"p50={execution['p50']*1000:.0f}/{end_to_end['p50']*1000:.0f}ms "
+              f"p95={execution['p95']*1000:.0f}/{end_to_end['p95']*1000:.0f}ms "
+              f"p99={execution['p99']*1000:.0f}/{end_to_end['p99']*1000:.0f}ms "
+              f"failures={stats['failures']}")
+    print("Upstream calls:")
+    for name, stats in report["upstream_calls"].items():
+        print(f"  {name:>12}: {stats['calls']} errors={stats['errors']}")
+    print("====================================================")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded updates against the bot's handlers")
+    parser.add_argument("recording", help="File written by update_recorder.py (RECORD_UPDATES_PATH)")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed factor (0 = as fast as possible)")
+    parser.add_argument("--limit", type=int, default=0, help="Only replay the first N updates")
+    parser.add_argument("--telegram", default="0.02,0.3", help="Telegram latency: median[,sigma[,error_rate[,codes]]]")
+    parser.add_argument("--gemini", default="0.8,0.4", help="Gemini latency: median[,sigma[,error_rate[,codes]]]")
+    parser.add_argument("--hf", default="3,0.3", help="Hugging Face latency: median[,sigma[,error_rate[,codes]]]")
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds to wait for handlers after the last update")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for upstream latency")
+    parser.add_argument("--json", help="Also write the report to this JSON file")
+    parser.add_argument("--quiet", action="store_true", help="Only log warnings and errors from the bot")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    args.recording = os.path.abspath(args.recording)
+    json_path = os.path.abspath(args.json) if args.json else None
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    report = run_replay(args)
+    print_report(report)
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Report saved to {json_path}")
+
+
+if __name__ == "__main__":
+    main()
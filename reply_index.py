@@ -0,0 +1,313 @@
+"""
+Offline reply engine: finds the past Ryuk reply whose question best matches
+a new message.
+
+Exchanges (what a user wrote, what Ryuk answered) are collected in an
+append-only log (EXCHANGE_LOG_PATH) and compiled into a compact inverted
+index file (REPLY_INDEX_PATH):
+
+    python reply_index.py build ruke_exchanges.jsonl --store sqlite:///ruke_state.db
+    python reply_index.py query "как дела?"
+
+The bot memory-maps the index at startup and uses it when Gemini is not
+available and when too many LLM calls are already in flight. A lookup reads
+a bounded slice of a few postings lists straight from the mapped file, so it
+stays well under a millisecond even with 100k replies and the index costs
+almost no memory.
+
+Index layout (little-endian):
+    header   magic, doc count, term count, section offsets
+    terms    sorted (term hash u64, postings offset u32, postings length u32, idf f32)
+    postings doc ids (u32)
+    docs     (reply offset u32, reply length u32)
+    norms    1/sqrt(terms in the question) per document (f32)
+    replies  UTF-8 text
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import math
+import mmap
+import operator
+import os
+import re
+import struct
+import threading
+import time
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"RUKEIDX1"
+HEADER = struct.Struct("<8sIIIIIII")
+TERM = struct.Struct("<QIIf")
+DOC = struct.Struct("<II")
+
+# Words are cut to this many characters, a crude stemmer that makes
+# "яблоко", "яблоки" and "яблоками" the same term
+STEM_LENGTH = 5
+# Terms in more than this share of documents carry no signal and are not indexed
+MAX_DOC_FREQUENCY = 0.2
+# Upper bound on postings read per lookup (rarest terms first), keeps lookups
+# well under a millisecond on large indexes
+MAX_POSTINGS_SCANNED = 800
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+HUMAN_PREFIX = "Человек: "
+RYUK_PREFIX = "Рюк: "
+
+
+def tokenize(text):
+    """Lowercased, prefix-stemmed words of `text` (commands and mentions removed)"""
+    words = []
+    for word in WORD_RE.findall(re.sub(r"[/@]\w+", " ", text.lower())):
+        if len(word) > 1 and not word.isdigit():
+            words.append(word[:STEM_LENGTH])
+    return words
+
+
+def term_hash(term):
+    return int.from_bytes(hashlib.blake2b(term.encode(), digest_size=8).digest(), "little")
+
+
+def exchanges_from_history(lines):
+    """Pair stored "Человек: ..." lines with the "Рюк: ..." line that follows them"""
+    pairs = []
+    question = None
+    for line in lines:
+        if line.startswith(HUMAN_PREFIX):
+            question = line[len(HUMAN_PREFIX):]
+        elif line.startswith(RYUK_PREFIX) and question:
+            pairs.append((question, line[len(RYUK_PREFIX):]))
+            question = None
+    return pairs
+
+
+def read_exchange_log(path):
+    """(human, reply) pairs from a log written by ExchangeLog"""
+    pairs = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A partly written last line after a crash
+                continue
+            if entry.get("human") and entry.get("reply"):
+                pairs.append((entry["human"], entry["reply"]))
+    return pairs
+
+
+def read_store_exchanges(store):
+    """(human, reply) pairs from the conversation history kept by a conversation store"""
+    pairs = []
+    for _, _, messages in store.histories():
+        pairs.extend(exchanges_from_history(messages))
+    return pairs
+
+
+class ExchangeLog:
+    """Append-only JSONL log of human message / Ryuk reply pairs"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8", buffering=1)
+
+    def append(self, human, reply):
+        line = json.dumps({"ts": int(time.time()), "human": human, "reply": reply}, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def build_index(exchanges, path):
+    """Write an index over (human, reply) pairs to `path`; returns the number of documents"""
+    documents = []
+    seen = set()
+    for human, reply in exchanges:
+        reply = reply.strip()
+        terms = tokenize(human)
+        key = (tuple(terms), reply)
+        if not terms or not reply or key in seen:
+            continue
+        seen.add(key)
+        documents.append((terms, reply))
+
+    postings = defaultdict(list)
+    for doc_id, (terms, _) in enumerate(documents):
+        for term in set(terms):
+            postings[term].append(doc_id)
+
+    doc_count = len(documents)
+    lengths = [len(set(terms_of_doc)) for terms_of_doc, _ in documents]
+    terms = []
+    for term, doc_ids in postings.items():
+        # Shortest questions first: they score highest, and lookups may only read the head of a list
+        doc_ids.sort(key=lengths.__getitem__)
+        frequency = len(doc_ids)
+        if doc_count > 50 and frequency / doc_count > MAX_DOC_FREQUENCY:
+            continue
+        idf = math.log(1 + (doc_count - frequency + 0.5) / (frequency + 0.5))
+        terms.append((term_hash(term), doc_ids, idf))
+    terms.sort(key=lambda item: item[0])
+
+    term_table = bytearray()
+    postings_blob = bytearray()
+    for hashed, doc_ids, idf in terms:
+        term_table += TERM.pack(hashed, len(postings_blob) // 4, len(doc_ids), idf)
+        postings_blob += struct.pack(f"<{len(doc_ids)}I", *doc_ids)
+
+    doc_table = bytearray()
+    norms = bytearray()
+    replies_blob = bytearray()
+    for terms_of_doc, reply in documents:
+        encoded = reply.encode("utf-8")
+        doc_table += DOC.pack(len(replies_blob), len(encoded))
+        norms += struct.pack("<f", 1.0 / math.sqrt(len(set(terms_of_doc))))
+        replies_blob += encoded
+
+    terms_at = HEADER.size
+    postings_at = terms_at + len(term_table)
+    docs_at = postings_at + len(postings_blob)
+    norms_at = docs_at + len(doc_table)
+    replies_at = norms_at + len(norms)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, doc_count, len(terms), terms_at, postings_at, docs_at, norms_at, replies_at))
+        f.write(term_table)
+        f.write(postings_blob)
+        f.write(doc_table)
+        f.write(norms)
+        f.write(replies_blob)
+    os.replace(tmp_path, path)
+    return doc_count
+
+
+class ReplyIndex:
+    """Read-only, memory-mapped view of an index written by build_index"""
+
+    def __init__(self, path, min_score=0.5):
+        self.path = path
+        self.min_score = min_score
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.doc_count, self.term_count, self._terms_at, postings_at, self._docs_at, norms_at,
+         self._replies_at) = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a reply index")
+        view = memoryview(self._mmap)
+        self._postings = view[postings_at:self._docs_at].cast("I")
+        self._norms = view[norms_at:self._replies_at].cast("f")
+
+    @classmethod
+    def open_if_exists(cls, path):
+        """The index at `path`, or None if there is none or it can't be read"""
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            index = cls(path)
+        except (OSError, ValueError, struct.error) as e:
+            logger.error(f"Could not open reply index {path}: {e}")
+            return None
+        logger.info(f"Reply index loaded from {path}: {index.doc_count} replies, {index.term_count} terms")
+        return index
+
+    def __len__(self):
+        return self.doc_count
+
+    def _lookup(self, hashed):
+        """(postings offset, postings length, idf) of a term, by binary search in the mapped term table"""
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            entry = TERM.unpack_from(self._mmap, self._terms_at + middle * TERM.size)
+            if entry[0] < hashed:
+                low = middle + 1
+            elif entry[0] > hashed:
+                high = middle
+            else:
+                return entry[1:]
+        return None
+
+    def reply(self, doc_id):
+        offset, length = DOC.unpack_from(self._mmap, self._docs_at + doc_id * DOC.size)
+        start = self._replies_at + offset
+        return self._mmap[start:start + length].decode("utf-8")
+
+    def search(self, text):
+        """Best-matching past reply for `text` as (reply, score), or None"""
+        entries = [entry for entry in map(self._lookup, map(term_hash, set(tokenize(text)))) if entry]
+        if not entries:
+            return None
+        # Rarest terms first, so the scan budget goes to the most telling ones
+        entries.sort(key=lambda entry: entry[1])
+        scores = {}
+        get = scores.get
+        budget = MAX_POSTINGS_SCANNED
+        for offset, length, idf in entries:
+            take = min(length, budget)
+            doc_ids = self._postings[offset:offset + take].tolist()
+            if scores:
+                for doc_id in doc_ids:
+                    scores[doc_id] = get(doc_id, 0.0) + idf
+            else:
+                scores = dict.fromkeys(doc_ids, idf)
+                get = scores.get
+            budget -= take
+            if budget <= 0:
+                break
+        # score * norm for every candidate, computed without a Python-level loop
+        weighted = map(operator.mul, scores.values(), map(self._norms.__getitem__, scores))
+        best_score, best_doc = max(zip(weighted, scores))
+        if best_score < self.min_score:
+            return None
+        return self.reply(best_doc), best_score
+
+    def close(self):
+        self._postings.release()
+        self._norms.release()
+        self._mmap.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or query the offline reply index")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="Build the index from exchange logs and stored conversations")
+    build.add_argument("logs", nargs="*", help="Exchange log files (EXCHANGE_LOG_PATH)")
+    build.add_argument("--store", help="CONVERSATION_STORE to read stored conversations from, e.g. sqlite:///ruke_state.db")
+    build.add_argument("--output", default=os.getenv("REPLY_INDEX_PATH", "ruke_replies.idx"))
+    query = commands.add_parser("query", help="Look up the best past reply for a message")
+    query.add_argument("text")
+    query.add_argument("--index", default=os.getenv("REPLY_INDEX_PATH", "ruke_replies.idx"))
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        exchanges = []
+        for path in args.logs:
+            exchanges.extend(read_exchange_log(path))
+        if args.store:
+            from conversation_store import create_store
+            exchanges.extend(read_store_exchanges(create_store(args.store)))
+        started = time.time()
+        documents = build_index(exchanges, args.output)
+        print(f"Indexed {documents} replies from {len(exchanges)} exchanges into {args.output} "
+              f"({os.path.getsize(args.output)} bytes, {time.time() - started:.2f}s)")
+    else:
+        index = ReplyIndex(args.index)
+        started = time.perf_counter()
+        result = index.search(args.text)
+        elapsed = (time.perf_counter() - started) * 1e6
+        if result:
+            print(f"{result[0]}\n(score {result[1]:.2f}, {elapsed:.0f} us)")
+        else:
+            print(f"No match ({elapsed:.0f} us)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""
+Multi-process mode: one front process polls Telegram and hands every update
+to one of N worker processes, chosen by consistent hashing of the chat id.
+
+- All updates of a chat go to the same worker, and each worker handles its
+  queue one update at a time, so per-chat ordering is preserved.
+- Workers run the normal handlers from simple_ruke_bot.py; conversation
+  history lives in the shared store (CONVERSATION_STORE, SQLite by default
+  in this mode), so a chat can move to another worker without losing context.
+- The hash ring uses virtual nodes, so changing the worker count only moves
+  about 1/N of the chats.
+- An update is confirmed to Telegram only once it is in a worker's queue.
+  When a worker falls behind and its queue stays full for DISPATCH_TIMEOUT
+  seconds, the front stops confirming at that update and polls again, so
+  Telegram redelivers it instead of it being lost.
+- Workers handle updates inline, each in turn, so there is nothing to drain
+  on shutdown beyond the queues: the front stops polling, every worker
+  finishes its queue and runs the bot's shutdown hooks. Each worker traces
+  the updates it handles to its own TRACE_EXPORT_PATH file (traces.jsonl ->
+  traces.worker-0.jsonl, ...).
+
+Usage:
+    python sharded_runner.py --workers 4
+"""
+
+import argparse
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+from collections import Counter
+
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SHARED_STORE = "sqlite:///ruke_state.db"
+# Seconds to wait for room in a full worker queue before leaving an update for Telegram to redeliver
+DISPATCH_TIMEOUT = 10
+# Seconds to wait for room for the stop sentinel in a worker's queue before terminating the worker
+STOP_TIMEOUT = 5
+
+
+class ShardRing:
+    """Consistent hash ring mapping chat ids to worker indexes"""
+
+    def __init__(self, workers, replicas=64):
+        self.workers = workers
+        points = []
+        for worker in range(workers):
+            for replica in range(replicas):
+                points.append((self._hash(f"worker-{worker}-{replica}"), worker))
+        points.sort()
+        self._keys = [point for point, _ in points]
+        self._workers = [worker for _, worker in points]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+
+    def shard_for(self, key):
+        index = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._workers[index]
+
+
+def routing_key(update):
+    """Chat id of a raw update (user id for updates without a chat)"""
+    for field in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if update.get(field):
+            return update[field]["chat"]["id"]
+    callback = update.get("callback_query")
+    if callback and callback.get("message"):
+        return callback["message"]["chat"]["id"]
+    for field in ("inline_query", "chosen_inline_result", "callback_query", "my_chat_member", "chat_member"):
+        if update.get(field) and update[field].get("from"):
+            return update[field]["from"]["id"]
+    return update.get("update_id", 0)
+
+
+def worker_main(index, updates, bot_id, bot_username):
+    """Worker process: handle updates from `updates` one at a time until a None arrives"""
+    # Ctrl+C is handled by the front process, which stops us with a sentinel
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    import simple_ruke_bot as ruke
+    from telebot.types import Update
+
+    ruke.BOT_ID = bot_id
+    ruke.BOT_USERNAME = bot_username
+    # Handlers run inline so this worker's queue is processed strictly in order
+    ruke.bot.threaded = False
+    if ruke.tracer.export_path:
+        # One export file per process, so workers never interleave their writes
+        root, ext = os.path.splitext(ruke.tracer.export_path)
+        ruke.tracer.export_path = f"{root}.worker-{index}{ext}"
+    ruke.tracer.install(ruke.bot)
+
+    if ruke.init_model():
+        ruke.logger.info(f"Worker {index}: model initialized")
+    else:
+        ruke.logger.warning(f"Worker {index}: model initialization failed, falling back to offline mode")
+
+    handled = 0
+    while True:
+        item = updates.get()
+        if item is None:
+            break
+        try:
+            ruke.bot.process_new_updates([Update.de_json(item)])
+        except Exception as e:
+            ruke.logger.error(f"Worker {index}: error handling update {item.get('update_id')}: {e}", exc_info=True)
+        handled += 1
+    # Flush the user registry, game store and traces; the conversations are already in the shared store
+    ruke.lifecycle.run_shutdown_hooks()
+    ruke.logger.info(f"Worker {index} stopped after {handled} updates")
+
+
+def run(workers, stop_event=None, poll_timeout=20, queue_size=1000):
+    """Poll Telegram and dispatch updates to `workers` processes until `stop_event` is set"""
+    os.environ.setdefault("CONVERSATION_STORE", DEFAULT_SHARED_STORE)
+    if os.environ["CONVERSATION_STORE"] == "memory":
+        logger.warning("CONVERSATION_STORE=memory is not shared between workers; "
+                       "context is kept only while a chat stays on the same worker")
+
+    import simple_ruke_bot as ruke
+    from telebot import apihelper
+
+    stop_event = stop_event or threading.Event()
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+        signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+
+    bot_info = ruke.bot.get_me()
+    ruke.BOT_USERNAME = bot_info.username
+    ruke.BOT_ID = bot_info.id
+    logger.info(f"Bot information retrieved: @{bot_info.username} (ID: {bot_info.id})")
+    ruke.register_bot_commands()
+
+    if ruke.BROADCAST_ENABLED:
+        # Broadcasts run in the front process only, so users are messaged once
+        from broadcaster import start_scheduler
+        start_scheduler(ruke.create_broadcaster(), ruke.BROADCAST_INTERVAL_HOURS * 3600)
+
+    recorder = None
+    if ruke.RECORD_UPDATES_PATH:
+        from update_recorder import start_recording
+        recorder = start_recording(ruke.bot, ruke.RECORD_UPDATES_PATH, bot_info.id, bot_info.username)
+
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue(maxsize=queue_size) for _ in range(workers)]
+    processes = [
+        context.Process(target=worker_main, args=(i, queues[i], bot_info.id, bot_info.username),
+                        name=f"ruke-worker-{i}", daemon=True)
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    ring = ShardRing(workers)
+    dispatched = Counter()
+    stalled = Counter()
+
+    def dispatch(update):
+        """Queue `update` for its worker; returns False if the queue stayed full for DISPATCH_TIMEOUT"""
+        worker = ring.shard_for(routing_key(update))
+        try:
+            queues[worker].put(update, timeout=DISPATCH_TIMEOUT)
+        except queue.Full:
+            stalled[worker] += 1
+            logger.warning(f"Worker {worker} queue is still full after {DISPATCH_TIMEOUT}s; "
+                           f"update {update.get('update_id')} is left for Telegram to redeliver")
+            return False
+        if recorder:
+            recorder.record(update)
+        dispatched[worker] += 1
+        return True
+
+    def workers_alive():
+        dead = [p.name for p in processes if not p.is_alive()]
+        if dead:
+            logger.error(f"Worker processes exited unexpectedly: {dead}")
+        return not dead
+
+    offset = 0
+    backlog = []
+    if ruke.BACKLOG_TRIAGE:
+        from backlog_triage import triage_startup_backlog
+        backlog, backlog_offset, _ = triage_startup_backlog(ruke.TELEGRAM_TOKEN, ruke.create_backlog_triage())
+        offset = backlog_offset or 0
+    # The backlog is already confirmed, so keep retrying instead of leaving it to Telegram
+    for update in backlog:
+        while not dispatch(update) and not stop_event.is_set() and workers_alive():
+            pass
+    print(f"====================================================")
+    print(f"Bot @{bot_info.username} started with {workers} worker processes")
+    print(f"Conversation store: {os.environ['CONVERSATION_STORE']}")
+    print(f"Press Ctrl+C to exit")
+    print(f"====================================================")
+
+    try:
+        while not stop_event.is_set():
+            try:
+                updates = apihelper.get_updates(ruke.TELEGRAM_TOKEN, offset=offset or None, limit=100,
+                                                timeout=poll_timeout + 10, long_polling_timeout=poll_timeout)
+            except Exception as e:
+                logger.error(f"Error polling updates: {e}")
+                stop_event.wait(1)
+                continue
+            for update in updates:
+                if not dispatch(update):
+                    # Not confirmed: the next poll starts at this update again
+                    break
+                offset = max(offset, update["update_id"] + 1)
+            if not workers_alive():
+                break
+    finally:
+        for index, (q, process) in enumerate(zip(queues, processes)):
+            if not process.is_alive():
+                # Nobody reads this queue any more; don't wait on its feeder thread at exit
+                q.cancel_join_thread()
+                continue
+            try:
+                q.put(None, timeout=STOP_TIMEOUT)
+            except queue.Full:
+                logger.error(f"Worker {index} queue is still full, terminating it")
+                q.cancel_join_thread()
+                process.terminate()
+        for process in processes:
+            process.join(timeout=60)
+            if process.is_alive():
+                logger.error(f"{process.name} did not stop in time, terminating it")
+                process.terminate()
+                process.join(timeout=STOP_TIMEOUT)
+        if recorder:
+            recorder.flush()
+        logger.info(f"Front stopped; updates dispatched per worker: {dict(sorted(dispatched.items()))}")
+        if stalled:
+            logger.warning(f"Updates left for redelivery because a worker queue was full: "
+                           f"{dict(sorted(stalled.items()))}")
+    return dispatched
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the Ryuk bot with chat-sharded worker processes")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("BOT_WORKERS", "0")) or os.cpu_count() or 2,
+                        help="Number of worker processes (default: BOT_WORKERS or the CPU count)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    load_dotenv()
+    if not os.getenv("TELEGRAM_TOKEN"):
+        print("Error: TELEGRAM_TOKEN not set in environment variables")
+        sys.exit(1)
+    run(args.workers)
+
+
+if __name__ == "__main__":
+    main()
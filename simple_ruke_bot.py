@@ -1,16 +1,35 @@
 import os
+import json
 import logging
 import google.generativeai as genai
 from dotenv import load_dotenv
 import telebot
 from telebot.types import Message
 import time
-from collections import defaultdict
 import requests
 import io
+import math
 import random
 import urllib.parse
 import sys
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from update_recorder import start_recording
+from conversation_store import create_store
+from gemini_sessions import ChatSessionPool
+from lifecycle import Lifecycle
+from backlog_triage import BacklogTriage, triage_startup_backlog
+from reply_index import ReplyIndex, ExchangeLog
+from inline_answers import InlineAnswers, to_inline_results
+from chat_actions import ChatActions
+import tracing
+from tracing import Tracer
+import introspection
+from introspection import InFlight
+from mini_app_api import MiniAppAPI, InitDataValidator, CaseCatalog, GameStore, normalize_result
+from user_registry import UserRegistry
+from broadcaster import Broadcaster, PROACTIVE_PROMPT, start_scheduler
 
 try:
     from huggingface_hub import InferenceClient
@@ -34,6 +53,54 @@ GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 DEFAULT_LLM_MODEL = os.getenv("DEFAULT_LLM_MODEL", "gemini-pro")  # Fallback to gemini-pro if not specified
 HUGGINGFACE_API_KEY = os.getenv("HUGGINGFACE_API_KEY", "")  # Optional: For authenticated requests to Hugging Face
 
+# Optional endpoint overrides, e.g. to run against the local stand-ins in fake_upstreams.py
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")  # Format: http://host:port/bot{0}/{1}
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT", "")  # Uses the REST transport when set
+
+# Optional: record anonymized incoming updates for replay_updates.py (.gz for compressed)
+RECORD_UPDATES_PATH = os.getenv("RECORD_UPDATES_PATH", "")
+
+# Re-engagement broadcasts to idle users (see broadcaster.py)
+USERS_DB_PATH = os.getenv("USERS_DB_PATH", "ruke_users.db")
+BROADCAST_ENABLED = os.getenv("BROADCAST_ENABLED", "0") == "1"
+BROADCAST_INTERVAL_HOURS = float(os.getenv("BROADCAST_INTERVAL_HOURS", "5"))
+BROADCAST_IDLE_HOURS = float(os.getenv("BROADCAST_IDLE_HOURS", "5"))
+
+# Graceful shutdown and warm restart (see lifecycle.py)
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "ruke_snapshot.bin")
+SHUTDOWN_DEADLINE = float(os.getenv("SHUTDOWN_DEADLINE", "25"))
+
+# Startup triage of updates that queued up while the bot was down (see backlog_triage.py)
+BACKLOG_TRIAGE = os.getenv("BACKLOG_TRIAGE", "1") == "1"
+
+# Offline replies from past conversations (see reply_index.py)
+REPLY_INDEX_PATH = os.getenv("REPLY_INDEX_PATH", "ruke_replies.idx")
+EXCHANGE_LOG_PATH = os.getenv("EXCHANGE_LOG_PATH", "")  # Where to log exchanges for the index; off when empty
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "0"))  # Above this, answer from the index; 0 = no limit
+
+# Inline mode (see inline_answers.py)
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "300"))  # Seconds Telegram may cache an inline answer
+INLINE_DEBOUNCE = float(os.getenv("INLINE_DEBOUNCE", "0.7"))  # Typing pause before an inline query asks Gemini
+MAX_REMEMBERED_IMAGES = 50  # Per user
+
+# Death Note mini-app and its API (see mini_app_api.py)
+MINI_APP_URL = os.getenv("MINI_APP_URL", "https://example.com/death-note-game")
+MINI_APP_API_PORT = int(os.getenv("MINI_APP_API_PORT", "0"))  # 0 = API off
+MINI_APP_API_URL = os.getenv("MINI_APP_API_URL", "")  # Public base URL of the API, passed to the mini-app
+MINI_APP_CASES_PATH = os.getenv(
+    "MINI_APP_CASES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "mini-app", "src", "data", "cases.json")
+)
+
+# Per-update tracing (see tracing.py)
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "")  # OTLP/JSON lines; off when empty
+TRACE_SLOW_SECONDS = float(os.getenv("TRACE_SLOW_SECONDS", "10"))  # 0 = no slow-request log
+TRACE_SLOW_LOG_PATH = os.getenv("TRACE_SLOW_LOG_PATH", "ruke_slow_requests.log")
+
+# Telegram user ids allowed to see runtime internals and profile the bot with /debug (see introspection.py)
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "").replace(",", " ").split()}
+DEBUG_CAPTURE_SECONDS = float(os.getenv("DEBUG_CAPTURE_SECONDS", "10"))  # Default /debug profile|memory window
+DEBUG_CAPTURE_MAX_SECONDS = 60  # Upper bound an admin can ask for
+
 # Expanded list of models to try
 FALLBACK_MODELS = [
     "gemini-pro", 
@@ -48,7 +115,14 @@ FALLBACK_MODELS = [
 IMAGE_GENERATION_ENABLED = True
 
 # Using the SD 3.5 model that works with free tokens
-DEFAULT_SD_MODEL = "stabilityai/stable-diffusion-3.5-large"
+# (SD_MODEL may also be the URL of an Inference Endpoint)
+DEFAULT_SD_MODEL = os.getenv("SD_MODEL", "stabilityai/stable-diffusion-3.5-large")
+
+# At most this many text_to_image calls run at once; /draw N queues its variants here
+IMAGE_MAX_CONCURRENCY = int(os.getenv("IMAGE_MAX_CONCURRENCY", "2"))
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_MAX_CONCURRENCY, thread_name_prefix="image")
+# Largest N accepted by /draw N <prompt> (Telegram albums hold up to 10 photos)
+MAX_DRAW_VARIANTS = min(10, int(os.getenv("MAX_DRAW_VARIANTS", "4")))
 
 # Various style prompts to enhance images
 IMAGE_STYLE_PROMPTS = [
@@ -76,10 +150,18 @@ if HUGGINGFACE_API_KEY and HUGGINGFACE_AVAILABLE:
         hf_client = None
 
 # Configure Google Generative AI
-genai.configure(api_key=GOOGLE_API_KEY)
+if GEMINI_API_ENDPOINT:
+    genai.configure(api_key=GOOGLE_API_KEY, transport="rest", client_options={"api_endpoint": GEMINI_API_ENDPOINT})
+else:
+    genai.configure(api_key=GOOGLE_API_KEY)
+
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL
 
 # Initialize model globally to None, we'll set it during startup
 model = None
+# Name of the model that passed the startup probe
+active_model_name = None
 
 # Create bot instance using pyTelegramBotAPI
 bot = telebot.TeleBot(TELEGRAM_TOKEN)
@@ -89,11 +171,35 @@ BOT_USERNAME = None
 BOT_ID = None
 
 # Conversation tracking
-# Store chat history for each user/chat with timestamps
-# Format: {chat_id: {user_id: [(timestamp, "message"), ...]}}
-conversations = defaultdict(lambda: defaultdict(list))
+# Chat history for each user/chat lives in a pluggable store:
+# in-process by default, SQLite when several worker processes share it
+# (CONVERSATION_STORE=sqlite:///ruke_state.db, see sharded_runner.py)
+conversation_store = create_store(os.getenv("CONVERSATION_STORE", "memory"))
 # How long to remember conversation context (in seconds)
 CONVERSATION_TIMEOUT = 600  # 10 minutes
+# Guards the read-modify-write of the per-user lists of generated images in the store
+remembered_images_lock = threading.Lock()
+
+# Who talks to the bot and when, for re-engagement broadcasts;
+# updates are coalesced in memory and written every USERS_FLUSH_INTERVAL seconds
+user_registry = UserRegistry(USERS_DB_PATH, flush_interval=float(os.getenv("USERS_FLUSH_INTERVAL", "5")))
+atexit.register(user_registry.close)
+
+# Drains handlers on SIGTERM and carries conversations over restarts in a snapshot
+lifecycle = Lifecycle(bot, SNAPSHOT_PATH, deadline=SHUTDOWN_DEADLINE, pending_max_age=CONVERSATION_TIMEOUT)
+lifecycle.register_state("conversations", conversation_store.export_state, conversation_store.import_state)
+lifecycle.on_shutdown(user_registry.close)
+
+# A trace per update, exported as OTLP/JSON; slow updates get their span tree logged
+tracer = Tracer(TRACE_EXPORT_PATH, slow_seconds=TRACE_SLOW_SECONDS, slow_log_path=TRACE_SLOW_LOG_PATH)
+atexit.register(tracer.close)
+lifecycle.on_shutdown(tracer.close)
+
+# "typing…" / "sending photo…" while replies are worked on, refreshed before Telegram's 5s expiry
+chat_actions = ChatActions(
+    lambda chat_id, action: bot.send_chat_action(chat_id, action),
+    refresh=float(os.getenv("CHAT_ACTION_REFRESH", "4")),
+)
 
 # Ruke's personality prompts
 RUKE_SYSTEM_PROMPT = """
@@ -129,11 +235,35 @@ RUKE_SYSTEM_PROMPT = """
 ВАЖНО: ты создал мини-игру для Telegram, в которой люди могут играть роль Лайта Ягами и ловить преступников с помощью Тетради Смерти. Время от времени предлагай сыграть в эту игру, используя команду /play.
 """
 
+# Past replies, memory-mapped, for when Gemini is down or busy
+reply_index = ReplyIndex.open_if_exists(REPLY_INDEX_PATH)
+exchange_log = ExchangeLog(EXCHANGE_LOG_PATH) if EXCHANGE_LOG_PATH else None
+# Limits concurrent LLM calls; messages beyond it get an answer from the index (load shedding)
+llm_slots = threading.BoundedSemaphore(LLM_MAX_CONCURRENCY) if LLM_MAX_CONCURRENCY else None
+# Gemini calls and image renders running right now, and renders waiting for an image worker, for /debug
+llm_jobs = InFlight()
+image_jobs = InFlight()
+image_queue = InFlight()
+# One profile or memory capture at a time
+debug_capture_lock = threading.Lock()
+
+# Pool of per-conversation Gemini chat sessions with the persona as system instruction
+# (see gemini_sessions.py); sized by SESSION_POOL_SIZE, history bounded by MAX_SESSION_TURNS
+chat_sessions = ChatSessionPool(
+    RUKE_SYSTEM_PROMPT,
+    max_sessions=int(os.getenv("SESSION_POOL_SIZE", "1000")),
+    max_turns=int(os.getenv("MAX_SESSION_TURNS", "3")),
+    idle_timeout=CONVERSATION_TIMEOUT,
+    use_context_cache=os.getenv("GEMINI_CONTEXT_CACHE", "1") == "1",
+)
+lifecycle.on_shutdown(chat_sessions.close)
+
 def get_available_models():
     """List available models to help with debugging"""
     try:
-        models = genai.list_models()
-        model_names = [model.name for model in models]
+        with tracing.span("gemini.list_models", tracing.KIND_CLIENT):
+            models = genai.list_models()
+            model_names = [model.name for model in models]
         logger.info(f"Available models: {model_names}")
         return model_names
     except Exception as e:
@@ -142,31 +272,23 @@ def get_available_models():
 
 def get_conversation_history(chat_id, user_id):
     """Get recent conversation history for a specific user in a specific chat"""
-    current_time = time.time()
-    # Get messages not older than CONVERSATION_TIMEOUT
-    recent_messages = []
-    
-    for timestamp, message in conversations[chat_id][user_id]:
-        if current_time - timestamp <= CONVERSATION_TIMEOUT:
-            recent_messages.append(message)
-    
     # Only keep the most recent messages to avoid context overflow
-    return recent_messages[-5:] if recent_messages else []
+    return conversation_store.recent_messages(chat_id, user_id, CONVERSATION_TIMEOUT, limit=5)
 
 def add_to_conversation(chat_id, user_id, message):
-    """Add a message to the conversation history"""
-    current_time = time.time()
-    conversations[chat_id][user_id].append((current_time, message))
-    
-    # Clean up old messages
-    conversations[chat_id][user_id] = [
-        (ts, msg) for ts, msg in conversations[chat_id][user_id] 
-        if current_time - ts <= CONVERSATION_TIMEOUT
-    ]
+    """Add a message to the conversation history (old messages are cleaned up by the store)"""
+    conversation_store.append_message(chat_id, user_id, message, CONVERSATION_TIMEOUT)
 
 def init_model():
     """Initialize Gemini model with fallback options"""
-    global model
+    with tracing.span("gemini.init_model") as init_span:
+        initialized = probe_models()
+        init_span.set("model", active_model_name if initialized else "none")
+        return initialized
+
+def probe_models():
+    """Find a working model, the default one first; returns True on success"""
+    global model, active_model_name
     
     # Try to list available models for debugging
     available_models = get_available_models()
@@ -181,10 +303,13 @@ def init_model():
             logger.info(f"Trying to initialize model: {DEFAULT_LLM_MODEL}")
             model = genai.GenerativeModel(DEFAULT_LLM_MODEL)
             # Test the model with a simple prompt
-            response = model.generate_content("Test")
+            with tracing.span("gemini.probe", tracing.KIND_CLIENT, model=DEFAULT_LLM_MODEL):
+                response = model.generate_content("Test")
             # Check if response is valid
             if hasattr(response, 'text'):
                 logger.info(f"Successfully initialized model: {DEFAULT_LLM_MODEL}")
+                active_model_name = DEFAULT_LLM_MODEL
+                chat_sessions.reset(active_model_name)
                 return True
             else:
                 logger.error(f"Model returned invalid response format: {response}")
@@ -203,9 +328,12 @@ def init_model():
                 logger.info(f"Trying fallback model: {fallback_model}")
                 model = genai.GenerativeModel(fallback_model)
                 # Test the model with a simple prompt
-                response = model.generate_content("Test")
+                with tracing.span("gemini.probe", tracing.KIND_CLIENT, model=fallback_model):
+                    response = model.generate_content("Test")
                 if hasattr(response, 'text'):
                     logger.info(f"Successfully initialized fallback model: {fallback_model}")
+                    active_model_name = fallback_model
+                    chat_sessions.reset(active_model_name)
                     return True
                 else:
                     logger.error(f"Fallback model returned invalid response format: {response}")
@@ -219,7 +347,13 @@ def init_model():
     return False
 
 def simple_generate_response(text):
-    """Simple fallback when AI models are not available"""
+    """Simple fallback when AI models are not available: the best past reply, or a canned one"""
+    with tracing.span("gemini.fallback") as fallback:
+        match = reply_index.search(text) if reply_index is not None else None
+        fallback.set("source", "reply_index" if match else "canned")
+    if match:
+        return match[0]
+    
     responses = [
         "Ку-ку-ку! Я не могу связаться с мыслями шинигами. Может быть, это сила тетради смерти?",
         "Хе-хе-хе! Какие интересные люди. Ваша технология сейчас не работает, но мне всё равно забавно наблюдать за вами.",
@@ -231,54 +365,184 @@ def simple_generate_response(text):
     import random
     return random.choice(responses)
 
-def generate_response(user_input: str, chat_id=None, user_id=None) -> str:
-    """Generate response using Google Gemini model with Ruke's personality and conversation context"""
+def generate_response(user_input: str, chat_id=None, user_id=None, fallback=True) -> str:
+    """Generate response using Google Gemini model with Ruke's personality and conversation context.
+
+    When the model can't answer, returns a fallback reply, or None with fallback=False.
+    """
     global model
     
     # Initialize model if not already done
     if model is None and not init_model():
         logger.warning("Using fallback response system since model initialization failed")
-        return simple_generate_response(user_input)
+        return simple_generate_response(user_input) if fallback else None
     
-    try:
-        # Build context from conversation history if available
-        conversation_context = ""
-        if chat_id and user_id:
+    # Recent history is only used to rebuild a chat session that is not in the pool
+    history = []
+    if chat_id and user_id:
+        with tracing.span("history.fetch") as fetch:
             history = get_conversation_history(chat_id, user_id)
-            if history:
-                conversation_context = "Недавний разговор:\n" + "\n".join(history) + "\n\n"
-                
-        # Add the current message to history
-        if chat_id and user_id:
-            add_to_conversation(chat_id, user_id, f"Человек: {user_input}")
-            
-        # Prepare the prompt with context if available
-        prompt = f"{RUKE_SYSTEM_PROMPT}\n\n{conversation_context}Человек: {user_input}\n\nРюк:"
-        
-        response = model.generate_content(prompt)
-        response_text = response.text.strip() if hasattr(response, 'text') else simple_generate_response(user_input)
-        
-        # Add the response to conversation history
-        if chat_id and user_id:
-            add_to_conversation(chat_id, user_id, f"Рюк: {response_text}")
-            
-        return response_text
+            fetch.set("messages", len(history))
+    
+    # Too many LLM calls in flight: answer from past replies instead of queueing
+    if llm_slots is not None and not llm_slots.acquire(blocking=False):
+        logger.warning("LLM concurrency limit reached, answering from the reply index")
+        return simple_generate_response(user_input) if fallback else None
+    
+    try:
+        with tracing.span("gemini.chat", attempt=1), llm_jobs:
+            response_text = chat_sessions.send(chat_id, user_id, user_input, history)
     except Exception as e:
         logger.error(f"Error generating response: {e}")
+        response_text = None
         
         # If there was an error with the model, try to reinitialize
         try:
             logger.info("Attempting to reinitialize model after error")
             model = None
             if init_model():
-                # Try once more with the new model
-                prompt = f"{RUKE_SYSTEM_PROMPT}\n\nЧеловек: {user_input}\n\nРюк:"
-                response = model.generate_content(prompt)
-                return response.text.strip() if hasattr(response, 'text') else simple_generate_response(user_input)
+                # Try once more with the new model, keeping the conversation context
+                with tracing.span("gemini.chat", attempt=2), llm_jobs:
+                    response_text = chat_sessions.send(chat_id, user_id, user_input, history)
         except Exception as reinit_error:
             logger.error(f"Error in retry attempt: {reinit_error}")
-            
-        return simple_generate_response(user_input)
+    finally:
+        if llm_slots is not None:
+            llm_slots.release()
+    
+    if not response_text:
+        return simple_generate_response(user_input) if fallback else None
+    
+    # Add the exchange to conversation history; shed or failed turns are left out,
+    # so a rebuilt session never starts with an unanswered message
+    if chat_id and user_id:
+        add_to_conversation(chat_id, user_id, f"Человек: {user_input}")
+        add_to_conversation(chat_id, user_id, f"Рюк: {response_text}")
+    if exchange_log is not None:
+        exchange_log.append(user_input, response_text)
+        
+    return response_text
+
+def track_users(messages):
+    """Update listener: remember the sender of every incoming message"""
+    for message in messages:
+        if message.from_user and not message.from_user.is_bot:
+            try:
+                user_registry.record_interaction(message.from_user)
+            except Exception as e:
+                logger.error(f"Error recording user {message.from_user.id}: {e}")
+
+bot.set_update_listener(track_users)
+
+def generate_proactive_message(history):
+    """Generate a message that restarts the conversation after a long pause"""
+    if model is None and not init_model():
+        return None
+    if history:
+        context = "Последний разговор:\n" + "\n".join(history)
+    else:
+        context = "Собеседник давно молчит, о чем вы говорили - неизвестно."
+    response = model.generate_content(f"{PROACTIVE_PROMPT}\n{context}\n\nРюк:")
+    return response.text.strip()
+
+def create_broadcaster(dry_run=False):
+    """Broadcaster sending re-engagement messages through this bot"""
+    return Broadcaster(
+        user_registry,
+        send_message=bot.send_message,
+        generate_message=generate_proactive_message,
+        # Private chat id equals the user id; history older than the context window is still useful here
+        get_history=lambda user_id: conversation_store.recent_messages(
+            user_id, user_id, BROADCAST_IDLE_HOURS * 3600 * 4, limit=4),
+        idle_seconds=BROADCAST_IDLE_HOURS * 3600,
+        llm_concurrency=int(os.getenv("BROADCAST_LLM_CONCURRENCY", "4")),
+        send_lanes=int(os.getenv("BROADCAST_SEND_LANES", "4")),
+        send_rate=float(os.getenv("BROADCAST_SEND_RATE", "25")),
+        template_batch=int(os.getenv("BROADCAST_TEMPLATE_BATCH", "20")),
+        dry_run=dry_run,
+    )
+
+def create_backlog_triage():
+    """Backlog policy with the age thresholds from the environment"""
+    return BacklogTriage(
+        bot_id=BOT_ID,
+        bot_username=BOT_USERNAME,
+        fresh_seconds=float(os.getenv("BACKLOG_FRESH_SECONDS", "60")),
+        private_max_age=float(os.getenv("BACKLOG_PRIVATE_MAX_AGE", str(6 * 3600))),
+        group_max_age=float(os.getenv("BACKLOG_GROUP_MAX_AGE", "600")),
+        command_max_age=float(os.getenv("BACKLOG_COMMAND_MAX_AGE", "600")),
+    )
+
+def remember_image(user_id, prompt, file_id, seed=None):
+    """Keep the Telegram file_id of an image `user_id` generated, so it can be sent again without uploading"""
+    with remembered_images_lock:
+        images = conversation_store.get_value("images", user_id, [])
+        images = [image for image in images if image["file_id"] != file_id]
+        images.append({"prompt": prompt, "file_id": file_id, "seed": seed})
+        conversation_store.set_value("images", user_id, images[-MAX_REMEMBERED_IMAGES:])
+
+def recent_images(user_id):
+    """Images remembered for `user_id` by remember_image, newest first; only ever shown to that user"""
+    return list(reversed(conversation_store.get_value("images", user_id, [])))
+
+def search_past_replies(text):
+    """Best past reply for `text` from the reply index, or None"""
+    match = reply_index.search(text) if reply_index is not None else None
+    return match[0] if match else None
+
+def answer_inline_query(query_id, results, cache_time, is_personal=False):
+    bot.answer_inline_query(query_id, to_inline_results(results), cache_time=cache_time, is_personal=is_personal)
+
+# Cached, debounced answers to inline queries; only real Gemini replies are cached
+inline_answers = InlineAnswers(
+    generate=lambda text: generate_response(text, fallback=False),
+    answer=answer_inline_query,
+    search_replies=search_past_replies,
+    recent_images=recent_images,
+    debounce=INLINE_DEBOUNCE,
+    cache_time=INLINE_CACHE_TIME,
+    workers=int(os.getenv("INLINE_WORKERS", "4")),
+)
+lifecycle.register_state("inline_answers", inline_answers.export_state, inline_answers.import_state)
+
+# Mini-app game progress and results, next to the user registry
+game_store = GameStore(USERS_DB_PATH, flush_interval=float(os.getenv("GAME_FLUSH_INTERVAL", "5")))
+atexit.register(game_store.close)
+lifecycle.on_shutdown(game_store.close)
+mini_app_api = None
+
+def game_result_reply(result, totals):
+    """Ryuk's comment on a finished mini-app game"""
+    if result["solved"]:
+        text = (f"Ку-ку-ку... Дело #{result['case_id']} раскрыто за {result['days_used']} дн. "
+                f"Счёт: {result['score']}. Тетрадь смерти в хороших руках.")
+    else:
+        text = (f"Хе-хе-хе... Дело #{result['case_id']} провалено. "
+                f"L уже подбирается к тебе. Попробуй ещё раз: /play")
+    return f"{text}\nРаскрыто дел: {totals['solved']} из {totals['games']}, лучший счёт: {totals['best_score']}"
+
+def notify_game_result(user, result, totals):
+    """Reply in the player's private chat to results posted to the mini-app API"""
+    bot.send_message(user["id"], game_result_reply(result, totals))
+
+def mini_app_link():
+    """Mini-app URL with the API address and case catalog version, if the API is on"""
+    if not (mini_app_api and MINI_APP_API_URL):
+        return MINI_APP_URL
+    query = urllib.parse.urlencode({"api": MINI_APP_API_URL, "cases": mini_app_api.catalog.version})
+    return f"{MINI_APP_URL}{'&' if '?' in MINI_APP_URL else '?'}{query}"
+
+def start_mini_app_api():
+    """Serve the mini-app API on MINI_APP_API_PORT; returns the MiniAppAPI"""
+    api = MiniAppAPI(
+        validator=InitDataValidator(TELEGRAM_TOKEN),
+        catalog=CaseCatalog(MINI_APP_CASES_PATH),
+        store=game_store,
+        on_result=notify_game_result,
+        allowed_origin=os.getenv("MINI_APP_ALLOWED_ORIGIN", "*"),
+    )
+    api.start(os.getenv("MINI_APP_API_HOST", "0.0.0.0"), MINI_APP_API_PORT)
+    return api
 
 def log_message(message: Message):
     """Log message details for debugging"""
@@ -302,7 +566,7 @@ def handle_help(message: Message):
         "*Команды:*\n"
         "/start - Начать разговор с Рюком\n"
         "/help - Показать эту справку\n"
-        "/draw - Создать изображение (например: /draw яблоко смерти)\n"
+        "/draw - Создать изображение (например: /draw яблоко смерти, /draw 3 яблоко смерти)\n"
         "/play - Запустить игру 'Death Note: Justice Awaits'\n"
         "/image_info - Информация о генерации изображений\n"
         "/debug - Диагностическая информация\n\n"
@@ -319,19 +583,115 @@ def handle_help(message: Message):
     )
     bot.reply_to(message, help_text, parse_mode="Markdown")
 
+def hit_ratio_text(hits, total):
+    return f"{hits / total:.0%} of {total}" if total else "-"
+
+def runtime_report():
+    """Queue depths, running jobs, latencies, store size and cache hit ratios of this process"""
+    pool = getattr(bot, "worker_pool", None)
+    actions = chat_actions.stats()
+    llm = llm_jobs.stats()
+    images = image_jobs.stats()
+    lines = [
+        "Queues:",
+        f"  handlers {pool.tasks.qsize() if pool is not None else 0}, images {image_queue.stats()['running']}, "
+        f"trace export {tracer.stats()['queued']}, user writes {user_registry.stats()['dirty']}",
+        "In flight:",
+        f"  handlers {lifecycle.in_flight()}, LLM {llm['running']} (peak {llm['peak']}, total {llm['total']}), "
+        f"images {images['running']} (peak {images['peak']}, total {images['total']})",
+        f"  chat actions for {actions['active_chats']} chats, {threading.active_count()} threads",
+    ]
+
+    latencies = tracer.latencies()
+    if latencies:
+        lines.append(f"Latency p50 / p99 (last {tracer.latency_window}):")
+        for name, window in sorted(latencies.items(), key=lambda item: -item[1]["count"])[:12]:
+            lines.append(f"  {name}: {window['p50_ms']:.0f} / {window['p99_ms']:.0f} ms (n={window['count']})")
+
+    store = conversation_store.stats()
+    lines += [
+        f"Conversation store ({store['backend']}):",
+        f"  {store['users'] + store['values']} keys, {store['messages']} messages, ~{store['approx_bytes'] / 1024:,.0f} KB",
+    ]
+
+    sessions = chat_sessions.stats()
+    inline = inline_answers.stats()
+    users = user_registry.stats()
+    lines += [
+        "Cache hit ratios:",
+        f"  chat sessions {hit_ratio_text(sessions['sessions_reused'], sessions['sessions_created'] + sessions['sessions_reused'])}",
+        f"  inline answers {hit_ratio_text(inline['cache_hits'], inline['queries'])}",
+        f"  user writes coalesced {users['coalescing_ratio']:.1f}x",
+    ]
+    if mini_app_api is not None:
+        api = mini_app_api.stats()
+        lookups = api["init_data_cache_hits"] + api["init_data_verified"]
+        lines.append(f"  mini-app init data {hit_ratio_text(api['init_data_cache_hits'], lookups)}, "
+                     f"cases not modified {hit_ratio_text(api['not_modified'], api['requests'])}")
+    return "\n".join(lines)
+
+def send_debug_capture(message: Message, kind, seconds):
+    """Run a time-boxed CPU profile or memory snapshot and send the report as a document"""
+    if not debug_capture_lock.acquire(blocking=False):
+        bot.reply_to(message, "Another profile is already running, try again later")
+        return
+    try:
+        title = "CPU profile" if kind == "profile" else "tracemalloc snapshot"
+        bot.reply_to(message, f"Capturing a {title} for {seconds:.0f}s...")
+        with chat_actions.working(message.chat.id, "upload_document"):
+            try:
+                if kind == "profile":
+                    report = introspection.profile(seconds)
+                else:
+                    report = introspection.memory_snapshot(seconds)
+            except Exception as e:
+                logger.error(f"/debug {kind} failed: {e}", exc_info=True)
+                bot.reply_to(message, f"The {title} failed: {e}")
+                return
+            bot.send_document(
+                message.chat.id,
+                io.BytesIO(report.encode("utf-8")),
+                reply_to_message_id=message.message_id,
+                visible_file_name=f"ruke-{kind}-{time.strftime('%Y%m%d-%H%M%S')}.txt",
+                caption=f"{title}, {seconds:.0f}s",
+            )
+    finally:
+        debug_capture_lock.release()
+
 @bot.message_handler(commands=['debug'])
 def handle_debug(message: Message):
-    """Debug command to check bot info"""
+    """Debug command to check bot info; admins also get runtime internals and profiles"""
     log_message(message)
+    if message.from_user.id not in ADMIN_USER_IDS:
+        # Nothing for other users touches the user registry or the runtime counters
+        bot.reply_to(message, debug_summary())
+        return
+    args = message.text.split()[1:]
+    if args and args[0] in ("profile", "memory"):
+        try:
+            seconds = float(args[1]) if len(args) > 1 else DEBUG_CAPTURE_SECONDS
+        except ValueError:
+            seconds = DEBUG_CAPTURE_SECONDS
+        if not math.isfinite(seconds):
+            seconds = DEBUG_CAPTURE_SECONDS
+        send_debug_capture(message, args[0], min(max(seconds, 1.0), DEBUG_CAPTURE_MAX_SECONDS))
+        return
+    bot.reply_to(message, debug_summary(admin=True))
+
+def debug_summary(admin=False):
+    """Text of /debug; admins also get active users and runtime internals"""
     model_name = DEFAULT_LLM_MODEL if model is None else "initialized"
     debug_info = f"Bot username: @{BOT_USERNAME}\nBot ID: {BOT_ID}\nModel: {model_name}"
+    if admin:
+        debug_info += f"\nActive users (24h): {user_registry.active_count(24 * 3600)}"
+        debug_info += "\n\n" + runtime_report()
+        debug_info += "\n\n/debug profile [seconds] - CPU profile\n/debug memory [seconds] - tracemalloc snapshot"
     
     # Add available models to debug output
     available_models = get_available_models()
     if available_models:
         debug_info += f"\n\nAvailable models:\n" + "\n".join(available_models)
-    
-    bot.reply_to(message, debug_info)
+    return debug_info
 
 @bot.message_handler(commands=['ryuk'])
 def handle_ryuk_command(message: Message):
@@ -344,12 +704,13 @@ def handle_ryuk_command(message: Message):
     if len(text) > 1:
         user_text = text[1].strip()
         # Generate and send response
-        response = generate_response(
-            user_text,
-            chat_id=message.chat.id,
-            user_id=message.from_user.id
-        )
-        bot.reply_to(message, response)
+        with chat_actions.working(message.chat.id, "typing"):
+            response = generate_response(
+                user_text,
+                chat_id=message.chat.id,
+                user_id=message.from_user.id
+            )
+            bot.reply_to(message, response)
     else:
         # No message provided with the command
         bot.reply_to(message, "Ку-ку-ку! Ты позвал меня, но ничего не сказал. Скажи что-нибудь после команды, например: /ryuk расскажи о яблоках")
@@ -385,28 +746,27 @@ def handle_all_messages(message: Message):
     """Handler for all non-command text messages"""
     log_message(message)
     
-    # Check if the bot was mentioned
-    if check_mentions(message.text):
-        # Bot was explicitly mentioned - send a direct response
-        user_input = message.text
-        response = generate_response(user_input, message.chat.id, message.from_user.id)
-        bot.reply_to(message, response)
-        return
-        
-    # Check if this is a reply to the bot's message
-    if message.reply_to_message and message.reply_to_message.from_user.id == BOT_ID:
-        # Message is a reply to the bot - send a direct response
-        user_input = message.text
-        response = generate_response(user_input, message.chat.id, message.from_user.id)
-        bot.reply_to(message, response)
+    with tracing.span("addressing") as addressing:
+        # Check if the bot was mentioned
+        if check_mentions(message.text):
+            reason = "mention"
+        # Check if this is a reply to the bot's message
+        elif message.reply_to_message and message.reply_to_message.from_user.id == BOT_ID:
+            reason = "reply"
+        # In private chats, respond to all messages
+        elif message.chat.type == "private":
+            reason = "private"
+        else:
+            reason = None
+        addressing.set("reason", reason or "none")
+    if reason is None:
         return
-        
-    # In private chats, respond to all messages
-    if message.chat.type == "private":
-        user_input = message.text
+    
+    # Send a direct response
+    user_input = message.text
+    with chat_actions.working(message.chat.id, "typing"):
         response = generate_response(user_input, message.chat.id, message.from_user.id)
         bot.reply_to(message, response)
-        return
 
 # Function to generate images using Hugging Face's Stable Diffusion 3.5
 def generate_image(prompt):
@@ -465,6 +825,100 @@ def generate_image(prompt):
         logger.error(f"Error generating image with Hugging Face: {error_msg}", exc_info=True)
         return None
 
+def render_draw_image(prompt, seed=None):
+    """Run text_to_image with the /draw settings; returns a PIL image"""
+    # Use the exact same parameters that worked well in the test script
+    extra = {"seed": seed} if seed is not None else {}
+    with tracing.span("hf.text_to_image", tracing.KIND_CLIENT, model=DEFAULT_SD_MODEL, seed=seed or 0), image_jobs:
+        return hf_client.text_to_image(
+            prompt=prompt,
+            model=DEFAULT_SD_MODEL,
+            negative_prompt="low quality, blurry, distorted, deformed, disfigured, bad anatomy, unrealistic, cartoon",
+            guidance_scale=9.0,  # Higher guidance scale for better prompt adherence
+            num_inference_steps=40,  # More steps for higher quality
+            width=1024,  # Higher resolution
+            height=1024,
+            **extra
+        )
+
+def submit_render(prompt, seed=None):
+    """Queue render_draw_image on image_executor (in the current trace); returns its future"""
+    image_queue.add()
+
+    def render():
+        image_queue.done()
+        return render_draw_image(prompt, seed)
+
+    return image_executor.submit(tracing.wrap(render))
+
+def draw_variants(message: Message, base_prompt, enhanced_prompt, variants, wait_msg):
+    """Generate `variants` seeds of one prompt concurrently and send them as a single album"""
+    chat_id = message.chat.id
+    seeds = [random.randint(0, 2**31 - 1) for _ in range(variants)]
+    start_time = time.time()
+    futures = [submit_render(enhanced_prompt, seed) for seed in seeds]
+    
+    media = []
+    used_seeds = []
+    errors = []
+    for seed, future in zip(seeds, futures):
+        try:
+            image_result = future.result()
+        except Exception as e:
+            logger.error(f"Error generating variant with seed {seed}: {str(e)}")
+            errors.append(str(e))
+            continue
+        img_byte_arr = io.BytesIO()
+        image_result.convert("RGB").save(img_byte_arr, format='JPEG', quality=95)
+        caption = f"*{base_prompt}*\n\nСоздано с помощью Stable Diffusion 3.5" if not media else None
+        media.append(telebot.types.InputMediaPhoto(img_byte_arr.getvalue(), caption=caption, parse_mode="Markdown"))
+        used_seeds.append(seed)
+    logger.info(f"{len(media)}/{variants} variants generated in {time.time() - start_time:.2f} seconds")
+    
+    if not media:
+        try:
+            bot.edit_message_text(chat_id=chat_id, message_id=wait_msg.message_id,
+                                  text=f"Не удалось создать изображение: {errors[0] if errors else ''}")
+        except:
+            bot.send_message(chat_id, "Ошибка при генерации изображения.")
+        return
+    
+    try:
+        if len(media) == 1:
+            sent_messages = [bot.send_photo(chat_id, media[0].media, caption=media[0].caption, parse_mode="Markdown")]
+        else:
+            sent_messages = bot.send_media_group(chat_id, media)
+    except Exception as send_error:
+        logger.error(f"Error sending variants: {str(send_error)}", exc_info=True)
+        try:
+            bot.edit_message_text(chat_id=chat_id, message_id=wait_msg.message_id,
+                                  text=f"Изображения созданы, но не могу их отправить. Ошибка: {str(send_error)}")
+        except:
+            bot.send_message(chat_id, "Ошибка при отправке изображения.")
+        return
+    
+    # The file_ids let these images be sent again (inline mode) without another upload
+    for sent, seed in zip(sent_messages, used_seeds):
+        if sent.photo:
+            remember_image(message.from_user.id, base_prompt, sent.photo[-1].file_id, seed)
+    try:
+        bot.delete_message(chat_id=chat_id, message_id=wait_msg.message_id)
+    except Exception as delete_error:
+        logger.error(f"Could not delete wait message: {str(delete_error)}")
+
+@bot.inline_handler(func=lambda query: True)
+def handle_inline_query(query):
+    """Answer "@bot ..." inline queries from cached and precomputed results"""
+    inline_answers.handle(query.id, query.from_user.id, query.query)
+
+def plural(n, one, few, many):
+    """Russian plural form for `n`: 1 вариант, 2 варианта, 5 вариантов"""
+    if n % 10 == 1 and n % 100 != 11:
+        return one
+    if 2 <= n % 10 <= 4 and not 12 <= n % 100 <= 14:
+        return few
+    return many
+
 @bot.message_handler(commands=['draw', 'рисуй'])
 def handle_draw_command(message: Message):
     """Generate an image based on user's prompt using a simplified approach"""
@@ -486,14 +940,35 @@ def handle_draw_command(message: Message):
     # Extract prompt and create high-quality prompt without random styles
     base_prompt = message.text.split(' ', 1)[1].strip()
     
+    # "/draw 3 <prompt>" asks for several variants of the same prompt; other numbers
+    # ("/draw 1984 город") are part of the prompt
+    variants = 1
+    count, _, rest = base_prompt.partition(' ')
+    if count.isdigit() and 2 <= int(count) <= MAX_DRAW_VARIANTS and rest.strip():
+        variants = int(count)
+        base_prompt = rest.strip()
+    
     # Create a detailed, high-quality prompt without randomization
     # This ensures consistent high-quality results like in the test script
     enhanced_prompt = f"{base_prompt}, highly detailed, 8k, hyperrealistic, cinematic lighting, dark fantasy style"
     print(f"GENERATING IMAGE with prompt: {enhanced_prompt}")
     
     # Let user know we're working
-    wait_msg = bot.reply_to(message, "Рисую высококачественное изображение с помощью Stable Diffusion 3.5... *хмык*")
+    if variants > 1:
+        wait_msg = bot.reply_to(message, f"Рисую {variants} {plural(variants, 'вариант', 'варианта', 'вариантов')} "
+                                         f"с помощью Stable Diffusion 3.5... *хмык*")
+    else:
+        wait_msg = bot.reply_to(message, "Рисую высококачественное изображение с помощью Stable Diffusion 3.5... *хмык*")
     
+    # "sending photo…" until the image is sent (the wait message above would clear it)
+    with chat_actions.working(message.chat.id, "upload_photo"):
+        if variants > 1:
+            draw_variants(message, base_prompt, enhanced_prompt, variants, wait_msg)
+        else:
+            draw_single(message, base_prompt, enhanced_prompt, wait_msg)
+
+def draw_single(message: Message, base_prompt, enhanced_prompt, wait_msg):
+    """Generate one image for /draw and send it in place of the wait message"""
     try:
         # Get chat and message IDs for later use
         chat_id = message.chat.id
@@ -503,16 +978,8 @@ def handle_draw_command(message: Message):
         start_time = time.time()
         logger.info(f"Generating image with optimized prompt: {enhanced_prompt}")
         
-        # Use the exact same parameters that worked well in the test script
-        image_result = hf_client.text_to_image(
-            prompt=enhanced_prompt,
-            model=DEFAULT_SD_MODEL,
-            negative_prompt="low quality, blurry, distorted, deformed, disfigured, bad anatomy, unrealistic, cartoon",
-            guidance_scale=9.0,  # Higher guidance scale for better prompt adherence
-            num_inference_steps=40,  # More steps for higher quality
-            width=1024,  # Higher resolution
-            height=1024
-        )
+        # Runs on the image executor, so it counts towards IMAGE_MAX_CONCURRENCY
+        image_result = submit_render(enhanced_prompt).result()
         
         generation_time = time.time() - start_time
         logger.info(f"Image generated in {generation_time:.2f} seconds")
@@ -536,6 +1003,8 @@ def handle_draw_command(message: Message):
             
             logger.info(f"Image sent successfully to chat {chat_id}")
             print(f"IMAGE SENT SUCCESSFULLY to {chat_id}")
+            if sent.photo:
+                remember_image(message.from_user.id, base_prompt, sent.photo[-1].file_id)
             
             # Delete wait message with explicit IDs
             try:
@@ -587,6 +1056,7 @@ def handle_image_info(message: Message):
 
 Для создания изображения используйте команду `/draw` или `/рисуй`, за которой следует ваш запрос.
 Например: `/draw шинигами наблюдает за городом`
+Несколько вариантов сразу: `/draw 3 шинигами наблюдает за городом`
 
 Сгенерированные изображения высокого качества в стиле dark fantasy.
         """
@@ -658,11 +1128,27 @@ def test_huggingface():
         print("huggingface_hub package not installed. Install with: pip install huggingface_hub")
         return False
 
+def register_bot_commands():
+    """Register commands for better menu display in Telegram"""
+    commands = [
+        telebot.types.BotCommand("start", "Начать общение с Рюком"),
+        telebot.types.BotCommand("help", "Помощь и информация"),
+        telebot.types.BotCommand("debug", "Информация о работе бота"),
+        telebot.types.BotCommand("ryuk", "Общение с Рюком"),
+        telebot.types.BotCommand("draw", "Генерация изображения"),
+        telebot.types.BotCommand("image_info", "Информация о генерации изображений")
+    ]
+    bot.set_my_commands(commands)
+    logger.info("Bot commands registered")
+
 def main():
     """Main bot execution function"""
-    global BOT_USERNAME, BOT_ID
+    global BOT_USERNAME, BOT_ID, mini_app_api
     
     try:
+        # Bring back conversations and unhandled updates from the last shutdown
+        pending_updates = lifecycle.restore()
+        
         # Initialize the Gemini model
         if init_model():
             logger.info("Model initialized successfully")
@@ -675,17 +1161,23 @@ def main():
         BOT_ID = bot_info.id
         logger.info(f"Bot information retrieved: @{BOT_USERNAME} (ID: {BOT_ID})")
         
+        # Record anonymized updates if requested
+        if RECORD_UPDATES_PATH:
+            recorder = start_recording(bot, RECORD_UPDATES_PATH, BOT_ID, BOT_USERNAME)
+            lifecycle.on_shutdown(recorder.flush)
+        
         # Register commands for better menu display in Telegram
-        commands = [
-            telebot.types.BotCommand("start", "Начать общение с Рюком"),
-            telebot.types.BotCommand("help", "Помощь и информация"),
-            telebot.types.BotCommand("debug", "Информация о работе бота"),
-            telebot.types.BotCommand("ryuk", "Общение с Рюком"),
-            telebot.types.BotCommand("draw", "Генерация изображения"),
-            telebot.types.BotCommand("image_info", "Информация о генерации изображений")
-        ]
-        bot.set_my_commands(commands)
-        logger.info("Bot commands registered")
+        register_bot_commands()
+        
+        # Message idle users every few hours, like the n8n schedule trigger
+        if BROADCAST_ENABLED:
+            start_scheduler(create_broadcaster(), BROADCAST_INTERVAL_HOURS * 3600)
+            logger.info(f"Re-engagement broadcasts every {BROADCAST_INTERVAL_HOURS}h")
+        
+        # HTTP API of the Death Note mini-app
+        if MINI_APP_API_PORT:
+            mini_app_api = start_mini_app_api()
+            lifecycle.on_shutdown(mini_app_api.stop)
         
         # Print initialization message
         print(f"====================================================")
@@ -695,14 +1187,30 @@ def main():
         print(f"Press Ctrl+C to exit")
         print(f"====================================================")
         
+        # Track handlers for a graceful shutdown, then answer what the last run left unhandled
+        lifecycle.install()
+        tracer.install(bot)
+        lifecycle.redeliver(pending_updates)
+        
+        # Updates that queued up while we were down: freshest first, stale ones collapsed or dropped
+        if BACKLOG_TRIAGE:
+            backlog, offset, _ = triage_startup_backlog(TELEGRAM_TOKEN, create_backlog_triage())
+            bot.process_new_updates([telebot.types.Update.de_json(update) for update in backlog])
+            # Polling continues after the last fetched update, including the ones triage dropped
+            if offset:
+                bot.last_update_id = max(bot.last_update_id, offset - 1)
+        
         # Start the bot
         logger.info("Starting bot polling...")
-        bot.polling(none_stop=True, interval=1, timeout=90)
+        lifecycle.run_polling(lambda: bot.polling(none_stop=True, interval=1, timeout=90))
         
     except Exception as e:
         logger.error(f"Error in main function: {str(e)}", exc_info=True)
         print(f"Error: {str(e)}")
         sys.exit(1)
+    finally:
+        # Runs on SIGTERM/Ctrl+C (polling stops) as well as on crashes
+        lifecycle.shutdown()
 
 @bot.message_handler(commands=['play', 'game'])
 def handle_play_command(message: Message):
@@ -710,15 +1218,17 @@ def handle_play_command(message: Message):
     log_message(message)
     logger.info(f"PLAY COMMAND RECEIVED from user {message.from_user.id}")
     
-    # URL of your mini-app (replace with your actual deployed URL)
-    mini_app_url = "https://example.com/death-note-game"
+    web_app = telebot.types.WebAppInfo(url=mini_app_link())
     
-    # Create an inline keyboard with a button to launch the mini-app
-    markup = telebot.types.InlineKeyboardMarkup()
-    markup.add(telebot.types.InlineKeyboardButton(
-        text="Запустить игру Death Note",
-        web_app=telebot.types.WebAppInfo(url=mini_app_url)
-    ))
+    if message.chat.type == "private":
+        # A keyboard button lets the mini-app send its results back as web_app_data;
+        # it hides once pressed and is removed when the results arrive
+        markup = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
+        markup.add(telebot.types.KeyboardButton(text="Запустить игру Death Note", web_app=web_app))
+    else:
+        # Create an inline keyboard with a button to launch the mini-app
+        markup = telebot.types.InlineKeyboardMarkup()
+        markup.add(telebot.types.InlineKeyboardButton(text="Запустить игру Death Note", web_app=web_app))
     
     # Send a message with the game launch button
     bot.send_message(
@@ -739,6 +1249,21 @@ def handle_play_command(message: Message):
         "Я буду наблюдать за твоими решениями... *хехехе*"
     )
 
+@bot.message_handler(content_types=['web_app_data'])
+def handle_web_app_data(message: Message):
+    """Record game results the mini-app sends with Telegram.WebApp.sendData"""
+    logger.info(f"Mini-app data from user {message.from_user.id}")
+    try:
+        result = normalize_result(json.loads(message.web_app_data.data))
+    except ValueError:
+        result = None
+    if result is None:
+        logger.warning(f"Ignoring unknown mini-app data: {message.web_app_data.data[:200]!r}")
+        return
+    totals = game_store.record_result(message.from_user.id, result, "web_app_data")
+    bot.send_message(message.chat.id, game_result_reply(result, totals),
+                     reply_markup=telebot.types.ReplyKeyboardRemove())
+
 if __name__ == "__main__":
     try:
         if os.getenv("TEST_HUGGINGFACE") == "1":
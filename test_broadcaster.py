@@ -0,0 +1,56 @@
+"""
+Offline checks of the re-engagement broadcaster: no Telegram, no Gemini.
+
+    python -m pytest test_broadcaster.py
+"""
+
+import time
+from types import SimpleNamespace
+
+from broadcaster import Broadcaster
+from user_registry import UserRegistry
+
+
+def make_registry(tmp_path, user_ids, idle_hours=10):
+    registry = UserRegistry(str(tmp_path / "users.db"), flush_interval=0)
+    when = time.time() - idle_hours * 3600
+    for user_id in user_ids:
+        registry.record_interaction(SimpleNamespace(id=user_id, username=None, first_name="x", last_name=None),
+                                    when=when)
+    return registry
+
+
+def make_broadcaster(registry, sent, dry_run=False):
+    return Broadcaster(
+        registry,
+        send_message=lambda chat_id, text: sent.append(chat_id),
+        generate_message=lambda history: "Ку-ку-ку...",
+        get_history=lambda user_id: [],
+        idle_seconds=5 * 3600,
+        send_rate=1000.0,
+        dry_run=dry_run,
+    )
+
+
+def test_dry_run_leaves_users_for_the_next_real_run(tmp_path):
+    registry = make_registry(tmp_path, [1, 2, 3])
+
+    previewed = []
+    report = make_broadcaster(registry, previewed, dry_run=True).run()
+    assert sorted(previewed) == [1, 2, 3]
+    assert report["sent"] == 3
+    # Nothing of the dry run is left in the real database
+    assert registry.connection().execute("SELECT COUNT(*) FROM telegram_users WHERE last_broadcast IS NOT NULL"
+                                         ).fetchone()[0] == 0
+    assert registry.connection().execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE name = 'broadcast_runs'").fetchone()[0] == 0
+
+    sent = []
+    report = make_broadcaster(registry, sent).run()
+    assert sorted(sent) == [1, 2, 3]
+    assert not report["resumed"]
+
+    # The real run did start the cooldown
+    again = []
+    make_broadcaster(registry, again).run()
+    assert again == []
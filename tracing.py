@@ -0,0 +1,380 @@
+"""
+Per-update tracing.
+
+Every update handled by the bot gets a trace: a root span from the moment
+polling hands it over until its handler returns, with child spans for where
+the time went:
+
+    receive            waiting for a handler thread (telegram.message_age_s
+                       tells how old the message already was on arrival)
+    addressing         deciding whether the bot should answer
+    history.fetch      conversation store lookup
+    prompt.build       finding or rebuilding the Gemini chat session
+    gemini.*           each upstream call: probes of init_model, every attempt
+                       and retry, the offline fallback
+    telegram.<method>  each Bot API call (sendMessage, sendPhoto, ...)
+
+Code adds spans with `tracing.span(name, **attributes)`; outside a trace it
+is a no-op costing one context lookup, so helpers can be instrumented no
+matter who calls them. Work handed to another thread keeps its trace when
+submitted through `tracing.wrap(fn)`.
+
+Finished traces are
+- appended to TRACE_EXPORT_PATH (when set) as OTLP/JSON, one
+  {"resourceSpans": [...]} document per line like the OpenTelemetry
+  collector's file exporter, written in batches by a background thread
+- written as an indented span tree to the slow-request log
+  (TRACE_SLOW_LOG_PATH) when they took longer than TRACE_SLOW_SECONDS
+- counted into per-span-name windows of the latest durations, for the
+  p50/p99 latencies /debug shows to admins
+"""
+
+import contextvars
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = "ruke-bot"
+# OTLP span kinds and status codes
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_current = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind", "start_ns", "end_ns", "attributes", "status",
+                 "message")
+
+    def __init__(self, trace, name, parent_id=None, kind=KIND_INTERNAL, start_ns=None, attributes=None):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes or {}
+        self.status = STATUS_OK
+        self.message = ""
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def fail(self, error):
+        self.status = STATUS_ERROR
+        self.message = f"{type(error).__name__}: {error}"[:300]
+
+    def end(self, end_ns=None):
+        self.end_ns = end_ns or time.time_ns()
+
+    @property
+    def duration_ms(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+
+class _NoSpan:
+    """Stand-in yielded by span() outside a trace"""
+
+    def set(self, key, value):
+        pass
+
+    def fail(self, error):
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+class Trace:
+    """Spans of one update"""
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+        self.trace_id = os.urandom(16).hex()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    @property
+    def root(self):
+        return self.spans[0]
+
+
+@contextmanager
+def span(name, kind=KIND_INTERNAL, **attributes):
+    """Time the block as a child of the current span; a no-op outside a trace"""
+    parent = _current.get()
+    if parent is None:
+        yield NO_SPAN
+        return
+    child = Span(parent.trace, name, parent.span_id, kind, attributes=attributes)
+    parent.trace.add(child)
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.fail(e)
+        raise
+    finally:
+        child.end()
+        _current.reset(token)
+
+
+def current_trace_id():
+    current = _current.get()
+    return current.trace.trace_id if current is not None else None
+
+
+def wrap(fn):
+    """`fn` bound to the current context, so spans it opens in another thread join this trace"""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+def percentile(ordered, fraction):
+    """Value at `fraction` (0..1) of an already sorted list"""
+    return ordered[min(len(ordered) - 1, round(fraction * (len(ordered) - 1)))]
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(trace):
+    """OTLP/JSON ExportTraceServiceRequest for one trace"""
+    spans = []
+    for item in trace.spans:
+        encoded = {
+            "traceId": trace.trace_id,
+            "spanId": item.span_id,
+            "name": item.name,
+            "kind": item.kind,
+            "startTimeUnixNano": str(item.start_ns),
+            "endTimeUnixNano": str(item.end_ns or item.start_ns),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in item.attributes.items()],
+            "status": {"code": item.status, "message": item.message} if item.message else {"code": item.status},
+        }
+        if item.parent_id:
+            encoded["parentSpanId"] = item.parent_id
+        spans.append(encoded)
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+        "scopeSpans": [{"scope": {"name": __name__}, "spans": spans}],
+    }]}
+
+
+def render_tree(trace):
+    """Indented text view of a trace: offset from the start, duration, name and attributes"""
+    children = {}
+    for item in trace.spans[1:]:
+        children.setdefault(item.parent_id, []).append(item)
+    root = trace.root
+    lines = [f"trace {trace.trace_id} {root.name} {root.duration_ms:.0f} ms"]
+
+    def walk(item, depth):
+        attributes = " ".join(f"{key}={value}" for key, value in item.attributes.items())
+        error = f" ERROR {item.message}" if item.status == STATUS_ERROR else ""
+        lines.append(f"  +{(item.start_ns - root.start_ns) / 1e6:9.1f} ms {item.duration_ms:9.1f} ms  "
+                     f"{'  ' * depth}{item.name} {attributes}{error}".rstrip())
+        for child in sorted(children.get(item.span_id, []), key=lambda child: child.start_ns):
+            walk(child, depth + 1)
+
+    walk(root, 0)
+    return "\n".join(lines)
+
+
+class Tracer:
+    """Creates a trace per handled update and exports finished traces"""
+
+    def __init__(self, export_path="", slow_seconds=10.0, slow_log_path="", batch_size=100, flush_interval=2.0,
+                 latency_window=1000):
+        self.export_path = export_path
+        self.slow_seconds = slow_seconds
+        self.slow_log_path = slow_log_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._slow_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._stats = {"traces": 0, "spans": 0, "slow": 0, "exported": 0}
+        # Span name ("update" for roots) -> durations in ms of the latest `latency_window` spans
+        self.latency_window = latency_window
+        self._latencies = {}
+        self._original_exec_task = None
+        self._original_make_request = None
+        # Started with the first exported trace
+        self._thread = None
+
+    # --- traces ------------------------------------------------------------
+
+    @contextmanager
+    def trace(self, name, start_ns=None, **attributes):
+        """Run the block as the root span of a new trace"""
+        trace = Trace(self)
+        root = Span(trace, name, kind=KIND_SERVER, start_ns=start_ns, attributes=attributes)
+        trace.add(root)
+        token = _current.set(root)
+        try:
+            yield root
+        except BaseException as e:
+            root.fail(e)
+            raise
+        finally:
+            root.end()
+            _current.reset(token)
+            self.finish(trace)
+
+    def finish(self, trace):
+        slow = bool(self.slow_seconds) and trace.root.duration_ms >= self.slow_seconds * 1000
+        with self._lock:
+            self._stats["traces"] += 1
+            self._stats["spans"] += len(trace.spans)
+            self._stats["slow"] += slow
+            for item in trace.spans:
+                name = "update" if item is trace.root else item.name
+                window = self._latencies.get(name)
+                if window is None:
+                    window = self._latencies[name] = deque(maxlen=self.latency_window)
+                window.append(item.duration_ms)
+            start_thread = self.export_path and self._thread is None
+            if start_thread:
+                self._thread = threading.Thread(target=self._export_loop, name="trace-export", daemon=True)
+        if start_thread:
+            self._thread.start()
+        if self.export_path:
+            self._queue.put(trace)
+        if slow:
+            self._log_slow(trace)
+
+    def _log_slow(self, trace):
+        tree = render_tree(trace)
+        logger.warning(f"Slow update: {trace.root.duration_ms / 1000:.1f}s, trace {trace.trace_id}")
+        if not self.slow_log_path:
+            logger.warning(tree)
+            return
+        try:
+            with self._slow_lock, open(self.slow_log_path, "a", encoding="utf-8") as f:
+                f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {tree}\n\n")
+        except OSError as e:
+            logger.error(f"Could not write the slow-request log: {e}")
+
+    # --- export ------------------------------------------------------------
+
+    def _export_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            # A None from close() means "write now"
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        traces = [trace for trace in batch if trace is not None]
+        try:
+            if traces:
+                with open(self.export_path, "a", encoding="utf-8") as f:
+                    f.writelines(json.dumps(to_otlp(trace), separators=(",", ":")) + "\n" for trace in traces)
+                with self._lock:
+                    self._stats["exported"] += len(traces)
+        except Exception as e:
+            logger.error(f"Could not export {len(traces)} traces: {e}")
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    def close(self, timeout=5.0):
+        """Write the traces still queued, waiting at most `timeout` seconds (safe to call more than once)"""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and self._thread.is_alive() and time.monotonic() < deadline:
+            time.sleep(0.02)
+        if self._queue.unfinished_tasks:
+            left = sum(item is not None for item in list(self._queue.queue))
+            logger.warning(f"Trace export did not finish; {left} queued traces were not written")
+
+    # --- bot hooks ---------------------------------------------------------
+
+    def install(self, bot):
+        """Trace every update dispatched by `bot` and every Bot API request made inside a trace"""
+        from telebot import apihelper
+        self._original_exec_task = bot._exec_task
+        bot._exec_task = self._exec_task
+        self._original_make_request = apihelper._make_request
+        apihelper._make_request = self._make_request
+
+    def _exec_task(self, task, *args, **kwargs):
+        update_type = kwargs.get("update_type")
+        if update_type is None:
+            # Update listeners and other internal tasks are not traced
+            return self._original_exec_task(task, *args, **kwargs)
+        received_ns = time.time_ns()
+        item = args[0] if args else None
+        attributes = {"update.type": update_type}
+        chat = getattr(item, "chat", None) or getattr(getattr(item, "message", None), "chat", None)
+        if chat is not None:
+            attributes["chat.id"] = chat.id
+        user = getattr(item, "from_user", None)
+        if user is not None:
+            attributes["user.id"] = user.id
+        text = getattr(item, "text", None)
+        if text and text.startswith("/"):
+            attributes["command"] = text.split()[0].split("@")[0]
+        date = getattr(item, "date", None)
+
+        def traced(*task_args, **task_kwargs):
+            with self.trace(f"update {update_type}", start_ns=received_ns, **attributes) as root:
+                queued = Span(root.trace, "receive", root.span_id, start_ns=received_ns)
+                if date:
+                    queued.set("telegram.message_age_s", round(received_ns / 1e9 - date, 1))
+                queued.end()
+                root.trace.add(queued)
+                return task(*task_args, **task_kwargs)
+
+        return self._original_exec_task(traced, *args, **kwargs)
+
+    def _make_request(self, token, method_name, *args, **kwargs):
+        if _current.get() is None:
+            return self._original_make_request(token, method_name, *args, **kwargs)
+        with span(f"telegram.{method_name}", kind=KIND_CLIENT):
+            return self._original_make_request(token, method_name, *args, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["queued"] = self._queue.qsize()
+        return stats
+
+    def latencies(self):
+        """{span name: {"count", "p50_ms", "p99_ms"}} over the latest spans of each name"""
+        with self._lock:
+            windows = {name: sorted(window) for name, window in self._latencies.items()}
+        return {
+            name: {"count": len(ordered), "p50_ms": percentile(ordered, 0.5), "p99_ms": percentile(ordered, 0.99)}
+            for name, ordered in windows.items()
+        }
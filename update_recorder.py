@@ -0,0 +1,308 @@
+"""
+Records incoming Telegram updates to a compact append-only file so that a
+real day of traffic can be replayed later with replay_updates.py.
+
+Updates are anonymized before they touch the disk:
+- user and chat ids are replaced by keyed hashes (sign is kept, so groups stay groups)
+- names, usernames and titles are replaced by pseudonyms
+- message text is scrambled letter by letter, keeping its length, script,
+  case, whitespace, punctuation, emoji, /commands and mentions of the bot,
+  so message shape and entity offsets survive but the content does not
+
+File format: one compact JSON object per line. The first line of every
+recording session is a header {"header": {...}}; every other line is
+{"ts": <unix time>, "update": {...}}. Paths ending in .gz are gzip-compressed
+(one gzip member per flush, which gzip readers handle transparently).
+
+Buffered updates are written after flush_every updates or flush_interval
+seconds, whichever comes first (a timer covers quiet periods), and at exit.
+"""
+
+import atexit
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import secrets
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CYRILLIC_LOWER = "абвгдежзийклмнопрстуфхцчшщъыьэюя"
+LATIN_LOWER = "abcdefghijklmnopqrstuvwxyz"
+DIGITS = "0123456789"
+
+# Fields copied from user/chat objects; everything else is dropped
+USER_FIELDS = ("id", "is_bot", "first_name", "last_name", "username", "language_code")
+CHAT_FIELDS = ("id", "type", "title", "first_name", "last_name", "username")
+MESSAGE_FIELDS = ("message_id", "date", "edit_date", "media_group_id")
+
+
+class Anonymizer:
+    """Keyed, deterministic anonymization of Telegram update dicts"""
+
+    def __init__(self, salt=None, keep_ids=(), keep_usernames=(), keep_text=False):
+        self.salt = (salt or secrets.token_hex(16)).encode()
+        self.keep_ids = set(keep_ids)
+        self.keep_usernames = {u.lower() for u in keep_usernames if u}
+        self.keep_text = keep_text
+
+    def _digest(self, value):
+        return hmac.new(self.salt, str(value).encode(), hashlib.sha256).digest()
+
+    def anonymize_id(self, value):
+        if value is None or value in self.keep_ids:
+            return value
+        hashed = int.from_bytes(self._digest(value)[:5], "big") or 1
+        return -hashed if value < 0 else hashed
+
+    def pseudonym(self, value, prefix="u"):
+        if not value:
+            return value
+        if value.lower() in self.keep_usernames:
+            return value
+        return f"{prefix}{self._digest(value).hex()[:8]}"
+
+    def _scramble_word(self, word):
+        rng = random.Random(self._digest(word))
+        out = []
+        for ch in word:
+            lower = ch.lower()
+            if lower in CYRILLIC_LOWER:
+                repl = rng.choice(CYRILLIC_LOWER)
+            elif lower in LATIN_LOWER:
+                repl = rng.choice(LATIN_LOWER)
+            elif ch in DIGITS:
+                repl = rng.choice(DIGITS)
+            else:
+                out.append(ch)
+                continue
+            out.append(repl.upper() if ch != lower else repl)
+        return "".join(out)
+
+    def scramble_text(self, text):
+        """Replace letters and digits word by word, keeping commands and mentions of the bot"""
+        if not text or self.keep_text:
+            return text
+        words = text.split(" ")
+        result = []
+        for i, word in enumerate(words):
+            bare = word.split("@", 1)[0] if word.startswith("/") else word
+            if i == 0 and word.startswith("/"):
+                # Keep the command name (and a @botname suffix if it is ours)
+                suffix = word[len(bare):]
+                if suffix and suffix[1:].lower() not in self.keep_usernames:
+                    suffix = "@" + self._scramble_word(suffix[1:])
+                result.append(bare + suffix)
+            elif word.startswith("@") and word[1:].rstrip(",.!?:;").lower() in self.keep_usernames:
+                result.append(word)
+            else:
+                result.append("\n".join(self._scramble_word(part) for part in word.split("\n")))
+        return " ".join(result)
+
+    def user(self, user):
+        if not user:
+            return user
+        out = {k: user[k] for k in USER_FIELDS if k in user}
+        if "id" in out:
+            out["id"] = self.anonymize_id(out["id"])
+        for key in ("first_name", "last_name"):
+            if key in out and user.get("id") not in self.keep_ids:
+                out[key] = self.pseudonym(out[key], "n")
+        if "username" in out:
+            out["username"] = self.pseudonym(out["username"])
+        return out
+
+    def chat(self, chat):
+        if not chat:
+            return chat
+        out = {k: chat[k] for k in CHAT_FIELDS if k in chat}
+        out["id"] = self.anonymize_id(out.get("id"))
+        for key in ("title", "first_name", "last_name"):
+            if key in out:
+                out[key] = self.pseudonym(out[key], "n")
+        if "username" in out:
+            out["username"] = self.pseudonym(out["username"])
+        return out
+
+    def message(self, message, depth=0):
+        if not message:
+            return message
+        out = {k: message[k] for k in MESSAGE_FIELDS if k in message}
+        out["chat"] = self.chat(message.get("chat"))
+        if "from" in message:
+            out["from"] = self.user(message["from"])
+        for key in ("text", "caption"):
+            if key in message:
+                out[key] = self.scramble_text(message[key])
+        for key in ("entities", "caption_entities"):
+            if key in message:
+                out[key] = [
+                    {k: v for k, v in entity.items() if k in ("type", "offset", "length")}
+                    for entity in message[key]
+                ]
+        if "photo" in message:
+            out["photo"] = [
+                {"file_id": "anon", "file_unique_id": "anon", "width": p.get("width", 0), "height": p.get("height", 0)}
+                for p in message["photo"]
+            ]
+        if "web_app_data" in message:
+            out["web_app_data"] = {"data": "{}", "button_text": message["web_app_data"].get("button_text", "")}
+        if "reply_to_message" in message and depth == 0:
+            out["reply_to_message"] = self.message(message["reply_to_message"], depth + 1)
+        return out
+
+    def inline_query(self, query):
+        return {
+            "id": query.get("id"),
+            "from": self.user(query.get("from")),
+            "query": self.scramble_text(query.get("query", "")),
+            "offset": query.get("offset", ""),
+        }
+
+    def update(self, update):
+        out = {"update_id": update["update_id"]}
+        for key in ("message", "edited_message", "channel_post", "edited_channel_post"):
+            if update.get(key):
+                out[key] = self.message(update[key])
+        if update.get("inline_query"):
+            out["inline_query"] = self.inline_query(update["inline_query"])
+        return out
+
+
+def update_to_dict(update):
+    """Raw dict for a telebot Update (messages keep their original JSON)"""
+    out = {"update_id": update.update_id}
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        message = getattr(update, key, None)
+        if message is not None:
+            raw = message.json
+            out[key] = json.loads(raw) if isinstance(raw, str) else raw
+    query = getattr(update, "inline_query", None)
+    if query is not None:
+        out["inline_query"] = {
+            "id": query.id,
+            "from": query.from_user.to_dict() if hasattr(query.from_user, "to_dict") else {"id": query.from_user.id},
+            "query": query.query,
+            "offset": query.offset,
+        }
+    return out
+
+
+class UpdateRecorder:
+    """Appends anonymized updates to a recording file"""
+
+    def __init__(self, path, anonymizer, flush_every=20, flush_interval=1.0, header=None):
+        self.path = path
+        self.anonymizer = anonymizer
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.recorded = 0
+        self._buffer = []
+        self._last_flush = time.monotonic()
+        # Armed by the first buffered update, so nothing waits longer than flush_interval
+        self._timer = None
+        self._lock = threading.Lock()
+        self._write_lines([json.dumps({"header": dict(header or {}, started=time.time())}, separators=(",", ":"))])
+
+    def _write_lines(self, lines):
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        if self.path.endswith(".gz"):
+            with gzip.open(self.path, "ab") as f:
+                f.write(data)
+        else:
+            with open(self.path, "ab") as f:
+                f.write(data)
+
+    def record(self, update_dict, ts=None):
+        line = json.dumps(
+            {"ts": round(ts or time.time(), 3), "update": self.anonymizer.update(update_dict)},
+            ensure_ascii=False, separators=(",", ":"),
+        )
+        with self._lock:
+            self._buffer.append(line)
+            self.recorded += 1
+            if len(self._buffer) >= self.flush_every or time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush_locked()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._buffer:
+            try:
+                self._write_lines(self._buffer)
+            except Exception as e:
+                logger.error(f"Could not write update recording to {self.path}: {e}")
+            self._buffer = []
+        self._last_flush = time.monotonic()
+
+    def install(self, bot):
+        """Record every update passed to bot.process_new_updates before it is handled"""
+        original = bot.process_new_updates
+
+        def process_new_updates(updates):
+            now = time.time()
+            for update in updates:
+                try:
+                    self.record(update_to_dict(update), now)
+                except Exception as e:
+                    logger.warning(f"Could not record update {getattr(update, 'update_id', '?')}: {e}")
+            return original(updates)
+
+        bot.process_new_updates = process_new_updates
+        return self
+
+
+def read_recording(path):
+    """Yield (header, entry) pairs from a recording; header is the most recent header line"""
+    opener = gzip.open if path.endswith(".gz") else open
+    header = {}
+    with opener(path, "rt", encoding="utf-8") as f:
+        while True:
+            try:
+                line = f.readline()
+            except (EOFError, gzip.BadGzipFile):
+                # Truncated last gzip member (e.g. the recorder was killed mid-write)
+                break
+            if not line:
+                break
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                logger.warning("Skipping corrupt line in recording")
+                continue
+            if "header" in entry:
+                header = entry["header"]
+                continue
+            yield header, entry
+
+
+def start_recording(bot, path, bot_id=None, bot_username=None):
+    """Install a recorder on `bot` using RECORD_UPDATES_SALT / RECORD_UPDATES_KEEP_TEXT from the environment"""
+    anonymizer = Anonymizer(
+        salt=os.getenv("RECORD_UPDATES_SALT") or None,
+        keep_ids={bot_id} if bot_id else (),
+        keep_usernames={bot_username, "my_Ruke_bot"},
+        keep_text=os.getenv("RECORD_UPDATES_KEEP_TEXT") == "1",
+    )
+    recorder = UpdateRecorder(path, anonymizer, header={"bot_id": bot_id, "bot_username": bot_username})
+    recorder.install(bot)
+    atexit.register(recorder.flush)
+    logger.info(f"Recording anonymized updates to {path}")
+    return recorder
@@ -0,0 +1,180 @@
+"""
+Tracks who talks to the bot, like the `telegram_users` table of the n8n flow.
+
+The n8n flow upserts the sender on every single update. Here incoming
+messages only update an in-memory table of dirty rows; a background thread
+writes those rows to the local SQLite database (USERS_DB_PATH) in one bulk
+upsert every USERS_FLUSH_INTERVAL seconds, so a user sending 20 messages in
+that window costs one row write. Queries flush first and then use the index
+on last_interaction, e.g. to find users who have been idle for a while.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS telegram_users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    joined REAL NOT NULL,
+    last_interaction REAL NOT NULL,
+    last_broadcast REAL
+);
+CREATE INDEX IF NOT EXISTS telegram_users_by_last_interaction ON telegram_users (last_interaction);
+"""
+
+
+UPSERT = """
+INSERT INTO telegram_users (user_id, username, first_name, last_name, joined, last_interaction)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (user_id) DO UPDATE
+SET username = excluded.username,
+    first_name = excluded.first_name,
+    last_name = excluded.last_name,
+    last_interaction = MAX(telegram_users.last_interaction, excluded.last_interaction)
+"""
+
+
+class UserRegistry:
+    """Registry of Telegram users and their last interaction, with write-coalescing.
+
+    With flush_interval=0 every interaction is written immediately.
+    """
+
+    def __init__(self, path, flush_interval=5.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        # user_id -> (user_id, username, first_name, last_name, first_seen, last_interaction)
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stats = {"interactions": 0, "rows_written": 0, "flushes": 0}
+        self._stop = threading.Event()
+        # The database is created by the first query and the flush thread by the first write,
+        # so importing the bot touches no files and starts no threads
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+        self._thread = None
+
+    def connection(self):
+        """Per-thread SQLite connection"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        if not self._schema_ready:
+            with self._schema_lock:
+                if not self._schema_ready:
+                    connection.executescript(SCHEMA)
+                    connection.commit()
+                    self._schema_ready = True
+        return connection
+
+    def record_interaction(self, user, when=None):
+        """Remember a user's profile and last_interaction; written on the next flush"""
+        when = when or time.time()
+        with self._lock:
+            previous = self._dirty.get(user.id)
+            first_seen = previous[4] if previous else when
+            self._dirty[user.id] = (user.id, user.username, user.first_name, user.last_name,
+                                    first_seen, max(when, previous[5]) if previous else when)
+            self._stats["interactions"] += 1
+            start_thread = self.flush_interval and self._thread is None and not self._stop.is_set()
+            if start_thread:
+                self._thread = threading.Thread(target=self._flush_loop, name="user-registry-flush", daemon=True)
+        if start_thread:
+            self._thread.start()
+        elif not self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Write all dirty rows in one transaction; returns the number of rows written"""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._dirty = list(self._dirty.values()), {}
+            if not rows:
+                return 0
+            connection = self.connection()
+            try:
+                with connection:
+                    connection.executemany(UPSERT, rows)
+            except sqlite3.Error as e:
+                logger.error(f"Error flushing {len(rows)} users: {e}")
+                # Put the rows back unless they were touched again meanwhile
+                with self._lock:
+                    for row in rows:
+                        self._dirty.setdefault(row[0], row)
+                return 0
+            with self._lock:
+                self._stats["rows_written"] += len(rows)
+                self._stats["flushes"] += 1
+            return len(rows)
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """Stop the flush thread and write what is left"""
+        self._stop.set()
+        self.flush()
+
+    def idle_user_ids(self, idle_seconds, not_broadcast_since=None, limit=None):
+        """Ids of users whose last interaction is older than `idle_seconds`"""
+        self.flush()
+        cutoff = time.time() - idle_seconds
+        query = "SELECT user_id FROM telegram_users WHERE last_interaction < ?"
+        params = [cutoff]
+        if not_broadcast_since is not None:
+            query += " AND (last_broadcast IS NULL OR last_broadcast < ?)"
+            params.append(not_broadcast_since)
+        query += " ORDER BY last_interaction"
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        return [row[0] for row in self.connection().execute(query, params)]
+
+    def active_user_ids(self, within_seconds, limit=None):
+        """Ids of users who interacted in the last `within_seconds`, most recent first"""
+        self.flush()
+        query = "SELECT user_id FROM telegram_users WHERE last_interaction >= ? ORDER BY last_interaction DESC"
+        params = [time.time() - within_seconds]
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        return [row[0] for row in self.connection().execute(query, params)]
+
+    def active_count(self, within_seconds):
+        self.flush()
+        return self.connection().execute(
+            "SELECT COUNT(*) FROM telegram_users WHERE last_interaction >= ?", (time.time() - within_seconds,)
+        ).fetchone()[0]
+
+    def mark_broadcast(self, user_ids, when=None):
+        when = when or time.time()
+        connection = self.connection()
+        with connection:
+            connection.executemany(
+                "UPDATE telegram_users SET last_broadcast = ? WHERE user_id = ?",
+                [(when, user_id) for user_id in user_ids],
+            )
+
+    def count(self):
+        self.flush()
+        return self.connection().execute("SELECT COUNT(*) FROM telegram_users").fetchone()[0]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["dirty"] = len(self._dirty)
+        stats["coalescing_ratio"] = stats["interactions"] / stats["rows_written"] if stats["rows_written"] else 0.0
+        return stats